@@ -1,15 +1,73 @@
-from urllib.parse import urlparse as urlparse_func
+import os
+import time
 
-import requests
 # from flasgger import Swagger, swag_from
-from flask import Flask, Response, jsonify, render_template, request
+from typing import Any, Callable, Dict, Tuple
+from urllib.parse import urlparse as urlparse_func
 
-from config import API_URL, PASSPHRASE
+from flask import (
+    Flask,
+    Response,
+    g,
+    jsonify,
+    render_template,
+    request,
+    send_from_directory,
+    url_for,
+)
+
+import config
+from batch import BATCH_MAX_POSTS, authorize_items, publish_batch
+from clustering import get_cluster_index
+from config import PASSPHRASE
+from coordinate_sets import (
+    decode_polyline,
+    get_coordinate_sets,
+    parse_coordinate_string,
+    to_geojson,
+)
 from hreview import create_map
-from mediawiki import (SyndicationLinkNotPresent, UserNotAuthorized,
-                       get_csrf_token, get_login_token_state, log_in,
-                       parse_url, update_map_on_category_page,
-                       verify_user_is_authorized)
+from jobs import QueueFull, job_queue
+from mediawiki import (
+    MicroformatsNotFound,
+    SyndicationLinkNotPresent,
+    UserNotAuthorized,
+    get_page_url,
+    get_wiki_session,
+    parse_url,
+    rebuild_category_map,
+    verify_user_is_authorized,
+)
+from metrics import (
+    METRICS_ENABLED,
+    REQUEST_SECONDS,
+    REQUESTS_IN_FLIGHT,
+    render_metrics,
+    start_request_timings,
+)
+from profiling import (
+    PROFILE_DIR,
+    PROFILE_EXTENSION,
+    format_profile,
+    list_profiles,
+    should_profile,
+    start_profile,
+    stop_profile,
+)
+from source_cache import (
+    MAX_SOURCE_BYTES,
+    SourceRejected,
+    SourceTooLarge,
+    UnsupportedContentType,
+)
+
+# if True, /webhook queues posts and returns 202 instead of publishing them inline
+ASYNC_WEBHOOK = getattr(config, "ASYNC_WEBHOOK", False)
+
+# the endpoints that can be profiled with the X-Profile header or by sampling
+PROFILED_ENDPOINTS = getattr(
+    config, "PROFILED_ENDPOINTS", {"index", "submit_post", "submit_batch"}
+)
 
 app = Flask(__name__)
 
@@ -22,22 +80,242 @@ app.config["SWAGGER"] = {
 # swagger = Swagger(app)
 
 
+@app.before_request
+def start_timing():
+    g.request_timings = start_request_timings()
+
+    if g.request_timings is not None:
+        REQUESTS_IN_FLIGHT.inc(endpoint=request.endpoint)
+
+
+@app.before_request
+def start_profiling():
+    endpoint = request.endpoint
+
+    if endpoint is None or endpoint not in PROFILED_ENDPOINTS:
+        return
+
+    token = request.headers.get("X-Profile") or request.args.get("profile")
+
+    if should_profile(token):
+        g.profile = start_profile(endpoint)
+
+
+@app.after_request
+def save_profile(response):
+    profile = g.get("profile")
+
+    if profile is not None:
+        file_name = profile.save()
+
+        if file_name:
+            response.headers["X-Profile-Trace"] = url_for("profile_trace", name=file_name)
+
+    return response
+
+
+@app.after_request
+def add_server_timing(response):
+    timings = g.get("request_timings")
+
+    if timings is not None:
+        # the time spent in each stage, shown in the browser's developer tools
+        response.headers["Server-Timing"] = timings.server_timing()
+
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - timings.started,
+            endpoint=request.endpoint,
+            method=request.method,
+            status=response.status_code,
+        )
+
+    return response
+
+
+@app.teardown_request
+def finish_timing(exception):
+    if g.get("request_timings") is not None:
+        REQUESTS_IN_FLIGHT.dec(endpoint=request.endpoint)
+
+
+@app.teardown_request
+def finish_profiling(exception):
+    # runs even if the view raised, so the profile never outlives its request
+    profile = g.pop("profile", None)
+
+    if profile is not None:
+        stop_profile(profile)
+
+
+def _passphrase_given() -> bool:
+    return PASSPHRASE in (request.args.get("passphrase"), request.headers.get("X-Profile"))
+
+
+@app.route("/profiles")
+def profiles():
+    if not _passphrase_given():
+        return jsonify({"error": "user not authorised"}), 403
+
+    return jsonify(
+        {
+            "profiles": [
+                {**profile, "url": url_for("profile_trace", name=profile["name"])}
+                for profile in list_profiles()
+            ]
+        }
+    )
+
+
+@app.route("/profiles/<name>")
+def profile_trace(name):
+    if not _passphrase_given():
+        return jsonify({"error": "user not authorised"}), 403
+
+    if not name.endswith(PROFILE_EXTENSION) or name not in {
+        profile["name"] for profile in list_profiles()
+    }:
+        return jsonify({"error": "profile not found"}), 404
+
+    if request.args.get("format") == "text":
+        return Response(
+            format_profile(os.path.join(PROFILE_DIR, name)), content_type="text/plain"
+        )
+
+    return send_from_directory(os.path.abspath(PROFILE_DIR), name, as_attachment=True)
+
+
+@app.route("/metrics")
+def metrics():
+    if not METRICS_ENABLED:
+        return jsonify({"error": "metrics are not enabled"}), 404
+
+    return Response(
+        render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+def source_error_response(error: Exception) -> Tuple[Response, int]:
+    """
+    Makes the response for a post that was rejected before, or after, it was parsed.
+
+    :param error: A SourceRejected or MicroformatsNotFound exception.
+    :type error: Exception
+    :return: A JSON error and its status code.
+    :rtype: Tuple[Response, int]
+    """
+    if isinstance(error, SourceTooLarge):
+        return jsonify({"error": f"post is larger than {MAX_SOURCE_BYTES} bytes"}), 413
+
+    if isinstance(error, UnsupportedContentType):
+        return jsonify({"error": f"post is not HTML ({error})"}), 415
+
+    return jsonify({"error": "no h-recipe, h-review or h-entry found"}), 422
+
+
 @app.route("/", methods=["GET", "POST"])
 def index():
     if request.method == "POST":
-        content_details, _, post_type = parse_url(
-            request.form["url"], "", requests.Session, False
-        )
+        try:
+            items = list(parse_url(request.form["url"], None, False))
+        except (SourceRejected, MicroformatsNotFound) as exception:
+            return source_error_response(exception)
+
+        post_types = [post_type for _, _, post_type in items]
+
         return render_template(
             "index.html",
             url=request.form["url"],
-            markup=content_details["content"]["html"],
-            post_type=post_type,
+            markup="\n\n".join(
+                content_details["content"]["html"] for content_details, _, _ in items
+            ),
+            post_type=", ".join(dict.fromkeys(post_types)),
         )
 
     return render_template("index.html")
 
 
+def publish_post(url_to_parse: str) -> Dict[str, Any]:
+    """
+    Publishes every item in a post to the wiki.
+
+    :param url_to_parse: The URL of the post to publish.
+    :type url_to_parse: str
+    :return: The title and URL of the wiki page that was created or edited for
+        the first item, and for each item in "items".
+    :rtype: Dict[str, Any]
+    """
+    items = [
+        {
+            "post_type": post_type,
+            "page": content_details["name"],
+            "page_url": get_page_url(content_details["name"]),
+            "status": content_details.get("status"),
+        }
+        for content_details, _, post_type in parse_url(url_to_parse, get_wiki_session())
+    ]
+
+    return {**items[0], "items": items}
+
+
+def wants_async() -> bool:
+    """
+    Checks whether posts sent in the current request should be queued.
+
+    :return: True if ASYNC_WEBHOOK is set or the request has ?async=true.
+    :rtype: bool
+    """
+    return ASYNC_WEBHOOK or request.args.get("async") == "true"
+
+
+def queue_job(function: Callable[..., Any], *args: Any) -> Response:
+    """
+    Queues a function to be run in the background.
+
+    :param function: The function to run.
+    :type function: Callable[..., Any]
+    :return: A 202 response with the location of the job's status, or a 429
+        response if the queue is full.
+    :rtype: Response
+    """
+    try:
+        job = job_queue.submit(function, *args)
+    except QueueFull:
+        response = jsonify({"error": "too many posts are waiting to be processed"})
+        response.status_code = 429
+        response.headers["Retry-After"] = "30"
+
+        return response
+
+    response = jsonify(job.to_dict())
+    response.status_code = 202
+    response.headers["Location"] = url_for("job_status", job_id=job.id)
+
+    return response
+
+
+def publish_post_now(url_to_parse: str) -> Any:
+    """
+    Publishes a post while the request waits.
+
+    :param url_to_parse: The URL of the post to publish.
+    :type url_to_parse: str
+    :return: A 201 response with the URL of the post, or an error response if
+        the post could not be read.
+    """
+    try:
+        publish_post(url_to_parse)
+    except (SourceRejected, MicroformatsNotFound) as exception:
+        return source_error_response(exception)
+    # except SyndicationLinkNotPresent:
+    #     return jsonify({"error": "syndication link not present"}), 400
+
+    # set Location header
+    response = Response(status=201)
+    response.headers["Location"] = url_to_parse
+
+    return response
+
+
 @app.route("/webhook", methods=["POST"])
 # @swag_from("docs/webhook.yml")
 def submit_post():
@@ -64,49 +342,184 @@ def submit_post():
 
     domain = urlparse_func(url_to_parse).netloc
 
-    token_request, session = get_login_token_state(API_URL)
-
-    log_in(API_URL, token_request, session)
-
-    csrf_token_request = get_csrf_token(API_URL, session)
+    # the session is logged in once and shared between requests
+    wiki_session = get_wiki_session()
 
     # user must be on approved list of domains
     try:
-        verify_user_is_authorized(API_URL, domain, session)
+        verify_user_is_authorized(domain, wiki_session)
     except UserNotAuthorized:
         return jsonify({"error": "user not authorised"}), 403
 
-    # try:
-    parse_url(url_to_parse, csrf_token_request, session)
-    # except SyndicationLinkNotPresent:
-    #     return jsonify({"error": "syndication link not present"}), 400
+    if wants_async():
+        return queue_job(publish_post, url_to_parse)
 
-    # set Location header
-    response = Response(status=201)
-    response.headers["Location"] = url_to_parse
+    return publish_post_now(url_to_parse)
 
-    return response
+
+@app.route("/webhook/batch", methods=["POST"])
+def submit_batch():
+    if request.args.get("passphrase") != PASSPHRASE:
+        return jsonify({"error": "user not authorised"}), 403
+
+    posts = request.json.get("posts") if isinstance(request.json, dict) else None
+
+    if not isinstance(posts, list) or len(posts) == 0:
+        return jsonify({"error": "invalid request body"}), 400
+
+    if len(posts) > BATCH_MAX_POSTS:
+        return (
+            jsonify({"error": f"no more than {BATCH_MAX_POSTS} posts can be sent at once"}),
+            413,
+        )
+
+    items = []
+
+    for post in posts:
+        url_to_parse = post.get("url", "") if isinstance(post, dict) else ""
+
+        if not isinstance(url_to_parse, str) or url_to_parse == "":
+            return jsonify({"error": "invalid request body"}), 400
+
+        items.append({"url": url_to_parse})
+
+    wiki_session = get_wiki_session()
+
+    authorize_items(items, wiki_session)
+
+    if wants_async():
+        return queue_job(publish_batch, items, wiki_session)
+
+    return jsonify(publish_batch(items, wiki_session))
+
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = job_queue.get(job_id)
+
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+
+    return jsonify(job.to_dict())
+
+
+# coordinate sets are named by the hash of their contents, so they never change
+MAP_CACHE_MAX_AGE = 60 * 60 * 24 * 365
 
 
 @app.route("/map")  # , methods=["POST"])
 # @swag_from("docs/map.yml")
 def map():
-    coordinates = request.args.get("coordinates")
+    try:
+        if request.args.get("polyline"):
+            coordinate_lists = decode_polyline(request.args["polyline"])
+        else:
+            coordinate_lists = [
+                list(pair)
+                for pair in parse_coordinate_string(request.args.get("coordinates", ""))
+            ]
+    except ValueError:
+        return jsonify({"error": "invalid coordinates"}), 400
 
-    coordinate_list = coordinates.split("|")
+    return render_template("mapindex.html", coordinates=coordinate_lists)
 
-    coordinate_lists = [coordinate.split(",") for coordinate in coordinate_list]
 
-    coordinate_lists = [
-        [float(coordinate) for coordinate in coordinate_list]
-        for coordinate_list in coordinate_lists
-    ]
+def _cacheable(response: Response, set_id: str) -> Response:
+    response.set_etag(set_id)
+    response.cache_control.public = True
+    response.cache_control.max_age = MAP_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    response.make_conditional(request)
 
-    return render_template("mapindex.html", coordinates=coordinate_lists)
+    return response
+
+
+@app.route("/map/<set_id>")
+def stored_map(set_id):
+    coordinates = get_coordinate_sets().get(set_id)
+
+    if coordinates is None:
+        return jsonify({"error": "map not found"}), 404
+
+    bounds = None
+
+    if coordinates:
+        latitudes = [latitude for latitude, _ in coordinates]
+        longitudes = [longitude for _, longitude in coordinates]
+        bounds = [[min(latitudes), min(longitudes)], [max(latitudes), max(longitudes)]]
+
+    # markers are fetched for the visible area instead of being embedded in the page
+    response = Response(
+        render_template(
+            "mapindex.html",
+            coordinates=[],
+            bounds=bounds,
+            clusters_url=url_for("map_clusters", set_id=set_id),
+        )
+    )
+
+    return _cacheable(response, set_id)
+
+
+@app.route("/map/<set_id>/clusters")
+def map_clusters(set_id):
+    cluster_index = get_cluster_index(set_id)
+
+    if cluster_index is None:
+        return jsonify({"error": "map not found"}), 404
+
+    try:
+        west, south, east, north = [
+            float(value) for value in request.args.get("bbox", "").split(",")
+        ]
+        zoom = int(request.args.get("zoom", ""))
+    except ValueError:
+        return jsonify({"error": "bbox and zoom must be specified"}), 400
 
+    clusters = cluster_index.query(west, south, east, north, zoom)
 
-@app.route("/map/update")
+    response = jsonify({"clusters": [cluster.to_dict() for cluster in clusters]})
+    response.cache_control.public = True
+    response.cache_control.max_age = MAP_CACHE_MAX_AGE
+
+    return response
+
+
+@app.route("/map/<set_id>.geojson")
+def stored_map_geojson(set_id):
+    coordinates = get_coordinate_sets().get(set_id)
+
+    if coordinates is None:
+        return jsonify({"error": "map not found"}), 404
+
+    response = jsonify(to_geojson(coordinates))
+    response.mimetype = "application/geo+json"
+
+    return _cacheable(response, set_id)
+
+
+@app.route("/map/update", methods=["POST"])
 def update_map():
-    update_map_on_category_page("Leeds")
+    if request.args.get("passphrase") != PASSPHRASE:
+        return jsonify({"error": "user not authorised"}), 403
+
+    category = request.args.get("category", "")
+
+    if category == "":
+        return jsonify({"error": "category not specified"}), 400
+
+    # a full rebuild fetches every page in the category, so it runs in the background
+    try:
+        job = job_queue.submit(rebuild_category_map, category)
+    except QueueFull:
+        response = jsonify({"error": "too many jobs are waiting to be processed"})
+        response.status_code = 429
+        response.headers["Retry-After"] = "30"
+
+        return response
 
-    return ""
+    response = jsonify(job.to_dict())
+    response.status_code = 202
+    response.headers["Location"] = url_for("job_status", job_id=job.id)
+
+    return response
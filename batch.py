@@ -0,0 +1,254 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+
+import config
+from mediawiki import (
+    INTERACTIVE,
+    MicroformatsNotFound,
+    SyndicationLinkNotPresent,
+    UserNotAuthorized,
+    WikiSession,
+    edit_priority,
+    get_page_revisions,
+    get_page_url,
+    parse_url,
+    publish_content,
+    verify_user_is_authorized,
+)
+from metrics import in_request_context
+from source_cache import (
+    MAX_SOURCE_BYTES,
+    PostMarkupNotFound,
+    SourceTooLarge,
+    UnsupportedContentType,
+)
+
+logger = logging.getLogger(__name__)
+
+# the number of posts that can be sent to /webhook/batch in one request
+BATCH_MAX_POSTS = getattr(config, "BATCH_MAX_POSTS", 100)
+
+# the number of posts that are fetched, or pages that are edited, at the same time
+BATCH_WORKERS = getattr(config, "BATCH_WORKERS", 8)
+
+
+def authorize_items(items: List[Dict[str, Any]], wiki_session: WikiSession) -> None:
+    """
+    Marks the items whose authors are not wiki users as errors.
+
+    Each domain is only checked once, however many of its posts are in the list.
+
+    :param items: One dictionary per post with a "url" key.
+    :type items: List[Dict[str, Any]]
+    :param wiki_session: The session used to make requests to the API.
+    :type wiki_session: WikiSession
+    """
+    authorized_domains: Dict[str, bool] = {}
+
+    for item in items:
+        domain = urlparse(item["url"]).netloc
+
+        if domain not in authorized_domains:
+            try:
+                verify_user_is_authorized(domain, wiki_session)
+                authorized_domains[domain] = True
+            except UserNotAuthorized:
+                authorized_domains[domain] = False
+
+        if not authorized_domains[domain]:
+            item["status"] = "error"
+            item["error"] = "user not authorised"
+
+
+def _error_message(error: Exception) -> str:
+    if isinstance(error, SyndicationLinkNotPresent):
+        return "syndication link not present"
+
+    if isinstance(error, (MicroformatsNotFound, PostMarkupNotFound)):
+        return "no h-recipe, h-review or h-entry found"
+
+    if isinstance(error, SourceTooLarge):
+        return f"post is larger than {MAX_SOURCE_BYTES} bytes"
+
+    if isinstance(error, UnsupportedContentType):
+        return f"post is not HTML ({error})"
+
+    return str(error) or type(error).__name__
+
+
+def _parse_post(post: Dict[str, Any]) -> None:
+    started = time.monotonic()
+
+    try:
+        post["entries"] = [
+            {
+                "url": post["url"],
+                "content_details": content_details,
+                "post_type": post_type,
+            }
+            for content_details, _, post_type in parse_url(
+                post["url"], None, False, skip_unchanged=True
+            )
+        ]
+    except Exception as error:
+        logger.warning("could not parse %s", post["url"], exc_info=True)
+        post["status"] = "error"
+        post["error"] = _error_message(error)
+
+    post["parse_seconds"] = round(time.monotonic() - started, 3)
+
+
+def _publish_entries(
+    entries: List[Dict[str, Any]],
+    wiki_session: WikiSession,
+    exists: Optional[bool],
+    priority: int,
+) -> None:
+    # entries that edit the same page are published one after another
+    for entry in entries:
+        started = time.monotonic()
+
+        try:
+            with edit_priority(priority):
+                entry["status"] = publish_content(
+                    entry["content_details"], entry["post_type"], wiki_session, exists
+                )
+        except Exception as error:
+            logger.warning("could not publish %s", entry["url"], exc_info=True)
+            entry["status"] = "error"
+            entry["error"] = _error_message(error)
+        else:
+            exists = exists or entry["status"] in ("created", "updated")
+
+        entry["edit_seconds"] = round(time.monotonic() - started, 3)
+
+
+def _post_status(entries: List[Dict[str, Any]]) -> str:
+    statuses = {entry["status"] for entry in entries}
+
+    for status in ("error", "created", "updated"):
+        if status in statuses:
+            return status
+
+    return "skipped"
+
+
+def _entry_result(entry: Dict[str, Any]) -> Dict[str, Any]:
+    page = entry["content_details"]["name"]
+
+    result = {
+        "post_type": entry["post_type"],
+        "page": page,
+        "page_url": get_page_url(page),
+        "status": entry["status"],
+        "edit_seconds": entry.get("edit_seconds"),
+    }
+
+    if "error" in entry:
+        result["error"] = entry["error"]
+
+    return result
+
+
+def publish_batch(
+    items: List[Dict[str, Any]],
+    wiki_session: WikiSession,
+    workers: int = BATCH_WORKERS,
+    priority: int = INTERACTIVE,
+) -> Dict[str, Any]:
+    """
+    Publishes several posts to the wiki.
+
+    Every post is fetched and parsed concurrently. The edits for every item
+    in every post are then grouped by page title so that items about the same
+    page are applied in order, while edits to different pages run
+    concurrently. Whether each page exists is looked up for up to 50 pages at
+    a time before any edits are made.
+
+    :param items: One dictionary per post with a "url" key. Posts that already
+        have a "status" (for example, because their author is not authorized)
+        are not fetched and are returned as they are.
+    :type items: List[Dict[str, Any]]
+    :param wiki_session: The session used to make edits.
+    :type wiki_session: WikiSession
+    :param workers: The number of posts fetched, or pages edited, at the same time.
+    :type workers: int
+    :param priority: The priority of the edits, INTERACTIVE or BACKGROUND.
+    :type priority: int
+    :return: A dictionary with one result per post, in the order they were given.
+        Each result lists the pages its items were published to in "items".
+    :rtype: Dict[str, Any]
+    """
+    started = time.monotonic()
+
+    pending = [post for post in items if "status" not in post]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(in_request_context(_parse_post), pending))
+
+    pages: Dict[str, List[Dict[str, Any]]] = {}
+
+    for post in pending:
+        for entry in post.get("entries", []):
+            # items that have not changed since they were last published are not edited again
+            if entry["content_details"].get("status") == "skipped":
+                entry["status"] = "skipped"
+                entry["edit_seconds"] = 0.0
+            else:
+                pages.setdefault(entry["content_details"]["name"], []).append(entry)
+
+    revisions = get_page_revisions(list(pages), wiki_session) if pages else {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(
+            executor.map(
+                in_request_context(
+                    lambda title: _publish_entries(
+                        pages[title],
+                        wiki_session,
+                        revisions[title] is not None,
+                        priority,
+                    )
+                ),
+                pages,
+            )
+        )
+
+    results = []
+
+    for post in items:
+        entries = [_entry_result(entry) for entry in post.get("entries", [])]
+
+        result = {
+            "url": post["url"],
+            "status": post.get("status") or _post_status(entries),
+            "post_type": entries[0]["post_type"] if entries else None,
+            "parse_seconds": post.get("parse_seconds"),
+            "edit_seconds": (
+                round(sum(entry["edit_seconds"] for entry in entries), 3)
+                if entries
+                else None
+            ),
+        }
+
+        if entries:
+            result["page"] = entries[0]["page"]
+            result["page_url"] = entries[0]["page_url"]
+            result["items"] = entries
+
+        if "error" in post:
+            result["error"] = post["error"]
+        elif result["status"] == "error":
+            result["error"] = next(
+                entry["error"] for entry in entries if "error" in entry
+            )
+
+        results.append(result)
+
+    return {
+        "results": results,
+        "seconds": round(time.monotonic() - started, 3),
+    }
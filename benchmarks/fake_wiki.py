@@ -0,0 +1,433 @@
+"""
+A local stand-in for a MediaWiki api.php, the wiki's pages and the websites
+that posts are fetched from, used by the benchmarks.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+HEADING_PATTERN = re.compile(r"^(={2,6})(.+?)\1[ \t]*$", re.MULTILINE)
+
+# markup repeated to make the large review page
+PADDING_BLOCK = (
+    "<div class='comment'><p>Great review, I went there last week and had the "
+    "same experience. The <a href='/menu'>menu</a> has changed since, though.</p>"
+    "<ul><li>Flat white</li><li>Cortado</li><li>Filter</li></ul></div>\n"
+)
+
+
+def _sections(text: str) -> List[Tuple[int, int, int, str]]:
+    """
+    Splits wikitext into sections the way MediaWiki numbers them.
+
+    :return: The level, start, end and heading of each section after the lead.
+    """
+    headings = [
+        (len(match.group(1)), match.start(), match.group(2).strip())
+        for match in HEADING_PATTERN.finditer(text)
+    ]
+
+    sections = []
+
+    for index, (level, start, line) in enumerate(headings):
+        end = len(text)
+
+        for next_level, next_start, _ in headings[index + 1 :]:
+            if next_level <= level:
+                end = next_start
+                break
+
+        sections.append((level, start, end, line))
+
+    return sections
+
+
+def _section_range(text: str, section: int) -> Tuple[int, int]:
+    sections = _sections(text)
+
+    if section == 0:
+        return 0, sections[0][1] if sections else len(text)
+
+    _, start, end, _ = sections[section - 1]
+
+    return start, end
+
+
+class FakeWiki:
+    """
+    The pages, users and revisions of the fake wiki.
+    """
+
+    def __init__(self, users: List[str], edit_latency: float = 0.0):
+        self.users = sorted(users)
+        self.edit_latency = edit_latency
+        self.pages: Dict[str, Dict[str, Any]] = {}
+        self.revid = 0
+        self.edits = 0
+        # the number of requests to answer as if the bot's login had expired
+        self.expired_logins = 0
+        self._lock = threading.Lock()
+
+    def _timestamp(self) -> str:
+        return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+    def check_login(self, params: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        """
+        Fails requests that assert they are logged in while expired_logins is set.
+
+        :return: The error, or None if the request can go ahead.
+        """
+        with self._lock:
+            if not self.expired_logins or params.get("assert") != "user":
+                return None
+
+            self.expired_logins -= 1
+
+        return {
+            "error": {
+                "code": "assertuserfailed",
+                "info": "You are no longer logged in.",
+            }
+        }
+
+    def query(self, params: Dict[str, str]) -> Dict[str, Any]:
+        if params.get("meta") == "tokens":
+            return {
+                "query": {"tokens": {"logintoken": "login+\\", "csrftoken": "csrf+\\"}}
+            }
+
+        if params.get("list") == "allusers":
+            return {"query": {"allusers": [{"name": user} for user in self.users]}}
+
+        if params.get("list") == "logevents":
+            return {"query": {"logevents": []}}
+
+        if params.get("list") == "categorymembers":
+            category = params["cmtitle"]
+
+            with self._lock:
+                members = [
+                    {"title": title}
+                    for title, page in self.pages.items()
+                    if f"[[{category}]]" in page["text"]
+                ]
+
+            return {"query": {"categorymembers": members}}
+
+        if params.get("prop") == "revisions":
+            return {
+                "query": {
+                    "pages": [
+                        self._revisions(title, params)
+                        for title in params["titles"].split("|")
+                    ]
+                }
+            }
+
+        raise ValueError(f"unsupported query: {params}")
+
+    def _revisions(self, title: str, params: Dict[str, str]) -> Dict[str, Any]:
+        with self._lock:
+            page = self.pages.get(title)
+
+            if page is None:
+                return {"title": title, "missing": True}
+
+            revision = {"revid": page["revid"], "timestamp": page["timestamp"]}
+
+            if "content" in params.get("rvprop", ""):
+                text = page["text"]
+
+                if "rvsection" in params:
+                    start, end = _section_range(text, int(params["rvsection"]))
+                    text = text[start:end]
+
+                revision["slots"] = {"main": {"content": text}}
+
+        return {"title": title, "revisions": [revision]}
+
+    def parse(self, params: Dict[str, str]) -> Dict[str, Any]:
+        with self._lock:
+            text = self.pages[params["page"]]["text"]
+
+        return {
+            "parse": {
+                "sections": [
+                    {"index": str(index), "level": str(level), "line": line}
+                    for index, (level, _, _, line) in enumerate(
+                        _sections(text), start=1
+                    )
+                ]
+            }
+        }
+
+    def edit(self, params: Dict[str, str]) -> Dict[str, Any]:
+        if self.edit_latency:
+            time.sleep(self.edit_latency)
+
+        title = params["title"]
+
+        with self._lock:
+            page = self.pages.get(title)
+
+            if page is None and params.get("nocreate"):
+                return {
+                    "error": {
+                        "code": "missingtitle",
+                        "info": "The page does not exist.",
+                    }
+                }
+
+            if page is not None and params.get("createonly"):
+                return {
+                    "error": {
+                        "code": "articleexists",
+                        "info": "The page already exists.",
+                    }
+                }
+
+            if (
+                page is not None
+                and params.get("baserevid")
+                and int(params["baserevid"]) != page["revid"]
+            ):
+                return {"error": {"code": "editconflict", "info": "Edit conflict."}}
+
+            text = page["text"] if page else ""
+
+            if "section" in params and page is not None:
+                start, end = _section_range(text, int(params["section"]))
+            else:
+                start, end = 0, len(text)
+
+            if "text" in params:
+                new_text = text[:start] + params["text"] + text[end:]
+            else:
+                new_text = (
+                    text[:start]
+                    + params.get("prependtext", "")
+                    + text[start:end]
+                    + params.get("appendtext", "")
+                    + text[end:]
+                )
+
+            if page is not None and new_text == text:
+                return {"edit": {"result": "Success", "title": title, "nochange": ""}}
+
+            self.revid += 1
+            self.edits += 1
+            self.pages[title] = {
+                "text": new_text,
+                "revid": self.revid,
+                "timestamp": self._timestamp(),
+            }
+
+            edit = {"result": "Success", "title": title, "newrevid": self.revid}
+
+            if page is None:
+                edit["new"] = ""
+
+            return {"edit": edit}
+
+    def render(self, title: str) -> Optional[str]:
+        with self._lock:
+            page = self.pages.get(title)
+
+        if page is None:
+            return None
+
+        # the HTML in reviews and infoboxes is passed through, which is all the map rebuild needs
+        return f"<!DOCTYPE html><html><body><main>{page['text']}</main></body></html>"
+
+
+def _read_fixture(name: str) -> Optional[str]:
+    path = os.path.join(FIXTURE_DIR, os.path.basename(name) + ".html")
+
+    if not os.path.isfile(path):
+        return None
+
+    with open(path) as fixture:
+        return fixture.read()
+
+
+def _fill(template: str, values: Dict[str, str]) -> str:
+    return re.sub(
+        r"\{(\w+)\}", lambda match: values.get(match.group(1), match.group(0)), template
+    )
+
+
+def render_fixture(
+    name: str, query: Dict[str, List[str]], origin: str, path: str
+) -> Optional[str]:
+    """
+    Fills in the placeholders in a fixture.
+
+    Each post has a number, given by the "n" query parameter, so that every
+    request can be made for a different post and place. Fixtures whose names
+    start with an underscore are fragments of other fixtures and are not served.
+
+    :return: The page, or None if there is no such fixture.
+    """
+    if name.startswith("_"):
+        return None
+
+    template = _read_fixture(name)
+
+    if template is None:
+        return None
+
+    number = int(query.get("n", ["0"])[0])
+
+    values = {
+        "n": str(number),
+        "url": f"{origin}{path}?n={number}",
+        "origin": origin,
+        "latitude": f"{50 + (number % 1000) * 0.01:.4f}",
+        "longitude": f"{-5 + (number // 1000) * 0.01:.4f}",
+        "padding": PADDING_BLOCK * int(query.get("padding", ["400"])[0]),
+        "reviews": "",
+    }
+
+    if "{reviews}" in template:
+        review = _read_fixture("_review") or ""
+        values["reviews"] = "".join(
+            _fill(review, dict(values, index=str(index)))
+            for index in range(int(query.get("reviews", ["10"])[0]))
+        )
+
+    return _fill(template, values)
+
+
+def _login(params: Dict[str, str]) -> Dict[str, Any]:
+    return {"login": {"result": "Success", "lgusername": params.get("lgname")}}
+
+
+class WikiHandler(BaseHTTPRequestHandler):
+    """
+    Serves api.php, the wiki's pages and the posts. Subclassed by make_handler
+    for each fake wiki.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, so Nagle's algorithm would delay every response
+    disable_nagle_algorithm = True
+
+    wiki: FakeWiki
+    actions: Dict[str, Callable[[Dict[str, str]], Dict[str, Any]]]
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _send(self, status: int, body: str, content_type: str) -> None:
+        encoded = body.encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def _api(self, params: Dict[str, str]) -> None:
+        action = params.get("action", "")
+        expired = self.wiki.check_login(params)
+
+        try:
+            if expired is not None:
+                result = expired
+            elif action in self.actions:
+                result = self.actions[action](params)
+            else:
+                result = {
+                    "error": {
+                        "code": "badvalue",
+                        "info": f"unsupported action {action}",
+                    }
+                }
+        except (KeyError, ValueError) as exception:
+            result = {"error": {"code": "internal_api_error", "info": str(exception)}}
+
+        self._send(200, json.dumps(result), "application/json")
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == "/api.php":
+            self._api({key: values[-1] for key, values in query.items()})
+            return
+
+        if url.path.startswith("/wiki/"):
+            body = self.wiki.render(
+                unquote(url.path[len("/wiki/") :]).replace("_", " ")
+            )
+        elif url.path.startswith("/posts/"):
+            origin = f"http://{self.headers['Host']}"
+            body = render_fixture(url.path[len("/posts/") :], query, origin, url.path)
+        else:
+            body = None
+
+        if body is None:
+            self._send(404, "not found", "text/plain")
+        else:
+            self._send(200, body, "text/html; charset=utf-8")
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode("utf-8"), keep_blank_values=True)
+
+        self._api({key: values[-1] for key, values in form.items()})
+
+
+def make_handler(wiki: FakeWiki) -> type:
+    actions: Dict[str, Callable[[Dict[str, str]], Dict[str, Any]]] = {
+        "query": wiki.query,
+        "login": _login,
+        "parse": wiki.parse,
+        "edit": wiki.edit,
+    }
+
+    return type("Handler", (WikiHandler,), {"wiki": wiki, "actions": actions})
+
+
+def start_server(wiki: FakeWiki) -> Tuple[ThreadingHTTPServer, str]:
+    """
+    Starts the fake wiki and post server on a free local port.
+
+    :return: The server and its base URL.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(wiki))
+    server.daemon_threads = True
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class FakeGeocoderBackend:
+    """
+    A geocoder backend that makes up an address after a fixed delay, in place of Nominatim.
+    """
+
+    remote = True
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    def reverse(self, latitude: float, longitude: float) -> Dict[str, Any]:
+        if self.latency:
+            time.sleep(self.latency)
+
+        return {
+            "road": f"{abs(int(latitude * 100)) % 90 + 1} Harbour Street",
+            "postcode": "AB1 2CD",
+            "city": f"Town {int(latitude * 10) % 20}",
+            "country": "United Kingdom" if latitude > 52 else "France",
+        }
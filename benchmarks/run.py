@@ -0,0 +1,435 @@
+"""
+Benchmarks the parsers and the /webhook endpoint without touching a real
+wiki, geocoder or website.
+
+A local server stands in for api.php and for the websites that posts are
+fetched from, and a fake geocoder stands in for Nominatim. Run from the root
+of the repository:
+
+    python -m benchmarks.run
+    python -m benchmarks.run --concurrency 1 8 32 --requests 500
+    python -m benchmarks.run --compare benchmarks/results/<earlier run>.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import types
+from typing import Any, Callable, Dict, List, Optional
+
+from benchmarks.fake_wiki import (
+    FakeGeocoderBackend,
+    FakeWiki,
+    render_fixture,
+    start_server,
+)
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+FIXTURES = [
+    "h_entry",
+    "h_review",
+    "h_review_geo",
+    "h_review_large",
+    "h_review_many",
+    "h_recipe",
+]
+
+PASSPHRASE = "benchmark"
+
+
+def install_config(api_origin: str, cache_dir: str) -> None:
+    """
+    Installs a config module that points the app at the fake wiki.
+
+    This must be called before any module of the app is imported, since they
+    read the config when they are imported.
+    """
+    config = types.ModuleType("config")
+
+    config.__dict__.update(
+        {
+            "API_URL": f"{api_origin}/api.php",
+            "WIKI_URL": f"{api_origin}/wiki/",
+            "PASSPHRASE": PASSPHRASE,
+            "LGNAME": "Benchmark",
+            "LGPASSWORD": "benchmark",
+            "SYNDICATION_LINK": "https://breakfastand.coffee",
+            "REQUIRE_SYNDICATION_LINK": False,
+            "METRICS_ENABLED": True,
+            "SOURCE_CACHE_DIR": os.path.join(cache_dir, "sources"),
+            "GEOCODE_CACHE_PATH": os.path.join(cache_dir, "geocode.sqlite3"),
+            "GEO_INDEX_PATH": os.path.join(cache_dir, "geo_index.sqlite3"),
+            "IDEMPOTENCY_STORE_PATH": os.path.join(cache_dir, "idempotency.sqlite3"),
+            "TEMPLATE_CACHE_DIR": os.path.join(cache_dir, "templates"),
+            "PROFILE_DIR": os.path.join(cache_dir, "profiles"),
+            # the fake wiki has no rate limit, so edits are only paced by the code being measured
+            "EDIT_RATE_LIMIT": 1_000_000,
+            "EDIT_BURST": 1_000_000,
+            # map updates are left out of the measurements
+            "MAP_UPDATE_QUIET_PERIOD": 24 * 60 * 60,
+        }
+    )
+
+    sys.modules["config"] = config
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """
+    Summarises latencies, in milliseconds.
+
+    :param samples: The latencies, in seconds.
+    :type samples: List[float]
+    :return: The count, mean, maximum and 50th, 90th and 99th percentiles.
+    :rtype: Dict[str, float]
+    """
+    if not samples:
+        return {"count": 0}
+
+    ordered = sorted(samples)
+
+    def nearest_rank(percentile: float) -> float:
+        index = max(0, int(round(percentile / 100 * len(ordered) + 0.5)) - 1)
+
+        return ordered[min(index, len(ordered) - 1)] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50": round(nearest_rank(50), 3),
+        "p90": round(nearest_rank(90), 3),
+        "p99": round(nearest_rank(99), 3),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+
+def parse_server_timing(header: str) -> Dict[str, float]:
+    """
+    Reads the stage timings, in seconds, from a Server-Timing header.
+    """
+    timings = {}
+
+    for metric in header.split(","):
+        name, _, parameters = metric.strip().partition(";")
+
+        for parameter in parameters.split(";"):
+            key, _, value = parameter.partition("=")
+
+            if key.strip() == "dur":
+                timings[name] = float(value) / 1000
+
+    return timings
+
+
+def time_calls(function: Callable[[], Any], iterations: int) -> Dict[str, float]:
+    samples = []
+
+    for _ in range(iterations):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+
+    return percentiles(samples)
+
+
+def run_micro_benchmarks(origin: str, iterations: int) -> Dict[str, Dict[str, Any]]:
+    """
+    Times parsing each fixture, and rendering each item on it, in isolation.
+    """
+    import mf2py
+
+    from hrecipe import parse_h_recipe
+    from hreview import parse_h_review
+    from mediawiki import find_items, parse_url
+    from microformats import extract_microformats
+
+    results = {}
+
+    for fixture in FIXTURES:
+        path = f"/posts/{fixture}"
+        html = render_fixture(fixture, {}, origin, path)
+
+        if html is None:
+            raise ValueError(f"no fixture named {fixture}")
+
+        url = f"{origin}{path}?n=0"
+        domain = url.split("/")[2]
+
+        parsed = mf2py.parse(doc=html, url=url)
+        extracted = extract_microformats(parsed)
+        items = find_items(extracted)
+
+        def render_items() -> None:
+            for post_type, item in items:
+                if post_type == "review":
+                    parse_h_review(item, extracted, url, domain)
+                elif post_type == "recipe":
+                    parse_h_recipe(item, domain)
+
+        results[fixture] = {
+            "bytes": len(html.encode("utf-8")),
+            "items": len(items),
+            "mf2_parse": time_calls(lambda: mf2py.parse(doc=html, url=url), iterations),
+            "extract": time_calls(
+                lambda: find_items(extract_microformats(parsed)), iterations
+            ),
+            "render": time_calls(render_items, iterations),
+            # fetched from the fake server, so this includes the source cache's revalidation
+            "parse_url": time_calls(
+                lambda: list(parse_url(url, None, edit=False)), iterations
+            ),
+        }
+
+    return results
+
+
+def run_load(
+    client_factory: Callable[[], Any],
+    origin: str,
+    concurrency: int,
+    requests_per_level: int,
+    counter: Dict[str, int],
+) -> Dict[str, Any]:
+    """
+    Sends posts to /webhook from several threads at once.
+
+    Every request is for a new post, so each one is fetched, parsed, geocoded
+    and published in full.
+    """
+    latencies: List[float] = []
+    stages: Dict[str, List[float]] = {}
+    statuses: Dict[str, int] = {}
+    lock = threading.Lock()
+
+    def next_url() -> Optional[str]:
+        with lock:
+            if counter["sent"] >= counter["limit"]:
+                return None
+
+            counter["sent"] += 1
+            number = counter["next"]
+            counter["next"] += 1
+
+        fixture = FIXTURES[number % len(FIXTURES)]
+
+        return f"{origin}/posts/{fixture}?n={number}"
+
+    def worker() -> None:
+        client = client_factory()
+
+        while True:
+            url = next_url()
+
+            if url is None:
+                return
+
+            started = time.perf_counter()
+            response = client.post(
+                f"/webhook?passphrase={PASSPHRASE}", json={"post": {"url": url}}
+            )
+            elapsed = time.perf_counter() - started
+
+            timings = parse_server_timing(response.headers.get("Server-Timing", ""))
+
+            with lock:
+                latencies.append(elapsed)
+                statuses[str(response.status_code)] = (
+                    statuses.get(str(response.status_code), 0) + 1
+                )
+
+                for name, seconds in timings.items():
+                    if name != "total":
+                        stages.setdefault(name, []).append(seconds)
+
+    counter["sent"] = 0
+    counter["limit"] = requests_per_level
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+
+    started = time.perf_counter()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    seconds = time.perf_counter() - started
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(len(latencies) / seconds, 3) if seconds else 0,
+        "statuses": statuses,
+        "latency": percentiles(latencies),
+        "stages": {
+            name: percentiles(samples) for name, samples in sorted(stages.items())
+        },
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """
+    Describes how a run differs from an earlier one.
+
+    :return: One line per measurement, with the percentage change.
+    :rtype: List[str]
+    """
+
+    def change(new: float, old: float) -> str:
+        if not old:
+            return "n/a"
+
+        return f"{(new - old) / old * 100:+.1f}%"
+
+    lines = []
+
+    for fixture, result in current["micro"].items():
+        for name, summary in result.items():
+            old = baseline.get("micro", {}).get(fixture, {}).get(name)
+
+            if isinstance(summary, dict) and isinstance(old, dict) and "p50" in old:
+                lines.append(
+                    f"{fixture} {name}: p50 {summary['p50']}ms ({change(summary['p50'], old['p50'])})"
+                )
+
+    old_levels = {
+        level["concurrency"]: level for level in baseline.get("end_to_end", [])
+    }
+
+    for level in current["end_to_end"]:
+        old = old_levels.get(level["concurrency"])
+
+        if old is None:
+            continue
+
+        rps_change = change(level["requests_per_second"], old["requests_per_second"])
+        p90_change = change(level["latency"]["p90"], old["latency"]["p90"])
+
+        lines.append(
+            f"webhook x{level['concurrency']}: "
+            f"{level['requests_per_second']} req/s ({rps_change}), "
+            f"p90 {level['latency']['p90']}ms ({p90_change})"
+        )
+
+    return lines
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the parsers and the /webhook endpoint offline."
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=50, help="Calls per micro-benchmark."
+    )
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=200,
+        help="Webhook requests per concurrency level.",
+    )
+    parser.add_argument(
+        "--edit-latency",
+        type=float,
+        default=0.0,
+        help="Seconds the fake wiki takes per edit.",
+    )
+    parser.add_argument(
+        "--geocode-latency",
+        type=float,
+        default=0.0,
+        help="Seconds the fake geocoder takes.",
+    )
+    parser.add_argument(
+        "--output", help="Where to save the results. Defaults to benchmarks/results/."
+    )
+    parser.add_argument(
+        "--compare", help="The results of an earlier run to compare against."
+    )
+
+    arguments = parser.parse_args()
+
+    wiki = FakeWiki([], edit_latency=arguments.edit_latency)
+    server, origin = start_server(wiki)
+
+    # the posts are served by the fake server, so its host is the registered user
+    wiki.users = [origin.split("/")[2]]
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        install_config(origin, cache_dir)
+
+        import geocode
+        from app import app
+
+        geocode._geocoder = geocode.ReverseGeocoder(
+            FakeGeocoderBackend(arguments.geocode_latency)
+        )
+
+        micro = run_micro_benchmarks(origin, arguments.iterations)
+
+        counter = {"next": 1, "sent": 0, "limit": 0}
+
+        # logs in and loads the user index, so the first level does not pay for it
+        run_load(app.test_client, origin, 1, len(FIXTURES), counter)
+
+        end_to_end = [
+            run_load(app.test_client, origin, concurrency, arguments.requests, counter)
+            for concurrency in arguments.concurrency
+        ]
+
+    server.shutdown()
+
+    results = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "iterations": arguments.iterations,
+            "requests": arguments.requests,
+            "edit_latency": arguments.edit_latency,
+            "geocode_latency": arguments.geocode_latency,
+        },
+        "micro": micro,
+        "end_to_end": end_to_end,
+        "wiki_edits": wiki.edits,
+    }
+
+    output = arguments.output or os.path.join(
+        RESULTS_DIR, time.strftime("%Y%m%dT%H%M%S", time.gmtime()) + ".json"
+    )
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    with open(output, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+
+    for fixture, result in micro.items():
+        print(
+            f"{fixture:>16}: mf2 {result['mf2_parse']['p50']}ms, "
+            f"render {result['render']['p50']}ms, parse_url {result['parse_url']['p50']}ms (p50)"
+        )
+
+    for level in end_to_end:
+        print(
+            f"webhook x{level['concurrency']:<3}: {level['requests_per_second']} req/s, "
+            f"p50 {level['latency']['p50']}ms, p90 {level['latency']['p90']}ms, "
+            f"p99 {level['latency']['p99']}ms, statuses {level['statuses']}"
+        )
+
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            for line in compare(results, json.load(baseline_file)):
+                print(line)
+
+    print(f"Saved the results to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import math
+from collections import defaultdict
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import config
+from coordinate_sets import get_coordinate_sets
+
+# the highest zoom level at which markers are clustered
+MAX_CLUSTER_ZOOM = getattr(config, "MAX_CLUSTER_ZOOM", 17)
+
+# the width, in pixels, of the grid cells used to cluster markers
+CLUSTER_CELL_PIXELS = getattr(config, "CLUSTER_CELL_PIXELS", 60)
+
+# the number of coordinate sets whose clusters are kept in memory
+CLUSTER_CACHE_SIZE = getattr(config, "CLUSTER_CACHE_SIZE", 64)
+
+# map tiles are 256 pixels wide
+TILE_SIZE = 256
+
+# Web Mercator cannot show the poles
+MAX_LATITUDE = 85.05112878
+
+Cell = Tuple[int, int]
+
+
+def project(latitude: float, longitude: float) -> Tuple[float, float]:
+    """
+    Projects a coordinate to Web Mercator, scaled so the world is one unit wide.
+
+    :param latitude: The latitude of the point.
+    :type latitude: float
+    :param longitude: The longitude of the point.
+    :type longitude: float
+    :return: The x and y position of the point, each between 0 and 1.
+    :rtype: Tuple[float, float]
+    """
+    latitude = max(min(latitude, MAX_LATITUDE), -MAX_LATITUDE)
+
+    x = (longitude + 180) / 360
+    sine = math.sin(math.radians(latitude))
+    y = 0.5 - math.log((1 + sine) / (1 - sine)) / (4 * math.pi)
+
+    return x, y
+
+
+class Cluster:
+    """
+    A group of nearby points shown as one marker.
+    """
+
+    __slots__ = ("latitude", "longitude", "count")
+
+    def __init__(self):
+        self.latitude = 0.0
+        self.longitude = 0.0
+        self.count = 0
+
+    def add(self, latitude: float, longitude: float) -> None:
+        self.count += 1
+
+        # keep a running mean so the marker sits at the centre of its points
+        self.latitude += (latitude - self.latitude) / self.count
+        self.longitude += (longitude - self.longitude) / self.count
+
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            "latitude": round(self.latitude, 6),
+            "longitude": round(self.longitude, 6),
+            "count": self.count,
+        }
+
+
+class ClusterIndex:
+    """
+    Marker clusters for a set of points, computed ahead of time for every zoom
+    level and stored in a grid so a viewport can be queried quickly.
+
+    Above MAX_CLUSTER_ZOOM, each point is returned as its own marker.
+    """
+
+    def __init__(self, coordinates: Sequence[Sequence[float]]):
+        self.grids: List[Dict[Cell, List[Cluster]]] = []
+
+        projected = [
+            (
+                float(latitude),
+                float(longitude),
+                project(float(latitude), float(longitude)),
+            )
+            for latitude, longitude in coordinates
+        ]
+
+        for zoom in range(MAX_CLUSTER_ZOOM + 2):
+            cells = self.cells_per_world(zoom)
+            grid: Dict[Cell, List[Cluster]] = defaultdict(list)
+
+            for latitude, longitude, (x, y) in projected:
+                cell = (min(int(x * cells), cells - 1), min(int(y * cells), cells - 1))
+
+                # above MAX_CLUSTER_ZOOM, every point gets its own marker
+                if not grid[cell] or zoom > MAX_CLUSTER_ZOOM:
+                    grid[cell].append(Cluster())
+
+                grid[cell][-1].add(latitude, longitude)
+
+            self.grids.append(dict(grid))
+
+    @staticmethod
+    def cells_per_world(zoom: int) -> int:
+        return max(1, (TILE_SIZE * 2**zoom) // CLUSTER_CELL_PIXELS)
+
+    def query(
+        self, west: float, south: float, east: float, north: float, zoom: int
+    ) -> List[Cluster]:
+        """
+        Gets the clusters in a bounding box at a zoom level.
+
+        :param west: The western longitude of the bounding box.
+        :type west: float
+        :param south: The southern latitude of the bounding box.
+        :type south: float
+        :param east: The eastern longitude of the bounding box.
+        :type east: float
+        :param north: The northern latitude of the bounding box.
+        :type north: float
+        :param zoom: The zoom level of the map.
+        :type zoom: int
+        :return: The clusters whose centres are inside the bounding box.
+        :rtype: List[Cluster]
+        """
+        zoom = max(0, min(zoom, len(self.grids) - 1))
+
+        grid = self.grids[zoom]
+        cells = self.cells_per_world(zoom)
+
+        min_x, min_y = project(north, max(west, -180))
+        max_x, max_y = project(south, min(east, 180))
+
+        first_column, last_column = int(min_x * cells), min(
+            int(max_x * cells), cells - 1
+        )
+        first_row, last_row = int(min_y * cells), min(int(max_y * cells), cells - 1)
+
+        range_size = (last_column - first_column + 1) * (last_row - first_row + 1)
+
+        # look up each cell in the viewport, unless the viewport has more cells than there are clusters
+        if range_size < len(grid):
+            candidates = [
+                cluster
+                for column in range(first_column, last_column + 1)
+                for row in range(first_row, last_row + 1)
+                for cluster in grid.get((column, row), [])
+            ]
+        else:
+            candidates = [cluster for clusters in grid.values() for cluster in clusters]
+
+        return [
+            cluster
+            for cluster in candidates
+            if south <= cluster.latitude <= north and west <= cluster.longitude <= east
+        ]
+
+
+@lru_cache(maxsize=CLUSTER_CACHE_SIZE)
+def get_cluster_index(set_id: str) -> Optional[ClusterIndex]:
+    """
+    Gets the clusters for a stored coordinate set.
+
+    Coordinate sets never change, so clusters are computed once per set and
+    kept in memory.
+
+    :param set_id: The ID of the coordinate set.
+    :type set_id: str
+    :return: The clusters, or None if the set does not exist.
+    :rtype: Optional[ClusterIndex]
+    """
+    coordinates = get_coordinate_sets().get(set_id)
+
+    if coordinates is None:
+        return None
+
+    return ClusterIndex(coordinates)
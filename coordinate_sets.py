@@ -0,0 +1,226 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import config
+
+# the SQLite database in which the coordinate sets shown on maps are stored
+COORDINATE_SETS_PATH = getattr(
+    config, "COORDINATE_SETS_PATH", ".cache/coordinate_sets.sqlite3"
+)
+
+# coordinates are encoded to five decimal places, about one metre
+POLYLINE_PRECISION = 5
+
+
+def _encode_value(value: int) -> str:
+    value = ~(value << 1) if value < 0 else value << 1
+
+    chunks = []
+
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1F)) + 63))
+        value >>= 5
+
+    chunks.append(chr(value + 63))
+
+    return "".join(chunks)
+
+
+def encode_polyline(coordinates: Iterable[Sequence[float]]) -> str:
+    """
+    Encodes coordinates with the encoded polyline algorithm.
+
+    :param coordinates: A list of [latitude, longitude] pairs.
+    :type coordinates: Iterable[Sequence[float]]
+    :return: The encoded polyline.
+    :rtype: str
+    """
+    factor = 10**POLYLINE_PRECISION
+
+    encoded = []
+    previous_latitude, previous_longitude = 0, 0
+
+    for latitude, longitude in coordinates:
+        latitude_value = round(float(latitude) * factor)
+        longitude_value = round(float(longitude) * factor)
+
+        encoded.append(_encode_value(latitude_value - previous_latitude))
+        encoded.append(_encode_value(longitude_value - previous_longitude))
+
+        previous_latitude, previous_longitude = latitude_value, longitude_value
+
+    return "".join(encoded)
+
+
+def decode_polyline(polyline: str) -> List[List[float]]:
+    """
+    Decodes a polyline encoded with the encoded polyline algorithm.
+
+    :param polyline: The encoded polyline.
+    :type polyline: str
+    :return: A list of [latitude, longitude] pairs.
+    :rtype: List[List[float]]
+
+    :raises ValueError: The polyline is not valid.
+    """
+    factor = 10**POLYLINE_PRECISION
+
+    values = []
+    value, shift = 0, 0
+
+    for character in polyline:
+        chunk = ord(character) - 63
+
+        if chunk < 0 or chunk > 0x3F:
+            raise ValueError("invalid character in polyline")
+
+        value |= (chunk & 0x1F) << shift
+        shift += 5
+
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value, shift = 0, 0
+
+    if shift != 0 or len(values) % 2 != 0:
+        raise ValueError("incomplete polyline")
+
+    coordinates = []
+    latitude, longitude = 0, 0
+
+    for index in range(0, len(values), 2):
+        latitude += values[index]
+        longitude += values[index + 1]
+
+        coordinates.append([latitude / factor, longitude / factor])
+
+    return coordinates
+
+
+class CoordinateSetStore:
+    """
+    Stores sets of coordinates under the hash of their contents, so maps can
+    be linked to with a short, permanent URL.
+    """
+
+    def __init__(self, path: str = COORDINATE_SETS_PATH):
+        directory = os.path.dirname(path)
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock, self._connection:
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS coordinate_sets (
+                    id TEXT PRIMARY KEY,
+                    polyline TEXT NOT NULL,
+                    created REAL NOT NULL
+                )""")
+
+    def save(self, coordinates: Iterable[Sequence[float]]) -> str:
+        """
+        Stores a set of coordinates.
+
+        :param coordinates: A list of [latitude, longitude] pairs.
+        :type coordinates: Iterable[Sequence[float]]
+        :return: The ID of the set, which is derived from its contents.
+        :rtype: str
+        """
+        polyline = encode_polyline(coordinates)
+
+        set_id = hashlib.sha256(polyline.encode()).hexdigest()[:16]
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO coordinate_sets VALUES (?, ?, ?)",
+                (set_id, polyline, time.time()),
+            )
+
+        return set_id
+
+    def get(self, set_id: str) -> Optional[List[List[float]]]:
+        """
+        Gets a stored set of coordinates.
+
+        :param set_id: The ID of the set.
+        :type set_id: str
+        :return: A list of [latitude, longitude] pairs, or None if the set does not exist.
+        :rtype: Optional[List[List[float]]]
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT polyline FROM coordinate_sets WHERE id = ?", (set_id,)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return decode_polyline(row[0])
+
+
+def to_geojson(coordinates: Iterable[Sequence[float]]) -> dict:
+    """
+    Turns a set of coordinates into a GeoJSON FeatureCollection of points.
+
+    :param coordinates: A list of [latitude, longitude] pairs.
+    :type coordinates: Iterable[Sequence[float]]
+    :return: The GeoJSON FeatureCollection.
+    :rtype: dict
+    """
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [longitude, latitude]},
+                "properties": {},
+            }
+            for latitude, longitude in coordinates
+        ],
+    }
+
+
+_coordinate_sets: Optional[CoordinateSetStore] = None
+_coordinate_sets_lock = threading.Lock()
+
+
+def get_coordinate_sets() -> CoordinateSetStore:
+    """
+    Returns the process-wide coordinate set store, creating it on first use.
+
+    :return: The shared store.
+    :rtype: CoordinateSetStore
+    """
+    global _coordinate_sets
+
+    if _coordinate_sets is None:
+        with _coordinate_sets_lock:
+            if _coordinate_sets is None:
+                _coordinate_sets = CoordinateSetStore()
+
+    return _coordinate_sets
+
+
+def parse_coordinate_string(coordinates: str) -> List[Tuple[float, float]]:
+    """
+    Parses coordinates in the "lat,lon|lat,lon" format used by /map.
+
+    :param coordinates: The coordinate string.
+    :type coordinates: str
+    :return: A list of (latitude, longitude) pairs.
+    :rtype: List[Tuple[float, float]]
+
+    :raises ValueError: The string is not valid.
+    """
+    pairs = []
+
+    for coordinate in coordinates.split("|"):
+        latitude, longitude = coordinate.split(",")
+        pairs.append((float(latitude), float(longitude)))
+
+    return pairs
@@ -0,0 +1,184 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import config
+
+# the SQLite database that records where each reviewed place is
+GEO_INDEX_PATH = getattr(config, "GEO_INDEX_PATH", ".cache/geo_index.sqlite3")
+
+
+class GeoIndex:
+    """
+    A persistent index of wiki pages, their coordinates and their categories.
+
+    Category maps are drawn from this index, so a map can be regenerated
+    without fetching every page in the category.
+    """
+
+    def __init__(self, path: str = GEO_INDEX_PATH):
+        directory = os.path.dirname(path)
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock, self._connection:
+            self._connection.executescript("""CREATE TABLE IF NOT EXISTS places (
+                    title TEXT PRIMARY KEY,
+                    latitude REAL NOT NULL,
+                    longitude REAL NOT NULL,
+                    updated REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS place_categories (
+                    title TEXT NOT NULL,
+                    category TEXT NOT NULL,
+                    PRIMARY KEY (category, title)
+                );
+                CREATE TABLE IF NOT EXISTS published_maps (
+                    category TEXT PRIMARY KEY,
+                    content_hash TEXT NOT NULL
+                );""")
+
+    def record_place(
+        self, title: str, latitude: float, longitude: float, categories: Iterable[str]
+    ) -> None:
+        """
+        Adds a page to the index, or updates its location and categories.
+
+        :param title: The title of the page.
+        :type title: str
+        :param latitude: The latitude of the place.
+        :type latitude: float
+        :param longitude: The longitude of the place.
+        :type longitude: float
+        :param categories: The categories the page belongs to.
+        :type categories: Iterable[str]
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?)",
+                (title, float(latitude), float(longitude), time.time()),
+            )
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO place_categories VALUES (?, ?)",
+                [(title, category) for category in categories if category],
+            )
+
+    def get_place(self, title: str) -> Optional[Tuple[float, float]]:
+        """
+        Gets the coordinates of a page.
+
+        :param title: The title of the page.
+        :type title: str
+        :return: The latitude and longitude of the page, or None if the page is not in the index.
+        :rtype: Optional[Tuple[float, float]]
+        """
+        with self._lock:
+            return self._connection.execute(
+                "SELECT latitude, longitude FROM places WHERE title = ?", (title,)
+            ).fetchone()
+
+    def get_category_coordinates(self, category: str) -> List[Tuple[float, float]]:
+        """
+        Gets the coordinates of every page in a category.
+
+        :param category: The name of the category, without the "Category:" prefix.
+        :type category: str
+        :return: The latitude and longitude of each page, ordered by title.
+        :rtype: List[Tuple[float, float]]
+        """
+        with self._lock:
+            return self._connection.execute(
+                """SELECT places.latitude, places.longitude FROM places
+                JOIN place_categories ON places.title = place_categories.title
+                WHERE place_categories.category = ?
+                ORDER BY places.title""",
+                (category,),
+            ).fetchall()
+
+    def replace_category(
+        self, category: str, places: Dict[str, Tuple[float, float]]
+    ) -> None:
+        """
+        Replaces the pages recorded for a category.
+
+        :param category: The name of the category, without the "Category:" prefix.
+        :type category: str
+        :param places: The coordinates of each page in the category, keyed by title.
+        :type places: Dict[str, Tuple[float, float]]
+        """
+        now = time.time()
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM place_categories WHERE category = ?", (category,)
+            )
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?)",
+                [
+                    (title, float(latitude), float(longitude), now)
+                    for title, (latitude, longitude) in places.items()
+                ],
+            )
+            self._connection.executemany(
+                "INSERT INTO place_categories VALUES (?, ?)",
+                [(title, category) for title in places],
+            )
+
+    def get_published_map_hash(self, category: str) -> Optional[str]:
+        """
+        Gets the hash of the map content last published to a category page.
+
+        :param category: The name of the category, without the "Category:" prefix.
+        :type category: str
+        :return: The hash, or None if no map has been published.
+        :rtype: Optional[str]
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT content_hash FROM published_maps WHERE category = ?",
+                (category,),
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def set_published_map_hash(self, category: str, content_hash: str) -> None:
+        """
+        Records the hash of the map content published to a category page.
+
+        :param category: The name of the category, without the "Category:" prefix.
+        :type category: str
+        :param content_hash: The hash of the published content.
+        :type content_hash: str
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO published_maps VALUES (?, ?)",
+                (category, content_hash),
+            )
+
+
+_geo_index: Optional[GeoIndex] = None
+_geo_index_lock = threading.Lock()
+
+
+def get_geo_index() -> GeoIndex:
+    """
+    Returns the process-wide geo index, creating it on first use.
+
+    :return: The shared index.
+    :rtype: GeoIndex
+    """
+    global _geo_index
+
+    if _geo_index is None:
+        with _geo_index_lock:
+            if _geo_index is None:
+                _geo_index = GeoIndex()
+
+    return _geo_index
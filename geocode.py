@@ -0,0 +1,524 @@
+import argparse
+import csv
+import json
+import math
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+
+import config
+from metrics import CACHE_REQUESTS, stage
+from ratelimit import TokenBucket
+
+# the SQLite database in which reverse geocoding results are cached
+GEOCODE_CACHE_PATH = getattr(config, "GEOCODE_CACHE_PATH", ".cache/geocode.sqlite3")
+
+# the number of decimal places coordinates are rounded to before lookup (4 is about 11 metres)
+GEOCODE_PRECISION = getattr(config, "GEOCODE_PRECISION", 4)
+
+# the maximum number of requests per second made to Nominatim
+GEOCODE_RATE_LIMIT = getattr(config, "GEOCODE_RATE_LIMIT", 1.0)
+
+# the timeout, in seconds, for requests to Nominatim
+GEOCODE_TIMEOUT = getattr(config, "GEOCODE_TIMEOUT", 10)
+
+NOMINATIM_URL = getattr(
+    config, "NOMINATIM_URL", "https://nominatim.openstreetmap.org/reverse"
+)
+
+# the geocoder backend to use: "nominatim" or "offline"
+GEOCODER_BACKEND = getattr(config, "GEOCODER_BACKEND", "nominatim")
+
+# the index file built by `python geocode.py build`, used by the offline backend
+GEOCODE_OFFLINE_PATH = getattr(config, "GEOCODE_OFFLINE_PATH", "geocode.bin")
+
+# the furthest, in kilometres, the offline backend looks for an address
+GEOCODE_OFFLINE_MAX_DISTANCE = getattr(config, "GEOCODE_OFFLINE_MAX_DISTANCE", 25)
+
+# Nominatim's usage policy requires an identifying User-Agent
+GEOCODE_USER_AGENT = getattr(
+    config,
+    "GEOCODE_USER_AGENT",
+    "microformats-to-mediawiki (https://github.com/capjamesg/microformats-to-mediawiki)",
+)
+
+
+class GeocodingError(Exception):
+    """
+    A location could not be reverse geocoded.
+    """
+
+    pass
+
+
+class GeocodeCache:
+    """
+    A SQLite cache of reverse geocoding results.
+    """
+
+    def __init__(self, path: str = GEOCODE_CACHE_PATH):
+        directory = os.path.dirname(path)
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock, self._connection:
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS addresses (
+                    latitude REAL NOT NULL,
+                    longitude REAL NOT NULL,
+                    address TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    PRIMARY KEY (latitude, longitude)
+                )""")
+
+    def get(self, key: Tuple[float, float]) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT address FROM addresses WHERE latitude = ? AND longitude = ?",
+                key,
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return json.loads(row[0])
+
+    def set(self, key: Tuple[float, float], address: Dict[str, Any]) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO addresses VALUES (?, ?, ?, ?)",
+                (key[0], key[1], json.dumps(address), time.time()),
+            )
+
+
+class NominatimBackend:
+    """
+    Looks up addresses with the Nominatim reverse geocoding API.
+    """
+
+    remote = True
+
+    def __init__(self, rate_limiter: Optional[TokenBucket] = None):
+        self.rate_limiter = rate_limiter or TokenBucket(GEOCODE_RATE_LIMIT)
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = GEOCODE_USER_AGENT
+
+    def reverse(self, latitude: float, longitude: float) -> Dict[str, Any]:
+        self.rate_limiter.acquire()
+
+        try:
+            response = self.session.get(
+                NOMINATIM_URL,
+                params={"lat": str(latitude), "lon": str(longitude), "format": "json"},
+                timeout=GEOCODE_TIMEOUT,
+            )
+            response.raise_for_status()
+            result = response.json()
+        except (requests.exceptions.RequestException, ValueError) as exception:
+            raise GeocodingError(str(exception))
+
+        # Nominatim returns an error object for places with no address, such as the sea
+        return result.get("address", {})
+
+
+# the layout of an offline index file: a header, a table of grid cells sorted
+# by cell, the places sorted by cell, then the address strings of the places
+OFFLINE_MAGIC = b"MF2GEO01"
+OFFLINE_HEADER = struct.Struct("<8sdIIQ")
+OFFLINE_CELL = struct.Struct("<iiII")
+OFFLINE_PLACE = struct.Struct("<ddII")
+OFFLINE_FIELDS = ("road", "postcode", "city", "country")
+
+# the approximate length, in kilometres, of one degree of latitude
+KILOMETRES_PER_DEGREE = 111.32
+
+
+class OfflineBackend:
+    """
+    Looks up addresses in a local index file built by `python geocode.py build`.
+
+    Places in the file are grouped into a grid of cells. The file is memory
+    mapped when the first address is looked up, so worker processes share one
+    copy of it in the operating system's page cache. Only the table of cells
+    is read into memory.
+    """
+
+    remote = False
+
+    def __init__(
+        self,
+        path: str = GEOCODE_OFFLINE_PATH,
+        max_distance: float = GEOCODE_OFFLINE_MAX_DISTANCE,
+    ):
+        self.path = path
+        self.max_distance = max_distance
+        self._data: Optional[mmap.mmap] = None
+        self._cells: Dict[Tuple[int, int], Tuple[int, int]] = {}
+        self._cell_size = 0.0
+        self._places_offset = 0
+        self._strings_offset = 0
+        self._lock = threading.Lock()
+
+    def _load(self) -> mmap.mmap:
+        with self._lock:
+            if self._data is not None:
+                return self._data
+
+            try:
+                with open(self.path, "rb") as f:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError) as exception:
+                raise GeocodingError(f"could not open {self.path}: {exception}")
+
+            magic, cell_size, cell_count, _, strings_offset = (
+                OFFLINE_HEADER.unpack_from(data, 0)
+            )
+
+            if magic != OFFLINE_MAGIC:
+                raise GeocodingError(f"{self.path} is not an offline geocoder index")
+
+            for cell in OFFLINE_CELL.iter_unpack(
+                data[
+                    OFFLINE_HEADER.size : OFFLINE_HEADER.size
+                    + cell_count * OFFLINE_CELL.size
+                ]
+            ):
+                self._cells[(cell[0], cell[1])] = (cell[2], cell[3])
+
+            self._cell_size = cell_size
+            self._places_offset = OFFLINE_HEADER.size + cell_count * OFFLINE_CELL.size
+            self._strings_offset = strings_offset
+            self._data = data
+
+            return data
+
+    def _nearest_in_cell(
+        self,
+        data: mmap.mmap,
+        cell: Tuple[int, int],
+        latitude: float,
+        longitude: float,
+        scale: float,
+    ) -> Tuple[float, int]:
+        best_distance, best_place = math.inf, -1
+
+        start, count = self._cells.get(cell, (0, 0))
+
+        for index in range(start, start + count):
+            place_latitude, place_longitude, _, _ = OFFLINE_PLACE.unpack_from(
+                data, self._places_offset + index * OFFLINE_PLACE.size
+            )
+
+            distance = math.hypot(
+                place_latitude - latitude, (place_longitude - longitude) * scale
+            )
+
+            if distance < best_distance:
+                best_distance, best_place = distance, index
+
+        return best_distance, best_place
+
+    def reverse(self, latitude: float, longitude: float) -> Dict[str, Any]:
+        data = self._load()
+
+        # degrees of longitude are shorter than degrees of latitude away from the equator
+        scale = max(math.cos(math.radians(latitude)), 0.01)
+        max_distance = self.max_distance / KILOMETRES_PER_DEGREE
+        max_ring = math.ceil(max_distance / (self._cell_size * scale))
+
+        row = math.floor(latitude / self._cell_size)
+        column = math.floor(longitude / self._cell_size)
+
+        best_distance, best_place = math.inf, -1
+
+        for ring in range(max_ring + 1):
+            for cell in _ring_cells(row, column, ring):
+                distance, place = self._nearest_in_cell(
+                    data, cell, latitude, longitude, scale
+                )
+
+                if distance < best_distance:
+                    best_distance, best_place = distance, place
+
+            # no place in a further ring can be closer than the one already found
+            if best_distance <= ring * self._cell_size * scale:
+                break
+
+        if best_place == -1 or best_distance > max_distance:
+            return {}
+
+        _, _, string_offset, string_length = OFFLINE_PLACE.unpack_from(
+            data, self._places_offset + best_place * OFFLINE_PLACE.size
+        )
+
+        start = self._strings_offset + string_offset
+        values = data[start : start + string_length].decode("utf-8").split("\t")
+
+        return {key: value for key, value in zip(OFFLINE_FIELDS, values) if value}
+
+
+def _ring_cells(row: int, column: int, ring: int) -> List[Tuple[int, int]]:
+    if ring == 0:
+        return [(row, column)]
+
+    cells = []
+
+    for offset in range(-ring, ring + 1):
+        cells.append((row - ring, column + offset))
+        cells.append((row + ring, column + offset))
+
+    for offset in range(-ring + 1, ring):
+        cells.append((row + offset, column - ring))
+        cells.append((row + offset, column + ring))
+
+    return cells
+
+
+def build_offline_index(
+    source_path: str, output_path: str, cell_size: float = 0.1
+) -> int:
+    """
+    Builds an index file for the offline geocoder backend.
+
+    The source file is a tab-separated file with a header row that contains
+    latitude, longitude, road, postcode, city and country columns, such as an
+    extract from GeoNames or OpenStreetMap.
+
+    :param source_path: The path of the tab-separated source file.
+    :type source_path: str
+    :param output_path: The path of the index file to write.
+    :type output_path: str
+    :param cell_size: The size, in degrees, of each grid cell.
+    :type cell_size: float
+    :return: The number of places in the index.
+    :rtype: int
+    """
+    places = []
+
+    with open(source_path, "r", newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            latitude = float(row["latitude"])
+            longitude = float(row["longitude"])
+
+            cell = (
+                math.floor(latitude / cell_size),
+                math.floor(longitude / cell_size),
+            )
+
+            address = "\t".join(
+                (row.get(key) or "").replace("\t", " ") for key in OFFLINE_FIELDS
+            )
+
+            places.append((cell, latitude, longitude, address.encode("utf-8")))
+
+    places.sort(key=lambda place: place[0])
+
+    cells: List[Tuple[Tuple[int, int], int, int]] = []
+
+    for index, place in enumerate(places):
+        if cells and cells[-1][0] == place[0]:
+            cells[-1] = (place[0], cells[-1][1], cells[-1][2] + 1)
+        else:
+            cells.append((place[0], index, 1))
+
+    strings_offset = (
+        OFFLINE_HEADER.size
+        + len(cells) * OFFLINE_CELL.size
+        + len(places) * OFFLINE_PLACE.size
+    )
+
+    with open(output_path, "wb") as f:
+        f.write(
+            OFFLINE_HEADER.pack(
+                OFFLINE_MAGIC, cell_size, len(cells), len(places), strings_offset
+            )
+        )
+
+        for cell, start, count in cells:
+            f.write(OFFLINE_CELL.pack(cell[0], cell[1], start, count))
+
+        string_offset = 0
+
+        for _, latitude, longitude, encoded_address in places:
+            f.write(
+                OFFLINE_PLACE.pack(
+                    latitude, longitude, string_offset, len(encoded_address)
+                )
+            )
+            string_offset += len(encoded_address)
+
+        for place in places:
+            f.write(place[3])
+
+    return len(places)
+
+
+class _PendingLookup:
+    def __init__(self):
+        self.done = threading.Event()
+        self.address: Optional[Dict[str, Any]] = None
+        self.error: Optional[Exception] = None
+
+
+class ReverseGeocoder:
+    """
+    Turns coordinates into an address.
+
+    Addresses from a remote backend are cached by coordinates rounded to
+    GEOCODE_PRECISION decimal places, so repeat lookups of a known place are
+    answered locally, and concurrent lookups of the same place share one
+    request. Local backends are queried directly.
+
+    Addresses have the same shape as Nominatim's "address" object.
+    """
+
+    def __init__(
+        self,
+        backend: Any = None,
+        cache: Optional[GeocodeCache] = None,
+        precision: int = GEOCODE_PRECISION,
+    ):
+        self.backend = backend or NominatimBackend()
+        self.cache = cache
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pending: Dict[Tuple[float, float], _PendingLookup] = {}
+
+        if self.cache is None and self.backend.remote:
+            self.cache = GeocodeCache()
+
+    def reverse(self, latitude: float, longitude: float) -> Dict[str, Any]:
+        """
+        Gets the address of a place.
+
+        :param latitude: The latitude of the place.
+        :type latitude: float
+        :param longitude: The longitude of the place.
+        :type longitude: float
+        :return: The address of the place, or an empty dictionary if the place has no address.
+        :rtype: Dict[str, Any]
+
+        :raises GeocodingError: The address could not be retrieved.
+        """
+        if self.cache is None:
+            with stage("geocode"):
+                return self.backend.reverse(float(latitude), float(longitude))
+
+        key = (
+            round(float(latitude), self.precision),
+            round(float(longitude), self.precision),
+        )
+
+        address = self.cache.get(key)
+
+        if address is not None:
+            with self._lock:
+                self.hits += 1
+
+            CACHE_REQUESTS.inc(cache="geocode", result="hit")
+
+            return address
+
+        CACHE_REQUESTS.inc(cache="geocode", result="miss")
+
+        with self._lock:
+            self.misses += 1
+
+            pending = self._pending.get(key)
+            is_leader = pending is None
+
+            if pending is None:
+                pending = self._pending[key] = _PendingLookup()
+
+        if not is_leader:
+            pending.done.wait()
+
+            if pending.error is not None:
+                raise pending.error
+
+            return pending.address or {}
+
+        try:
+            with stage("geocode"):
+                pending.address = self.backend.reverse(*key)
+            self.cache.set(key, pending.address)
+
+            return pending.address
+        except Exception as exception:
+            pending.error = exception
+
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+
+            pending.done.set()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the geocoder's cache counters.
+
+        :return: The number of cache hits and misses and the hit rate.
+        :rtype: Dict[str, Any]
+        """
+        with self._lock:
+            total = self.hits + self.misses
+
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+_geocoder: Optional[ReverseGeocoder] = None
+_geocoder_lock = threading.Lock()
+
+
+def get_geocoder() -> ReverseGeocoder:
+    """
+    Returns the process-wide reverse geocoder, creating it on first use.
+
+    :return: The shared geocoder.
+    :rtype: ReverseGeocoder
+    """
+    global _geocoder
+
+    if _geocoder is None:
+        with _geocoder_lock:
+            if _geocoder is None:
+                if GEOCODER_BACKEND == "offline":
+                    _geocoder = ReverseGeocoder(OfflineBackend())
+                else:
+                    _geocoder = ReverseGeocoder(NominatimBackend())
+
+    return _geocoder
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the offline geocoder index.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser(
+        "build", help="Build an offline index from a tab-separated file of places."
+    )
+    build_parser.add_argument("source", help="The tab-separated file of places.")
+    build_parser.add_argument("output", nargs="?", default=GEOCODE_OFFLINE_PATH)
+    build_parser.add_argument("--cell-size", type=float, default=0.1)
+
+    arguments = parser.parse_args()
+
+    count = build_offline_index(arguments.source, arguments.output, arguments.cell_size)
+
+    print(f"Wrote {count} places to {arguments.output}")
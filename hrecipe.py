@@ -1,9 +1,9 @@
 import datetime
 
-from jinja2 import Template
+from templating import get_template_environment
 
 
-def parse_h_recipe(h_recipe: dict, domain: str) -> str:
+def parse_h_recipe(h_recipe: dict, domain: str) -> dict:
     """
     Parse a h-recipe microformat into a MediaWiki page.
 
@@ -12,8 +12,7 @@ def parse_h_recipe(h_recipe: dict, domain: str) -> str:
     :returns: A dictionary containing the name of the recipe and the MediaWiki page content
     :rtype: dict
     """
-    with open("wiki_templates/recipe.html", "r") as f:
-        template = Template(f.read())
+    template = get_template_environment().get_template("recipe.html")
 
     # get the recipe name
     name = h_recipe["properties"]["name"][0] if "name" in h_recipe["properties"] else ""
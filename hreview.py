@@ -1,15 +1,27 @@
+import logging
 import re
-from typing import Dict, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
 
-import mf2py
-import requests
 from bs4 import BeautifulSoup
-from jinja2 import Template
 
-import mediawiki
-from config import API_URL
+import config
+from coordinate_sets import get_coordinate_sets
+from geocode import GeocodingError, get_geocoder
+from microformats import ExtractedMicroformats, extract_microformats
+from source_cache import get_source_cache
+from templating import get_template_environment, render_wiki_template
+from wikitext import Block, Section, WikiPage
 
-addyourself = "{{" + "addyourself" + "}}"
+logger = logging.getLogger(__name__)
+
+AGGREGATE_ATTRIBUTE_PATTERN = re.compile(r"(data-rating-(?:sum|count))='([^']*)'")
+AGGREGATE_VOTES_PATTERN = re.compile(r"<data value='([^']*)' class='p-votes'>")
+AGGREGATE_AVERAGE_PATTERN = re.compile(r"<data value='([^']*)' class='p-average'>")
+RATING_PATTERN = re.compile(r"<data value='([^']*)' class='p-rating'>")
+
+# the number of pages fetched at once when building a map
+MAP_FETCH_WORKERS = getattr(config, "MAP_FETCH_WORKERS", 8)
 
 
 def create_infobox(latitude: int, longitude: int, page_text: str) -> Tuple[str, dict]:
@@ -24,146 +36,239 @@ def create_infobox(latitude: int, longitude: int, page_text: str) -> Tuple[str,
     :return: A tuple with the text of the page with the infobox added and the address of the place
     :rtype: Tuple[str, str]
     """
-    # if section does not exist, create it
+    # create hgeo object
+    h_geo = render_wiki_template("h_geo.html", latitude=latitude, longitude=longitude)
+
+    # repeat lookups of a known place are answered from the geocode cache
     try:
-        nominatim_information = requests.get(
-            f"https://nominatim.openstreetmap.org/reverse?lat={latitude}&lon={longitude}&format=json"
-        )
-    except requests.exceptions.RequestException:
-        pass
+        address = get_geocoder().reverse(latitude, longitude)
+    except GeocodingError:
+        address = {}
 
-    address = nominatim_information.json()["address"]
+    if not address.get("country"):
+        return page_text + h_geo, {}
+
+    infobox = render_wiki_template(
+        "infobox.html",
+        road=address.get("road", ""),
+        postcode=address.get("postcode", ""),
+        city=address.get("city", ""),
+        country=address["country"],
+        latitude=latitude,
+        longitude=longitude,
+    )
 
-    address_string = f"{address['road']}, {address['postcode']} {address.get('city', '')}, {address['country']}"
+    page_text += infobox + h_geo
 
-    infobox = f"""
-    Infobox
-    |location={address.get('city')}, {address['country']}
-    |lat={latitude}
-    |long={longitude}
-    |address={address_string}
+    return page_text, address
+
+
+def _format_number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else str(round(value, 2))
+
+
+def render_aggregate(name: str, rating_sum: float, votes: int) -> str:
     """
+    Renders the h-review-aggregate block of a review page.
+
+    The block records the sum and number of ratings so the next review can
+    update it without counting every review on the page again.
+
+    :param name: The name of the place being reviewed
+    :type name: str
+    :param rating_sum: The sum of all ratings of the place
+    :type rating_sum: float
+    :param votes: The number of ratings
+    :type votes: int
+    :return: The h-review-aggregate block
+    :rtype: str
+    """
+    average = round(rating_sum / votes, 1)
+
+    return render_wiki_template(
+        "review_aggregate.html",
+        name=name,
+        rating_sum=_format_number(rating_sum),
+        average=average,
+        stars=int(round(average)),
+        votes=votes,
+    )
 
-    # mediawiki.update_map_on_category_page(address.get("city"))
-    mediawiki.update_map_on_category_page(address["country"])
 
-    # create hgeo object
-    h_geo = f"""
-    <div class="h-geo" style="display: none;">
-    <data class="p-latitude" value="{latitude}"></data>
-    <data class="p-longitude" value="{longitude}"></data>
-    </div>
+def read_aggregate_totals(aggregate: str) -> Optional[Tuple[float, int]]:
     """
+    Reads the running totals from an h-review-aggregate block.
 
-    page_text += "{{" + infobox + "}}" + h_geo
+    :param aggregate: The text of the h-review-aggregate block
+    :type aggregate: str
+    :return: The sum and number of ratings, or None if the totals are missing or
+        do not agree with the average and votes shown in the block
+    :rtype: Optional[Tuple[float, int]]
+    """
+    attributes = dict(AGGREGATE_ATTRIBUTE_PATTERN.findall(aggregate.split(">", 1)[0]))
+    votes = AGGREGATE_VOTES_PATTERN.search(aggregate)
+    average = AGGREGATE_AVERAGE_PATTERN.search(aggregate)
 
-    return page_text, address
+    try:
+        rating_sum = float(attributes["data-rating-sum"])
+        rating_count = int(attributes["data-rating-count"])
+    except (KeyError, ValueError):
+        return None
+
+    if rating_count < 1 or not votes or int(votes.group(1)) != rating_count:
+        return None
+
+    if not average or abs(float(average.group(1)) - rating_sum / rating_count) > 0.051:
+        return None
+
+    return rating_sum, rating_count
 
 
 def update_existing_review_section(
-    review_section_start: int,
+    reviews: Section,
     content_url: str,
     h_review: dict,
     domain: str,
-    page_text: str,
-) -> str:
+    content: str,
+) -> None:
     """
     Adds a new review to an existing review section.
 
-    :param review_section_start: The index of the start of the review section
-    :type review_section_start: int
+    The aggregate rating is updated from the running totals stored in the
+    h-review-aggregate block. Every rating in the section is only counted
+    again if those totals are missing or inconsistent.
+
+    :param reviews: The reviews section, which is changed in place
+    :type reviews: Section
     :param content_url: The URL of the new review
     :type content_url: str
     :param h_review: The h-review object that contains the new review
     :type h_review: dict
     :param domain: The domain of the person who wrote the review
     :type domain: str
-    :param page_text: The text of the wiki page to create
-    :type page_text: str
-    :return: The text of the page with the new review added and an updateed aggregate review
-    :rtype: str
+    :param content: The text of the new review
+    :type content: str
     """
-    page_text_after_reviews = page_text[review_section_start:]
+    review = Block(
+        "review",
+        render_wiki_template(
+            "review.html",
+            url=content_url,
+            name=h_review["name"][0],
+            domain=domain,
+            rating=h_review["rating"][0],
+            content=content,
+        ),
+    )
 
-    page_text += f"""
-        <div class='h-review'>
-            \n=== <a href='{content_url}' class='p-name'>{h_review['name'][0]}</a>
-            by {domain} -
-             <data value='{h_review['rating'][0]}' class='p-rating'>{h_review['rating'][0]} stars</data>
-            ===\n
-        <blockquote>{h_review['content'][0]['html']}</blockquote></div>"""
+    aggregate = reviews.find("aggregate")
 
-    page_text = page_text[:review_section_start] + page_text_after_reviews
+    if aggregate is None:
+        reviews.append(Block("text", "\n"), review, Block("text", "\n"))
+        return
 
-    aggregate_ratings = mf2py.parse(doc=page_text)
+    totals = read_aggregate_totals(aggregate.text)
 
-    ratings = [
-        int(r["properties"]["rating"][0])
-        for r in aggregate_ratings["items"][0]["children"]
-        if r["type"][0] == "h-review"
-    ]
+    if totals is None:
+        ratings = [
+            float(rating)
+            for block in reviews.find_all("review")
+            for rating in RATING_PATTERN.findall(block.text)
+        ]
+        totals = (sum(ratings), len(ratings))
 
-    stars = str(round(sum(ratings) / len(ratings), 1))
+    rating_sum = totals[0] + float(h_review["rating"][0])
+    votes = totals[1] + 1
 
-    # get h-review-aggregate
-    page_text_aggregate = re.search(
-        r"<div class='h-review-aggregate'>.*?</div>", page_text, re.DOTALL
-    )
+    # the new review goes above the aggregate
+    reviews.insert_before(aggregate, review, Block("text", "\n\n"))
 
-    if page_text_aggregate:
-        page_text_aggregate = page_text_aggregate.group(0)
+    aggregate.text = render_aggregate(h_review["name"][0], rating_sum, votes)
 
-        star_no_decimal_places = round(int(stars), 0)
 
-        star_emojis = "⭐" * star_no_decimal_places
+def add_review_to_text(
+    text: str, content_url: str, h_review: dict, domain: str, content: str
+) -> str:
+    """
+    Adds a new review to the wikitext of a page or of its reviews section.
 
-        # replace h-review-aggregate
-        page_text = page_text.replace(
-            page_text_aggregate,
-            f"""\n\n<div class='h-review-aggregate'>
-                <span class='p-item'>{h_review['name'][0]}</span>
-                aggregate review: {star_emojis} -
-                <data value='{stars}' class='p-average'>{stars}</data>
-                /<data value='5' class='p-best'>5</data>
-                (<data value='{len(ratings)}' class='p-votes'>{len(ratings)}</data>
-                ratings)</div>\n\n{addyourself}\n""",
-        )
+    :param text: The wikitext
+    :type text: str
+    :param content_url: The URL of the new review
+    :type content_url: str
+    :param h_review: The h-review object that contains the new review
+    :type h_review: dict
+    :param domain: The domain of the person who wrote the review
+    :type domain: str
+    :param content: The text of the new review
+    :type content: str
+    :return: The wikitext with the review added
+    :rtype: str
+    """
+    page = WikiPage.parse(text)
 
-    return page_text
+    reviews = page.section("Reviews") or page.add_section("Reviews")
 
+    update_existing_review_section(reviews, content_url, h_review, domain, content)
 
-def get_all_h_geos(urls: list) -> list:
+    return page.serialize()
+
+
+def get_h_geos(url: str) -> list:
     """
-    Gets all h-geo objects from a list of URLs.
+    Gets all h-geo objects on a page.
 
-    :param urls: A list of URLs from which to get h-geo objects
-    :type urls: list
+    :param url: The URL of the page
+    :type url: str
     :return: A list of h-geo objects
     :rtype: list
+
+    :raises requests.exceptions.RequestException: The request to get the page failed.
     """
+    # wiki pages only carry a h-geo, so they are not screened for posts
+    parsed = get_source_cache().fetch(url, screen=False)
+
     h_geos = []
+    seen = set()
 
-    for u in urls:
-        try:
-            r = requests.get(u)
-        except requests.exceptions.RequestException:
-            return []
+    for h_geo in extract_microformats(parsed).geos:
+        properties = h_geo.get("properties", {})
+
+        if not properties.get("latitude") or not properties.get("longitude"):
+            continue
+
+        coordinates = (properties["latitude"][0], properties["longitude"][0])
+
+        # a place's infobox and its reviews can mark up the same location
+        if coordinates not in seen:
+            seen.add(coordinates)
+            h_geos.append(h_geo)
+
+    return h_geos
 
-        parser = mf2py.Parser(doc=r.text, url=u)
 
-        mf2_parser = parser.to_dict(filter_by_type="h-review")
+def get_all_h_geos(urls: list) -> list:
+    """
+    Gets all h-geo objects from a list of URLs.
 
-        for item in mf2_parser:
-            properties = item["children"]
+    Pages are fetched concurrently. A page that cannot be retrieved is
+    skipped without affecting the results from the other pages.
 
-            for p in properties:
-                if p["type"][0] == "h-geo":
-                    h_geos.append(p)
+    :param urls: A list of URLs from which to get h-geo objects
+    :type urls: list
+    :return: A list of h-geo objects
+    :rtype: list
+    """
+    h_geos = []
 
-        mf2_parser = parser.to_dict(filter_by_type="h-geo")
+    with ThreadPoolExecutor(max_workers=MAP_FETCH_WORKERS) as executor:
+        futures = {url: executor.submit(get_h_geos, url) for url in urls}
 
-        for item in mf2_parser:
-            h_geos.append(item)
+    for url, future in futures.items():
+        try:
+            h_geos.extend(future.result())
+        except Exception:
+            logger.warning("Could not retrieve h-geos from %s", url, exc_info=True)
 
     return h_geos
 
@@ -180,23 +285,19 @@ def create_map(urls: list) -> tuple:
 
     h_geos = get_all_h_geos(urls)
 
-    with open("templates/mapindex.html", "r") as f:
-        template = Template(f.read())
+    template = get_template_environment().get_template("mapindex.html")
 
     coordinates = []
 
-    coordinate_string = ""
-
     for geo in h_geos:
-        latitude = geo["properties"]["latitude"][0]
-        longitude = geo["properties"]["longitude"][0]
+        latitude = float(geo["properties"]["latitude"][0])
+        longitude = float(geo["properties"]["longitude"][0])
 
         coordinates.append([latitude, longitude])
-        coordinate_string += f"{latitude},{longitude}|"
 
     template_vars = {"coordinates": coordinates}
 
-    url = "/map?coordinates=" + coordinate_string.rstrip("|")
+    url = "/map/" + get_coordinate_sets().save(coordinates)
 
     return template.render(template_vars), url
 
@@ -225,76 +326,55 @@ def create_new_review_section(
     :return: The text of the page with a new reviews section and categories set
         for the city and country of the place being reviewed
     """
-    # h_review = h_review["properties"]
-    star_no_decimal_places = round(int(h_review["rating"][0]))
-
-    star_emojis = "⭐" * star_no_decimal_places
-
-    page_text += "\n\n<div class='h-feed'>\n== Reviews ==\n\n"
-
-    page_text += f"""<div class='h-review'>\n===<a href='{content_url}' class='p-name'>{h_review['name'][0]}</a> by {domain} - <data value='{h_review['rating'][0]}' class='p-rating'>{h_review['rating'][0]} stars</data> ===\n
-        <blockquote>{content}</blockquote>"""
-
-    page_text += f"""\n
-        <div class='h-review-aggregate'>
-            <p><span class='p-item'>{h_review['name'][0]}</span> aggregate review: {star_emojis} - <data value='{h_review['rating'][0]}' class='p-average'>{h_review['rating'][0]}</data>/<data value='5' class='p-best'>5</data>
-            (<data value='1' class='p-votes'>1</data> rating)\n</p>
-            <p>{addyourself}</p>
-        </div>"""
-
-    categories = []
+    review = render_wiki_template(
+        "review.html",
+        url=content_url,
+        name=h_review["name"][0],
+        domain=domain,
+        rating=h_review["rating"][0],
+        content=content,
+    )
 
-    if address != {}:
-        page_text += f"[[Category:{address.get('city')}]]"
-        page_text += f"[[Category:{address['country']}]]"
-        # categories = ([address["city"], address["country"]],)
+    aggregate = render_aggregate(h_review["name"][0], float(h_review["rating"][0]), 1)
 
-    # for c in categories:
-    #     update_map_on_category_page(c)
+    page_text += render_wiki_template(
+        "reviews_section.html",
+        review=review,
+        aggregate=aggregate,
+        city=address.get("city"),
+        country=address.get("country"),
+    )
 
     return page_text
 
 
 def parse_h_review(
-    h_review: dict, content_parsed: dict, content_url: str, domain: str, titles: list
-) -> Dict[str, str]:
+    h_review: dict,
+    extracted: ExtractedMicroformats,
+    content_url: str,
+    domain: str,
+) -> Dict[str, Any]:
     """
     Parses a h-review object and returns the contents for the new or revised wiki page.
 
+    The returned "content" is the text of a new page for the place. The
+    "sections" are the parts used to update the Infobox, Reviews and Photos
+    sections of a page that already exists.
+
     :param h_review: The h-review object to parse
     :type h_review: dict
-    :param content_parsed: The parsed microformats of the page, used to look for a h-geo object
-    :type content_parsed: dict
+    :param extracted: The microformats on the page, used to look for a h-geo object
+    :type extracted: ExtractedMicroformats
     :param content_url: The URL of the page that contains the review
     :type content_url: str
     :param domain: The domain of the person who wrote the review
     :type domain: str
-    :return: The information needed to create the new wiki page.
-    :rtype: Dict[str, str]
+    :return: The information needed to create or update the wiki page.
+    :rtype: Dict[str, Any]
     """
-    h_review = h_review["properties"]
-
-    page_content = {
-        "action": "query",
-        "prop": "revisions",
-        "titles": titles,
-        "rvslots": "*",
-        "rvprop": "content",
-        "formatversion": "2",
-        "format": "json",
-    }
-
-    try:
-        page_content_request = requests.post(API_URL, params=page_content)
-
-        page_text = page_content_request.json()["query"]["pages"][0]["revisions"][0][
-            "slots"
-        ]["main"]["content"]
-    except Exception:
-        page_text = ""
+    h_geo = extracted.geo_for(h_review)
 
-    # get == Reviews == section
-    review_section_start = page_text.find("== Reviews ==")
+    h_review = h_review["properties"]
 
     content = ""
 
@@ -307,47 +387,55 @@ def parse_h_review(
     elif h_review.get("description"):
         content = h_review["description"][0]
 
-    h_geo = [
-        e
-        for e in content_parsed["items"][0].get("children", "")
-        if e.get("type") and e["type"][0] == "h-geo"
-    ]
-
     if h_geo:
-        latitude = h_geo[0]["properties"]["latitude"][0]
-        longitude = h_geo[0]["properties"]["longitude"][0]
+        latitude = h_geo["properties"]["latitude"][0]
+        longitude = h_geo["properties"]["longitude"][0]
 
-        page_text, address = create_infobox(latitude, longitude, page_text)
+        infobox, address = create_infobox(latitude, longitude, "")
     else:
         latitude = None
         longitude = None
+        infobox = ""
         address = {}
 
-    if review_section_start == -1:
-        page_text = create_new_review_section(
-            address, content_url, h_review, domain, page_text, content
-        )
-    else:
-        page_text = update_existing_review_section(
-            review_section_start, content_url, h_review, domain, page_text, content
-        )
+    reviews_section = create_new_review_section(
+        address, content_url, h_review, domain, "", content
+    )
 
-    photo_section_start = page_text.find("== Photos ==")
+    photo = ""
 
     if h_review.get("photo"):
-        if photo_section_start == -1:
-            page_text += "\n\n== Photos ==\n\n"
-
         photo_url = h_review["photo"][0]
         photo_url = photo_url.replace(" ", "%20")
-        page_text += (
-            f'\n<span class="plainlinks">[{{fullurl:MediaWiki}} {photo_url}]\n</span>'
-        )
+        photo = render_wiki_template("review_photo.html", photo_url=photo_url)
+
+    page = WikiPage.parse(infobox + reviews_section)
+
+    if photo:
+        page.add_section("Photos", Block("photo", photo))
+
+    page_text = page.serialize()
 
     content_details = {
         "name": h_review["name"][0],
         "content": {"html": page_text},
         "url": content_url,
+        "sections": {
+            "infobox": infobox,
+            "reviews": reviews_section,
+            "photo": photo,
+            # used to add the review to an existing reviews section
+            "review": {"h_review": h_review, "domain": domain, "content": content},
+        },
     }
 
+    # used to add the place to the category maps once the page is published
+    if latitude is not None and address:
+        content_details["place"] = {
+            "latitude": latitude,
+            "longitude": longitude,
+            "city": address.get("city"),
+            "country": address["country"],
+        }
+
     return content_details
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import config
+
+# the SQLite database that records what was last published from each post
+IDEMPOTENCY_STORE_PATH = getattr(
+    config, "IDEMPOTENCY_STORE_PATH", ".cache/idempotency.sqlite3"
+)
+
+
+def hash_item(post_type: str, item: dict, geo: Optional[dict] = None) -> str:
+    """
+    Hashes an item found on a page, and the h-geo that describes its location.
+
+    :param post_type: The post type of the item ("recipe", "review" or "entry").
+    :type post_type: str
+    :param item: The item.
+    :type item: dict
+    :param geo: The h-geo used for the item, if any.
+    :type geo: Optional[dict]
+    :return: A hex digest that changes whenever the item or its location changes.
+    :rtype: str
+    """
+    document = json.dumps(
+        {"post_type": post_type, "item": item, "geo": geo},
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+
+    return hashlib.sha256(document.encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    A persistent record of the content last published from each post to each
+    wiki page, used to skip edits when a post is sent again unchanged.
+    """
+
+    def __init__(self, path: str = IDEMPOTENCY_STORE_PATH):
+        directory = os.path.dirname(path)
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock, self._connection:
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS published_items (
+                    source_url TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    revid INTEGER,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (source_url, title)
+                )""")
+
+    def get(self, source_url: str, title: str) -> Optional[Dict[str, Any]]:
+        """
+        Gets what was last published from a post to a page.
+
+        :param source_url: The URL of the post.
+        :type source_url: str
+        :param title: The title of the page.
+        :type title: str
+        :return: The "content_hash" and "revid" of the last edit, or None if the
+            post has not been published to the page.
+        :rtype: Optional[Dict[str, Any]]
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT content_hash, revid FROM published_items WHERE source_url = ? AND title = ?",
+                (source_url, title),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return {"content_hash": row[0], "revid": row[1]}
+
+    def record(
+        self, source_url: str, title: str, content_hash: str, revid: Optional[int]
+    ) -> None:
+        """
+        Records that a post has been published to a page.
+
+        :param source_url: The URL of the post.
+        :type source_url: str
+        :param title: The title of the page.
+        :type title: str
+        :param content_hash: The hash of the item that was published.
+        :type content_hash: str
+        :param revid: The ID of the revision created by the edit, if known.
+        :type revid: Optional[int]
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO published_items VALUES (?, ?, ?, ?, ?)",
+                (source_url, title, content_hash, revid, time.time()),
+            )
+
+
+_idempotency_store: Optional[IdempotencyStore] = None
+_idempotency_store_lock = threading.Lock()
+
+
+def get_idempotency_store() -> IdempotencyStore:
+    """
+    Returns the process-wide idempotency store, creating it on first use.
+
+    :return: The shared store.
+    :rtype: IdempotencyStore
+    """
+    global _idempotency_store
+
+    if _idempotency_store is None:
+        with _idempotency_store_lock:
+            if _idempotency_store is None:
+                _idempotency_store = IdempotencyStore()
+
+    return _idempotency_store
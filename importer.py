@@ -0,0 +1,303 @@
+import argparse
+import json
+import logging
+import os
+import time
+import xml.etree.ElementTree as ElementTree
+from collections import Counter
+from typing import Any, Dict, List, Optional, Set
+from urllib.parse import urldefrag
+
+import mf2py
+
+import config
+from batch import BATCH_WORKERS, authorize_items, publish_batch
+from mediawiki import BACKGROUND, get_wiki_session
+from microformats import extract_microformats
+from source_cache import (
+    SOURCE_CONTENT_TYPES,
+    SOURCE_FETCH_TIMEOUT,
+    check_content_type,
+    decode_body,
+    get_source_cache,
+    read_body,
+)
+
+logger = logging.getLogger(__name__)
+
+# the file in which the result of each imported post is recorded
+IMPORT_JOURNAL_PATH = getattr(config, "IMPORT_JOURNAL_PATH", ".cache/import.jsonl")
+
+# the number of posts published between each write to the journal
+IMPORT_CHUNK_SIZE = getattr(config, "IMPORT_CHUNK_SIZE", 50)
+
+# posts with these statuses are not imported again when an import is resumed
+FINISHED_STATUSES = {"created", "updated", "skipped"}
+
+# the most sitemaps that are followed from one sitemap index
+MAX_SITEMAPS = 1000
+
+# the largest feed or sitemap, in bytes, that is downloaded
+MAX_FEED_BYTES = getattr(config, "MAX_FEED_BYTES", 50 * 1024 * 1024)
+
+# the content types of feeds and sitemaps; pages marked up with h-feed are served as HTML
+FEED_CONTENT_TYPES = getattr(
+    config,
+    "FEED_CONTENT_TYPES",
+    (
+        "application/rss+xml",
+        "application/atom+xml",
+        "application/rdf+xml",
+        "application/xml",
+        "text/xml",
+    ),
+)
+
+
+def _local_name(tag: str) -> str:
+    # "{http://www.w3.org/2005/Atom}entry" -> "entry"
+    return tag.rsplit("}", 1)[-1]
+
+
+def _children(element: ElementTree.Element, name: str) -> List[ElementTree.Element]:
+    return [child for child in element if _local_name(child.tag) == name]
+
+
+def _discover_from_xml(root: ElementTree.Element, fetched: Set[str]) -> List[str]:
+    root_name = _local_name(root.tag)
+
+    if root_name in ("rss", "RDF"):
+        links = [
+            (link.text or "").strip()
+            for item in root.iter()
+            if _local_name(item.tag) == "item"
+            for link in _children(item, "link")
+        ]
+
+        return [link for link in links if link]
+
+    if root_name == "feed":
+        urls = []
+
+        for entry in _children(root, "entry"):
+            for link in _children(entry, "link"):
+                href = (link.get("href") or "").strip()
+
+                if link.get("rel", "alternate") == "alternate" and href:
+                    urls.append(href)
+                    break
+
+        return urls
+
+    # empty <loc> elements are left out rather than fetched as ""
+    locations = [
+        (location.text or "").strip()
+        for item in root
+        for location in _children(item, "loc")
+    ]
+    locations = [location for location in locations if location]
+
+    if root_name == "sitemapindex":
+        urls = []
+
+        for sitemap_url in locations:
+            if sitemap_url not in fetched and len(fetched) < MAX_SITEMAPS:
+                urls.extend(discover_urls(sitemap_url, fetched))
+
+        return urls
+
+    if root_name == "urlset":
+        return locations
+
+    raise ValueError(f"unrecognised XML document: <{root_name}>")
+
+
+def _discover_from_html(html: str, url: str) -> List[str]:
+    extracted = extract_microformats(mf2py.parse(doc=html, url=url))
+
+    urls = []
+
+    for item in extracted.entries + extracted.reviews + extracted.recipes:
+        item_urls = item.get("properties", {}).get("url", [])
+
+        if item_urls and isinstance(item_urls[0], str):
+            urls.append(item_urls[0])
+
+    return urls
+
+
+def discover_urls(source_url: str, fetched: Optional[Set[str]] = None) -> List[str]:
+    """
+    Finds the posts listed in an RSS or Atom feed, a sitemap (or sitemap index),
+    or a page marked up with h-feed.
+
+    :param source_url: The URL of the feed, sitemap or page.
+    :type source_url: str
+    :param fetched: The sitemaps that have already been read, so that loops are not followed.
+    :type fetched: Optional[Set[str]]
+    :return: The URL of each post, in the order they were found, without duplicates.
+    :rtype: List[str]
+
+    :raises requests.exceptions.RequestException: The request to get the feed failed.
+    :raises SourceTooLarge: The feed is larger than MAX_FEED_BYTES.
+    :raises UnsupportedContentType: The feed is not served as XML or HTML.
+    :raises ValueError: The document is not a feed, sitemap or h-feed.
+    """
+    fetched = set() if fetched is None else fetched
+    fetched.add(source_url)
+
+    # the body is streamed so that a feed that is too large is not downloaded in full
+    with get_source_cache().session.get(
+        source_url, timeout=SOURCE_FETCH_TIMEOUT, stream=True
+    ) as response:
+        response.raise_for_status()
+
+        content_type = response.headers.get("Content-Type", "")
+        check_content_type(content_type, (*FEED_CONTENT_TYPES, *SOURCE_CONTENT_TYPES))
+
+        body = read_body(response, MAX_FEED_BYTES).lstrip()
+
+    if "xml" in content_type or body.startswith(b"<?xml"):
+        urls = _discover_from_xml(ElementTree.fromstring(body), fetched)
+    else:
+        urls = _discover_from_html(decode_body(body, content_type), response.url)
+
+    # the same post can be listed more than once, for example with and without a fragment
+    unique_urls: Dict[str, None] = {}
+
+    for url in urls:
+        url = urldefrag(url).url
+
+        if url.startswith(("http://", "https://")):
+            unique_urls.setdefault(url, None)
+
+    return list(unique_urls)
+
+
+def read_journal(path: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Reads the latest result of each post from an import journal.
+
+    :param path: The path of the journal.
+    :type path: str
+    :return: The latest result of each post, keyed by URL.
+    :rtype: Dict[str, Dict[str, Any]]
+    """
+    results: Dict[str, Dict[str, Any]] = {}
+
+    if not os.path.exists(path):
+        return results
+
+    with open(path) as journal:
+        for line in journal:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # the last line may be incomplete if the import was killed while writing it
+                continue
+
+            results[result["url"]] = result
+
+    return results
+
+
+def import_posts(
+    source_url: str,
+    journal_path: str = IMPORT_JOURNAL_PATH,
+    workers: int = BATCH_WORKERS,
+    chunk_size: int = IMPORT_CHUNK_SIZE,
+) -> Dict[str, Any]:
+    """
+    Publishes every post listed in a feed, sitemap or h-feed to the wiki.
+
+    Posts are published in chunks and the result of each post is appended to
+    a journal after every chunk. Posts that the journal records as finished
+    are skipped, so an interrupted import can be run again to resume it.
+
+    :param source_url: The URL of the feed, sitemap or page.
+    :type source_url: str
+    :param journal_path: The path of the journal.
+    :type journal_path: str
+    :param workers: The number of posts fetched, or pages edited, at the same time.
+    :type workers: int
+    :param chunk_size: The number of posts published between each write to the journal.
+    :type chunk_size: int
+    :return: The number of posts with each status, and how long the import took.
+    :rtype: Dict[str, Any]
+    """
+    started = time.monotonic()
+
+    urls = discover_urls(source_url)
+
+    finished = {
+        url
+        for url, result in read_journal(journal_path).items()
+        if result.get("status") in FINISHED_STATUSES
+    }
+
+    remaining = [url for url in urls if url not in finished]
+
+    logger.info(
+        "Found %d posts, %d already imported", len(urls), len(urls) - len(remaining)
+    )
+
+    wiki_session = get_wiki_session()
+    statuses: Counter = Counter()
+
+    os.makedirs(os.path.dirname(journal_path) or ".", exist_ok=True)
+
+    with open(journal_path, "a") as journal:
+        for start in range(0, len(remaining), chunk_size):
+            items = [{"url": url} for url in remaining[start : start + chunk_size]]
+
+            authorize_items(items, wiki_session)
+
+            # imports can take a long time, so webhooks that arrive meanwhile are published first
+            results = publish_batch(items, wiki_session, workers, BACKGROUND)["results"]
+
+            for result in results:
+                journal.write(json.dumps(result) + "\n")
+                statuses[result["status"]] += 1
+
+            journal.flush()
+            os.fsync(journal.fileno())
+
+            logger.info("Imported %d of %d posts", start + len(items), len(remaining))
+
+    seconds = time.monotonic() - started
+
+    return {
+        "discovered": len(urls),
+        "already_imported": len(urls) - len(remaining),
+        "statuses": dict(statuses),
+        "seconds": round(seconds, 3),
+        "posts_per_second": round(len(remaining) / seconds, 3) if seconds else 0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import every post from a feed, sitemap or h-feed into the wiki."
+    )
+    parser.add_argument(
+        "source", help="The URL of an RSS or Atom feed, sitemap or h-feed page."
+    )
+    parser.add_argument("--journal", default=IMPORT_JOURNAL_PATH)
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    summary = import_posts(
+        arguments.source, arguments.journal, arguments.workers, arguments.chunk_size
+    )
+
+    print(
+        f"Imported {summary['discovered'] - summary['already_imported']} posts "
+        f"in {summary['seconds']} seconds ({summary['posts_per_second']} posts per second)"
+    )
+
+    for status, count in sorted(summary["statuses"].items()):
+        print(f"  {status}: {count}")
@@ -0,0 +1,194 @@
+import datetime
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# the number of worker threads that process queued jobs
+JOB_WORKERS = getattr(config, "JOB_WORKERS", 4)
+
+# the number of jobs that can wait in the queue before new jobs are refused
+JOB_QUEUE_SIZE = getattr(config, "JOB_QUEUE_SIZE", 100)
+
+# the number of jobs whose status is remembered
+JOB_HISTORY_SIZE = getattr(config, "JOB_HISTORY_SIZE", 1000)
+
+
+class QueueFull(Exception):
+    """
+    The job queue has no room for another job.
+    """
+
+    pass
+
+
+def _format_timestamp(timestamp: Optional[float]) -> Optional[str]:
+    if timestamp is None:
+        return None
+
+    return datetime.datetime.fromtimestamp(
+        timestamp, tz=datetime.timezone.utc
+    ).isoformat()
+
+
+class Job:
+    """
+    A unit of work run by a JobQueue.
+    """
+
+    def __init__(self, function: Callable[..., Dict[str, Any]], *args: Any):
+        self.id = uuid.uuid4().hex
+        self.function = function
+        self.args = args
+        self.state = "queued"
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+
+    def run(self) -> None:
+        self.state = "running"
+        self.started = time.time()
+
+        try:
+            self.result = self.function(*self.args)
+            self.state = "succeeded"
+        except Exception as exception:
+            logger.exception("Job %s failed", self.id)
+            self.error = repr(exception)
+            self.state = "failed"
+        finally:
+            self.finished = time.time()
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Returns a JSON-serialisable description of the job.
+
+        :return: The state, timing and result of the job.
+        :rtype: Dict[str, Any]
+        """
+        queued_seconds = None
+        run_seconds = None
+
+        if self.started is not None:
+            queued_seconds = round(self.started - self.created, 3)
+
+        if self.started is not None and self.finished is not None:
+            run_seconds = round(self.finished - self.started, 3)
+
+        return {
+            "id": self.id,
+            "state": self.state,
+            "created": _format_timestamp(self.created),
+            "started": _format_timestamp(self.started),
+            "finished": _format_timestamp(self.finished),
+            "queued_seconds": queued_seconds,
+            "run_seconds": run_seconds,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    """
+    A bounded queue of jobs processed by a pool of worker threads.
+
+    Worker threads are started when the first job is submitted.
+    """
+
+    def __init__(
+        self,
+        workers: int = JOB_WORKERS,
+        max_size: int = JOB_QUEUE_SIZE,
+        history_size: int = JOB_HISTORY_SIZE,
+    ):
+        self.workers = workers
+        self.history_size = history_size
+        self._queue: "queue.Queue[Job]" = queue.Queue(maxsize=max_size)
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads: list = []
+
+    def _start_workers(self) -> None:
+        with self._lock:
+            if self._threads:
+                return
+
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+
+            try:
+                job.run()
+            finally:
+                self._queue.task_done()
+
+    def submit(self, function: Callable[..., Dict[str, Any]], *args: Any) -> Job:
+        """
+        Adds a job to the queue.
+
+        :param function: The function to run. It should return a JSON-serialisable dictionary.
+        :type function: Callable[..., Dict[str, Any]]
+        :param args: The arguments to pass to the function.
+        :return: The queued job.
+        :rtype: Job
+
+        :raises QueueFull: The queue has no room for another job.
+        """
+        self._start_workers()
+
+        job = Job(function, *args)
+
+        with self._lock:
+            self._jobs[job.id] = job
+
+            # forget the oldest jobs so the history does not grow without bound
+            while len(self._jobs) > self.history_size:
+                self._jobs.popitem(last=False)
+
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+
+            raise QueueFull
+
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """
+        Gets a job that has been submitted to the queue.
+
+        :param job_id: The ID of the job.
+        :type job_id: str
+        :return: The job, or None if the job is unknown.
+        :rtype: Optional[Job]
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def pending(self) -> int:
+        """
+        Returns the number of jobs waiting to run.
+
+        :return: The number of queued jobs.
+        :rtype: int
+        """
+        return self._queue.qsize()
+
+
+job_queue = JobQueue()
@@ -0,0 +1,96 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# how long, in seconds, a category must go without new places before its map is regenerated
+MAP_UPDATE_QUIET_PERIOD = getattr(config, "MAP_UPDATE_QUIET_PERIOD", 30)
+
+
+class MapUpdateScheduler:
+    """
+    Coalesces requests to regenerate category maps.
+
+    Categories are marked as dirty. Once a category has gone a quiet period
+    without being marked again, its map is regenerated once in a background
+    thread, however many times it was marked.
+    """
+
+    def __init__(
+        self,
+        update: Callable[[str], object],
+        quiet_period: float = MAP_UPDATE_QUIET_PERIOD,
+    ):
+        self.update = update
+        self.quiet_period = quiet_period
+        self._dirty: Dict[str, float] = {}
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def schedule(self, category: str) -> None:
+        """
+        Marks a category's map as needing to be regenerated.
+
+        :param category: The name of the category, without the "Category:" prefix.
+        :type category: str
+        """
+        with self._condition:
+            self._dirty[category] = time.monotonic()
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+            self._condition.notify()
+
+    def _next_due(self) -> Optional[float]:
+        if not self._dirty:
+            return None
+
+        return min(self._dirty.values()) + self.quiet_period
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while True:
+                    due = self._next_due()
+
+                    if due is None:
+                        self._condition.wait()
+                        continue
+
+                    now = time.monotonic()
+
+                    if due <= now:
+                        break
+
+                    self._condition.wait(due - now)
+
+                ready = [
+                    category
+                    for category, marked in self._dirty.items()
+                    if marked + self.quiet_period <= now
+                ]
+
+                for category in ready:
+                    del self._dirty[category]
+
+            for category in ready:
+                try:
+                    self.update(category)
+                except Exception:
+                    logger.exception("Could not update the map for %s", category)
+
+    def pending(self) -> int:
+        """
+        Returns the number of categories waiting to be regenerated.
+
+        :return: The number of dirty categories.
+        :rtype: int
+        """
+        with self._condition:
+            return len(self._dirty)
@@ -1,12 +1,38 @@
-from typing import Any, Dict, Tuple
+import email.utils
+import hashlib
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 from urllib.parse import urlparse as urlparse_func
 
-import mf2py
 import requests
-
-from config import API_URL, LGNAME, LGPASSWORD, SYNDICATION_LINK, REQUIRE_SYNDICATION_LINK
+from requests.adapters import HTTPAdapter
+
+import config
+from config import (
+    API_URL,
+    LGNAME,
+    LGPASSWORD,
+    REQUIRE_SYNDICATION_LINK,
+    SYNDICATION_LINK,
+)
+from coordinate_sets import get_coordinate_sets
+from geo_index import get_geo_index
 from hrecipe import parse_h_recipe
-from hreview import get_all_h_geos, parse_h_review
+from hreview import MAP_FETCH_WORKERS, add_review_to_text, get_h_geos, parse_h_review
+from idempotency import get_idempotency_store, hash_item
+from map_scheduler import MapUpdateScheduler
+from metrics import CACHE_REQUESTS, ITEMS_PUBLISHED, RETRIES, in_request_context, stage
+from microformats import ExtractedMicroformats, extract_microformats
+from ratelimit import TokenBucket
+from source_cache import get_source_cache
+from wikitext import WikiPage
+
+logger = logging.getLogger(__name__)
 
 
 class SyndicationLinkNotPresent(Exception):
@@ -21,6 +47,14 @@ class SyndicationLinkNotPresent(Exception):
     pass
 
 
+class MicroformatsNotFound(Exception):
+    """
+    A page does not have a h-recipe, h-review or h-entry that can be published.
+    """
+
+    pass
+
+
 class UserNotAuthorized(Exception):
     """
     A user is not authorised to edit the MediaWiki page.
@@ -29,40 +63,406 @@ class UserNotAuthorized(Exception):
     pass
 
 
-def update_map_on_category_page(category):
-    # get h-geos on all https://breakfastand.coffee/api.php?format=json&action=query&generator=categorymembers&gcmtype=page&gcmlimit=max&gcmtitle=Category:Leeds pages
-    url = (
-        "https://breakfastand.coffee/api.php?format=json&action=query&generator=categorymembers&gcmtype=page&gcmlimit=max&gcmtitle=Category:"
-        + category
-    )
+class MediaWikiAPIError(Exception):
+    """
+    The MediaWiki API returned an error response.
+    """
 
-    r = requests.get(url)
+    def __init__(self, code: str, info: str = "", retry_after: Optional[float] = None):
+        super().__init__(f"{code}: {info}" if info else code)
+        self.code = code
+        self.info = info
+        self.retry_after = retry_after
 
-    if r.status_code != 200:
-        raise Exception
 
-    data = r.json()
+# the number of pooled connections kept open to api.php
+WIKI_POOL_SIZE = getattr(config, "WIKI_POOL_SIZE", 10)
+
+# the timeout, in seconds, applied to every request to api.php
+WIKI_REQUEST_TIMEOUT = getattr(config, "WIKI_REQUEST_TIMEOUT", 30)
+
+# the base URL of pages on the wiki
+WIKI_URL = getattr(config, "WIKI_URL", API_URL.rsplit("/", 1)[0] + "/")
+
+# API error codes that mean our login or CSRF token is no longer valid
+SESSION_EXPIRED_ERRORS = {"badtoken", "notloggedin", "assertuserfailed"}
+
+# the maximum number of edits per second made to the wiki
+EDIT_RATE_LIMIT = getattr(config, "EDIT_RATE_LIMIT", 1.0)
+
+# the number of edits that can be made at once before EDIT_RATE_LIMIT applies
+EDIT_BURST = getattr(config, "EDIT_BURST", 5)
+
+# edits are refused by the wiki while its database replicas are more than this many seconds behind
+MAXLAG = getattr(config, "MAXLAG", 5)
+
+# the number of times an edit is retried after the wiki asks us to slow down
+EDIT_THROTTLE_RETRIES = getattr(config, "EDIT_THROTTLE_RETRIES", 5)
+
+# the first and longest pause, in seconds, after the wiki asks us to slow down
+EDIT_BACKOFF_MIN = getattr(config, "EDIT_BACKOFF_MIN", 1.0)
+EDIT_BACKOFF_MAX = getattr(config, "EDIT_BACKOFF_MAX", 300.0)
+
+# API error codes and HTTP status codes that mean the wiki wants fewer edits
+THROTTLE_ERRORS = {"maxlag", "ratelimited", "readonly"}
+THROTTLE_STATUS_CODES = {429, 503}
+
+# edits made on behalf of a waiting request go before background work such as map updates
+INTERACTIVE = 0
+BACKGROUND = 1
 
-    pages = data["query"]["pages"]
 
-    h_geos = []
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Reads a Retry-After header.
+
+    :param value: The value of the header, in seconds or as an HTTP date.
+    :type value: Optional[str]
+    :return: The number of seconds to wait, or None if the header is missing or invalid.
+    :rtype: Optional[float]
+    """
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+_edit_priority = threading.local()
+
+
+@contextmanager
+def edit_priority(priority: int) -> Iterator[None]:
+    """
+    Sets the priority of the edits made by the current thread.
+
+    :param priority: INTERACTIVE or BACKGROUND.
+    :type priority: int
+    """
+    previous = getattr(_edit_priority, "value", INTERACTIVE)
+    _edit_priority.value = priority
+
+    try:
+        yield
+    finally:
+        _edit_priority.value = previous
+
+
+class EditScheduler:
+    """
+    Paces the edits made to one wiki.
+
+    Edits take a token from a token bucket, so no more than EDIT_RATE_LIMIT
+    edits per second are made. Background edits wait while any interactive
+    edit is waiting. When the wiki reports that it is lagged or that we are
+    editing too quickly, every edit is paused for the time given in the
+    response's Retry-After header, or for an exponential backoff that
+    doubles with each consecutive refusal and halves with each success.
+    """
 
-    for p in pages:
-        h_geos.extend(
-            get_all_h_geos(["https://breakfastand.coffee/" + pages[p]["title"]])
+    def __init__(self, rate: float = EDIT_RATE_LIMIT, burst: float = EDIT_BURST):
+        self.bucket = TokenBucket(rate, burst)
+        self.throttled = 0
+        self._condition = threading.Condition()
+        self._interactive_waiting = 0
+        self._paused_until = 0.0
+        self._backoff = 0.0
+
+    def _wait_for_turn(self, priority: int) -> None:
+        with self._condition:
+            if priority == INTERACTIVE:
+                self._interactive_waiting += 1
+
+            try:
+                while True:
+                    pause = self._paused_until - time.monotonic()
+
+                    if pause > 0:
+                        self._condition.wait(pause)
+                    elif priority == BACKGROUND and self._interactive_waiting:
+                        self._condition.wait()
+                    else:
+                        # a token is only taken when it is available, so the next edit is chosen again each time
+                        wait = self.bucket.try_acquire()
+
+                        if wait == 0:
+                            return
+
+                        self._condition.wait(wait)
+            finally:
+                if priority == INTERACTIVE:
+                    self._interactive_waiting -= 1
+                    self._condition.notify_all()
+
+    def _succeeded(self) -> None:
+        with self._condition:
+            self._backoff = self._backoff / 2 if self._backoff >= EDIT_BACKOFF_MIN else 0.0
+
+    def _throttle(self, retry_after: Optional[float]) -> float:
+        with self._condition:
+            self._backoff = min(
+                EDIT_BACKOFF_MAX, max(EDIT_BACKOFF_MIN, self._backoff * 2)
+            )
+            pause = min(EDIT_BACKOFF_MAX, max(retry_after or 0.0, self._backoff))
+
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            self.throttled += 1
+            self._condition.notify_all()
+
+        return pause
+
+    def run(self, send: Callable[[], Dict[str, Any]], priority: int) -> Dict[str, Any]:
+        """
+        Makes an edit when it is its turn, retrying if the wiki asks us to slow down.
+
+        :param send: A function that makes the edit request.
+        :type send: Callable[[], Dict[str, Any]]
+        :param priority: INTERACTIVE or BACKGROUND.
+        :type priority: int
+        :return: The decoded JSON response.
+        :rtype: Dict[str, Any]
+
+        :raises MediaWikiAPIError: The API rejected the edit, or kept asking us to slow down.
+        :raises requests.exceptions.RequestException: The edit request failed.
+        """
+        attempt = 0
+
+        while True:
+            with stage("edit_wait"):
+                self._wait_for_turn(priority)
+
+            try:
+                with stage("edit"):
+                    result = send()
+            except MediaWikiAPIError as exception:
+                if exception.code not in THROTTLE_ERRORS or attempt >= EDIT_THROTTLE_RETRIES:
+                    raise
+
+                retry_after = exception.retry_after
+                reason = exception.code
+            except requests.exceptions.HTTPError as exception:
+                response = exception.response
+
+                if (
+                    response is None
+                    or response.status_code not in THROTTLE_STATUS_CODES
+                    or attempt >= EDIT_THROTTLE_RETRIES
+                ):
+                    raise
+
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                reason = str(response.status_code)
+            else:
+                self._succeeded()
+                return result
+
+            attempt += 1
+
+            RETRIES.inc(operation="edit", reason=reason)
+
+            pause = self._throttle(retry_after)
+
+            logger.warning("Edits paused for %.1f seconds (%s)", pause, reason)
+
+
+class WikiSession:
+    """
+    A long-lived, logged in session with the MediaWiki API.
+
+    The session logs in once, keeps a warm connection pool, and caches the
+    CSRF token. If the API reports that the login or token has expired, the
+    session logs in again and retries the request once.
+
+    A single instance can be shared between threads.
+    """
+
+    def __init__(self, api_url: str = API_URL):
+        self.api_url = api_url
+        self.session = self._create_session()
+        self._csrf_token: Optional[str] = None
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.edit_scheduler = EditScheduler()
+
+    def _create_session(self) -> requests.Session:
+        session = requests.Session()
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=WIKI_POOL_SIZE)
+
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        return session
+
+    def _log_in(self) -> None:
+        with stage("login"):
+            self._log_in_once()
+
+    def _log_in_once(self) -> None:
+        token_request = self.session.get(
+            self.api_url,
+            params={"action": "query", "meta": "tokens", "format": "json", "type": "login"},
+            timeout=WIKI_REQUEST_TIMEOUT,
         )
 
-    url = "map?coordinates=" + "".join(
-        [
-            str(h_geo["properties"]["latitude"][0])
-            + ","
-            + str(h_geo["properties"]["longitude"][0])
-            + "|"
-            for h_geo in h_geos
-        ]
-    ).rstrip("|")
+        log_in(self.api_url, token_request, self.session)
 
-    content_details = {
+        self._csrf_token = get_csrf_token(self.api_url, self.session)
+        self._generation += 1
+
+    def _refresh(self, generation: int) -> None:
+        with self._lock:
+            # another thread has already logged in again since we saw the error
+            if generation != self._generation:
+                return
+
+            self.session = self._create_session()
+            self._log_in()
+
+    @property
+    def csrf_token(self) -> str:
+        """
+        The cached CSRF token, logging in first if necessary.
+        """
+        if self._csrf_token is None:
+            with self._lock:
+                if self._csrf_token is None:
+                    self._log_in()
+
+        return self._csrf_token  # type: ignore
+
+    def get(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Makes a read request to the MediaWiki API.
+
+        :param params: The query string parameters to send.
+        :type params: Dict[str, Any]
+        :return: The decoded JSON response.
+        :rtype: Dict[str, Any]
+
+        :raises MediaWikiAPIError: The API returned an error.
+        """
+        return self._request("GET", dict(params), with_token=False)
+
+    def post(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Makes a write request to the MediaWiki API, adding the CSRF token.
+
+        Edits should be made with `edit_page`, which paces them with the
+        session's EditScheduler.
+
+        :param data: The form parameters to send.
+        :type data: Dict[str, Any]
+        :return: The decoded JSON response.
+        :rtype: Dict[str, Any]
+
+        :raises MediaWikiAPIError: The API returned an error.
+        """
+        return self._request("POST", dict(data), with_token=True)
+
+    def _request(
+        self, method: str, params: Dict[str, Any], with_token: bool
+    ) -> Dict[str, Any]:
+        params.setdefault("format", "json")
+        # the API reports assertuserfailed if the login has expired, for reads as well as writes
+        params.setdefault("assert", "user")
+
+        for attempt in range(2):
+            if with_token:
+                params["token"] = self.csrf_token
+            elif self._csrf_token is None:
+                # make sure read requests are made as the bot user
+                self.csrf_token
+
+            # read after logging in, so an error on the first request still leads to a new login
+            generation = self._generation
+
+            if method == "GET":
+                response = self.session.get(
+                    self.api_url, params=params, timeout=WIKI_REQUEST_TIMEOUT
+                )
+            else:
+                response = self.session.post(
+                    self.api_url, data=params, timeout=WIKI_REQUEST_TIMEOUT
+                )
+
+            response.raise_for_status()
+
+            result = response.json()
+
+            error = result.get("error")
+
+            if not error:
+                return result
+
+            if error.get("code") in SESSION_EXPIRED_ERRORS and attempt == 0:
+                RETRIES.inc(operation="session", reason=error.get("code"))
+                self._refresh(generation)
+                continue
+
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+
+            # maxlag errors report how far behind the replicas are
+            if retry_after is None and isinstance(error.get("lag"), (int, float)):
+                retry_after = float(error["lag"])
+
+            raise MediaWikiAPIError(
+                error.get("code", ""), error.get("info", ""), retry_after
+            )
+
+        raise MediaWikiAPIError("badtoken", "could not re-authenticate")
+
+
+_wiki_session: Optional[WikiSession] = None
+_wiki_session_lock = threading.Lock()
+
+
+def get_wiki_session() -> WikiSession:
+    """
+    Returns the process-wide MediaWiki session, creating it on first use.
+
+    :return: The shared session.
+    :rtype: WikiSession
+    """
+    global _wiki_session
+
+    if _wiki_session is None:
+        with _wiki_session_lock:
+            if _wiki_session is None:
+                _wiki_session = WikiSession(API_URL)
+
+    return _wiki_session
+
+
+@stage("map_update")
+def update_map_on_category_page(category: str) -> bool:
+    """
+    Updates the map of places on a category page.
+
+    The map is drawn from the geo index, so no pages are fetched. Use
+    rebuild_category_map to reconcile the index with the wiki. The page is
+    not edited if the map has not changed since it was last published.
+
+    :param category: The name of the category, without the "Category:" prefix.
+    :type category: str
+    :return: Whether the category page was edited.
+    :rtype: bool
+    """
+    coordinates = get_geo_index().get_category_coordinates(category)
+
+    # the coordinates are stored on the map server so the iframe URL stays short
+    url = "map/" + get_coordinate_sets().save(coordinates)
+
+    content_details: Dict[str, Any] = {
         "name": "Category:" + category,
         "content": {
             "html": '<iframe path="'
@@ -72,21 +472,111 @@ def update_map_on_category_page(category):
         "url": "https://breakfastand.coffee/" + category,
     }
 
-    session = requests.Session()
+    content_hash = hashlib.sha256(
+        content_details["content"]["html"].encode()
+    ).hexdigest()
+
+    if get_geo_index().get_published_map_hash(category) == content_hash:
+        return False
+
+    # maps are redrawn in the background, so reviews being published go first
+    with edit_priority(BACKGROUND):
+        submit_edit_request(content_details, get_wiki_session())
 
-    token_request, session = get_login_token_state(API_URL)
+    get_geo_index().set_published_map_hash(category, content_hash)
 
-    log_in(API_URL, token_request, session)
+    return True
 
-    csrf_token_request = get_csrf_token(API_URL, session)
 
-    submit_edit_request(
-        content_details,
-        session,
-        API_URL,
-        csrf_token_request,
+# regenerates each category map once a burst of new places has settled
+map_update_scheduler = MapUpdateScheduler(update_map_on_category_page)
+
+
+def record_place(content_details: Dict[str, Any]) -> None:
+    """
+    Adds a published review's place to the geo index and schedules an update
+    of the map on the page for the place's country.
+
+    :param content_details: The information used to create the wiki page.
+    :type content_details: Dict[str, Any]
+    """
+    place = content_details.get("place")
+
+    if not place:
+        return
+
+    get_geo_index().record_place(
+        content_details["name"],
+        place["latitude"],
+        place["longitude"],
+        [place["city"], place["country"]],
     )
 
+    map_update_scheduler.schedule(place["country"])
+
+
+@stage("map_rebuild")
+def rebuild_category_map(category: str) -> Dict[str, Any]:
+    """
+    Reconciles the geo index with every page in a category, then updates the
+    map on the category page.
+
+    Every page in the category is fetched, following API continuation so large
+    categories are not truncated. If a page cannot be fetched, the location
+    already recorded for it is kept.
+
+    :param category: The name of the category, without the "Category:" prefix.
+    :type category: str
+    :return: The number of pages in the category and the number of pages with a location.
+    :rtype: Dict[str, Any]
+    """
+    category_members_params = {
+        "action": "query",
+        "list": "categorymembers",
+        "cmtype": "page",
+        "cmlimit": "max",
+        "cmtitle": "Category:" + category,
+    }
+
+    titles: List[str] = []
+
+    for result in iterate_query(get_wiki_session(), category_members_params):
+        titles.extend(member["title"] for member in result["query"]["categorymembers"])
+
+    geo_index = get_geo_index()
+
+    places = {}
+
+    with ThreadPoolExecutor(max_workers=MAP_FETCH_WORKERS) as executor:
+        futures = {
+            title: executor.submit(get_h_geos, get_page_url(title)) for title in titles
+        }
+
+    for title, future in futures.items():
+        try:
+            h_geos = future.result()
+        except Exception:
+            logger.warning("Could not retrieve h-geos from %s", title, exc_info=True)
+
+            place = geo_index.get_place(title)
+
+            if place:
+                places[title] = place
+
+            continue
+
+        if h_geos:
+            places[title] = (
+                h_geos[0]["properties"]["latitude"][0],
+                h_geos[0]["properties"]["longitude"][0],
+            )
+
+    geo_index.replace_category(category, places)
+
+    update_map_on_category_page(category)
+
+    return {"category": category, "pages": len(titles), "places": len(places)}
+
 
 def get_login_token_state(url: str) -> Tuple[requests.Response, requests.Session]:
     """
@@ -163,141 +653,277 @@ def get_csrf_token(url: str, session: requests.Session) -> str:
     return csrf_token
 
 
-def get_list_of_authorized_users(url: str, session: requests.Session) -> Dict[str, str]:
+def get_page_url(title: str) -> str:
+    """
+    Gets the URL of a page on the wiki.
+
+    :param title: The title of the page.
+    :type title: str
+    :return: The URL of the page.
+    :rtype: str
+    """
+    return WIKI_URL + title.replace(" ", "_")
+
+
+def iterate_query(
+    wiki_session: WikiSession, params: Dict[str, Any]
+) -> Iterator[Dict[str, Any]]:
+    """
+    Runs a query against the MediaWiki API, following "continue" values until
+    every page of results has been retrieved.
+
+    :param wiki_session: The session used to make requests to the API.
+    :type wiki_session: WikiSession
+    :param params: The query parameters.
+    :type params: Dict[str, Any]
+    :return: An iterator over each page of API responses.
+    :rtype: Iterator[Dict[str, Any]]
+    """
+    continue_params: Dict[str, Any] = {"continue": ""}
+
+    while True:
+        result = wiki_session.get({**params, **continue_params})
+
+        yield result
+
+        if "continue" not in result:
+            return
+
+        continue_params = result["continue"]
+
+
+def get_list_of_authorized_users(wiki_session: WikiSession) -> Set[str]:
     """
     Gets a list of all users on a MediaWiki.
 
-    :param url: The URL of the MediaWiki API.
-    :type url: str
-    :param session: A session object used to make requests to the API.
-    :type session: requests.Session
-    :return: A dictionary of all users on the MediaWiki.
-    :rtype: Dict[str, str]
+    :param wiki_session: The session used to make requests to the API.
+    :type wiki_session: WikiSession
+    :return: The lowercased names of all users on the MediaWiki.
+    :rtype: Set[str]
     """
     get_list_of_authorized_users_params = {
         "action": "query",
         "list": "allusers",
+        "aulimit": "max",
         "format": "json",
     }
 
-    try:
-        list_of_authorized_users_request = session.get(
-            url, params=get_list_of_authorized_users_params
+    authorized_users: Set[str] = set()
+
+    for result in iterate_query(wiki_session, get_list_of_authorized_users_params):
+        authorized_users.update(
+            user["name"].lower() for user in result["query"]["allusers"]
         )
-    except requests.exceptions.RequestException:
-        raise Exception
 
-    authorized_users = list_of_authorized_users_request.json()["query"]["allusers"]
+    return authorized_users
 
-    dictionary_of_authorized_users = {k["name"].lower(): True for k in authorized_users}
 
-    return dictionary_of_authorized_users
+# the maximum age, in seconds, of the authorized user index before a check
+# refreshes it inline
+USER_INDEX_MAX_AGE = getattr(config, "USER_INDEX_MAX_AGE", 300)
 
+# how often, in seconds, the authorized user index is refreshed in the background
+USER_INDEX_REFRESH_INTERVAL = getattr(config, "USER_INDEX_REFRESH_INTERVAL", 60)
 
-def verify_user_is_authorized(
-    url: str, user_domain: str, session: requests.Session
-) -> None:
-    """
-    Checks if a user is authorised to make changes to the wiki.
+# the minimum time, in seconds, between refreshes triggered by an unknown user
+USER_INDEX_MISS_REFRESH_INTERVAL = getattr(
+    config, "USER_INDEX_MISS_REFRESH_INTERVAL", 10
+)
 
-    :param url: The URL of the MediaWiki API.
-    :type url: str
-    :param user_domain: The domain of the user who wants to make changes to the wiki.
-    :type user_domain: str
-    :param session: A session object used to make requests to the API.
-    :type session: requests.Session
 
-    :raises UserNotAuthorized: If the user is not authorised to make changes to the wiki.
+class AuthorizedUserIndex:
     """
-    authorized_users = get_list_of_authorized_users(url, session)
-
-    # if not authorized_users.get(user_domain.lower()):
-    #     raise UserNotAuthorized
-
+    A local index of the users registered on the wiki.
 
-def parse_url(
-    content_url: str, csrf_token: str, session: requests.Session, edit: bool = True
-) -> Tuple[Dict[str, Any], str]:
+    The index is loaded in full once. After that, it is kept up to date from
+    the "newusers" log, fetching only accounts created since the last refresh.
     """
-    Retrieves a h-review or h-entry from a URL, checks for a syndication link,
-    and makes a dictionary with information that will be used to create the
-    new wiki page (or update an existing one).
 
-    :param content_url: The URL of the content to be parsed.
-    :type content_url: str
-    :param csrf_token_request: A CSRF token retrieved from the MediaWiki API.
-    :type csrf_token_request: str
-    :return: A tuple containing a dictionary of information about the content for the new wiki page.
+    def __init__(
+        self,
+        wiki_session: WikiSession,
+        max_age: float = USER_INDEX_MAX_AGE,
+        refresh_interval: float = USER_INDEX_REFRESH_INTERVAL,
+    ):
+        self.wiki_session = wiki_session
+        self.max_age = max_age
+        self.refresh_interval = refresh_interval
+        self._users: Set[str] = set()
+        self._log_timestamp: Optional[str] = None
+        self._last_refresh: Optional[float] = None
+        self._lock = threading.Lock()
+        # only one thread talks to the API about the index at a time
+        self._refresh_lock = threading.RLock()
+        self._refresh_thread: Optional[threading.Thread] = None
+
+    def _get_latest_log_timestamp(self) -> str:
+        result = self.wiki_session.get(
+            {"action": "query", "list": "logevents", "letype": "newusers", "lelimit": 1}
+        )
 
-    :raises requests.exceptions.RequestException: The request to get the content on a page fails.
-    :raises SyndicationLinkNotPresent: The specified URL does not have a syndication link to the MediaWiki instance.
+        log_events = result["query"]["logevents"]
+
+        if log_events:
+            return log_events[0]["timestamp"]
+
+        return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+    def load(self) -> None:
+        """
+        Loads every user on the wiki, replacing the contents of the index.
+        """
+        with self._refresh_lock:
+            # read the log position first so no account created during the load is missed
+            log_timestamp = self._get_latest_log_timestamp()
+            users = get_list_of_authorized_users(self.wiki_session)
+
+            with self._lock:
+                self._users = users
+                self._log_timestamp = log_timestamp
+                self._last_refresh = time.monotonic()
+
+    def refresh(self) -> None:
+        """
+        Adds users created since the last refresh to the index.
+        """
+        with self._refresh_lock:
+            if self._log_timestamp is None:
+                self.load()
+            else:
+                self._refresh_from_log(self._log_timestamp)
+
+    def _refresh_from_log(self, log_timestamp: str) -> None:
+        params = {
+            "action": "query",
+            "list": "logevents",
+            "letype": "newusers",
+            "lestart": log_timestamp,
+            "ledir": "newer",
+            "lelimit": "max",
+        }
+
+        new_users = set()
+
+        for result in iterate_query(self.wiki_session, params):
+            for log_event in result["query"]["logevents"]:
+                # the title is "User:<name>" for both self-created and admin-created accounts
+                new_users.add(log_event["title"].split(":", 1)[-1].lower())
+                log_timestamp = max(log_timestamp, log_event["timestamp"])
+
+        with self._lock:
+            self._users.update(new_users)
+            self._log_timestamp = log_timestamp
+            self._last_refresh = time.monotonic()
+
+    def _refresh_in_background(self) -> None:
+        while True:
+            time.sleep(self.refresh_interval)
+
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Could not refresh the authorized user index")
+
+    def start(self) -> None:
+        """
+        Starts refreshing the index in a background thread.
+        """
+        with self._lock:
+            if self._refresh_thread is not None:
+                return
+
+            self._refresh_thread = threading.Thread(
+                target=self._refresh_in_background, daemon=True
+            )
+
+        self._refresh_thread.start()
+
+    def _age(self) -> float:
+        if self._last_refresh is None:
+            return float("inf")
+
+        return time.monotonic() - self._last_refresh
+
+    def __contains__(self, user: str) -> bool:
+        if self._last_refresh is None:
+            with self._refresh_lock:
+                if self._last_refresh is None:
+                    self.load()
+
+            self.start()
+        elif self._age() > self.max_age:
+            self.refresh()
+
+        if user.lower() in self._users:
+            return True
+
+        # the user may have registered since the last refresh
+        if self._age() > USER_INDEX_MISS_REFRESH_INTERVAL:
+            self.refresh()
+
+        return user.lower() in self._users
+
+
+_user_index: Optional[AuthorizedUserIndex] = None
+
+
+def get_user_index(wiki_session: WikiSession) -> AuthorizedUserIndex:
     """
-    content_parsed = mf2py.parse(url=content_url)
-
-    h_reviews = []
-    h_recipe = []
-
-    for item in content_parsed["items"]:
-        item_type = item["type"][0]
-
-        if item_type == "h-review":
-            h_reviews.append(item)
-
-        if item_type == "h-recipe":
-            h_recipe.append(item)
-
-        if item_type == "h-entry":
-            parsed_entry = mf2py.parse(doc=item["properties"]["content"][0]["html"])
+    Returns the process-wide authorized user index, creating it on first use.
 
-            for new_item in parsed_entry["items"]:
-                item_type = new_item["type"][0]
-
-                if item_type == "h-review":
-                    h_reviews.append(new_item["properties"])
+    :param wiki_session: The session used to make requests to the API.
+    :type wiki_session: WikiSession
+    :return: The shared index.
+    :rtype: AuthorizedUserIndex
+    """
+    global _user_index
 
-    domain = urlparse_func(content_url).netloc
+    if _user_index is None:
+        with _wiki_session_lock:
+            if _user_index is None:
+                _user_index = AuthorizedUserIndex(wiki_session)
 
-    html = ""
+    return _user_index
 
-    if len(h_recipe) > 0:
-        content_details = parse_h_recipe(h_recipe[0], domain)
 
-        html += content_details["content"]["html"]
+def verify_user_is_authorized(user_domain: str, wiki_session: WikiSession) -> None:
+    """
+    Checks if a user is authorised to make changes to the wiki.
 
-        if edit == True:
-            submit_edit_request(content_details, session, API_URL, csrf_token)
+    :param user_domain: The domain of the user who wants to make changes to the wiki.
+    :type user_domain: str
+    :param wiki_session: The session used to make requests to the API.
+    :type wiki_session: WikiSession
 
-        return content_details, domain, "recipe"
+    :raises UserNotAuthorized: If the user is not authorised to make changes to the wiki.
+    """
+    with stage("authorize"):
+        authorized = user_domain in get_user_index(wiki_session)
 
-    for h_review in h_reviews:
-        content_details = parse_h_review(
-            h_review,
-            content_parsed,
-            content_url,
-            domain,
-            h_review["properties"]["name"][0].replace(" - ", " ").replace(" ", "_"),
-        )
+    if not authorized:
+        raise UserNotAuthorized
 
-        html += content_details["content"]["html"]
 
-        if edit == True:
-            submit_edit_request(content_details, session, API_URL, csrf_token)
+# the number of items on a page that are geocoded and rendered ahead of the item being published
+PARSE_PIPELINE_DEPTH = getattr(config, "PARSE_PIPELINE_DEPTH", 4)
 
-        return content_details, domain, "review"
 
-    h_entry = [
-        e
-        for e in content_parsed["items"]
-        if e["type"][0] == "h-entry" or e["type"][0] == "h-review"
-    ]
+def parse_h_entry(h_entry: dict) -> Dict[str, Any]:
+    """
+    Makes a dictionary with information that will be used to create a wiki
+    page from an h-entry.
 
-    if len(h_entry) == 0:
-        raise Exception
+    :param h_entry: The h-entry object.
+    :type h_entry: dict
+    :return: A dictionary of information about the content for the new wiki page.
+    :rtype: Dict[str, Any]
 
-    h_entry_item = h_entry[0].get("properties")
+    :raises SyndicationLinkNotPresent: The h-entry does not have a syndication link to the MediaWiki instance.
+    """
+    h_entry_item = h_entry.get("properties")
 
     if not h_entry_item:
-        raise Exception
+        raise MicroformatsNotFound
 
     categories = [f"[[Category:{c}]]" for c in h_entry_item.get("category", "")]
 
@@ -305,7 +931,7 @@ def parse_url(
     if not h_entry_item.get("syndication") and REQUIRE_SYNDICATION_LINK:
         raise SyndicationLinkNotPresent
 
-    if SYNDICATION_LINK not in h_entry_item.get("syndication") and REQUIRE_SYNDICATION_LINK:
+    if SYNDICATION_LINK not in h_entry_item.get("syndication", []) and REQUIRE_SYNDICATION_LINK:
         raise SyndicationLinkNotPresent
 
     name = h_entry_item.get("name") or ""
@@ -339,42 +965,655 @@ def parse_url(
         categories
     )
 
-    return content_details, csrf_token, "entry"
+    return content_details
 
 
-def submit_edit_request(
-    content_details: Dict[str, str],
-    session: requests.Session,
-    api_url: str,
-    csrf_token: str,
-) -> None:
+def find_items(extracted: ExtractedMicroformats) -> List[Tuple[str, dict]]:
     """
-    Submits an edit request to the MediaWiki API.
+    Lists the items on a page that can be published to the wiki.
 
-    Edit requests create a new page if the specified page does not exist.
+    Every h-recipe and h-review is listed. An h-entry is only listed if it does
+    not contain an h-recipe or h-review, since it is then a wrapper around them.
+
+    :param extracted: The microformats found on the page.
+    :type extracted: ExtractedMicroformats
+    :return: The post type ("recipe", "review" or "entry") and object of each item, in document order.
+    :rtype: List[Tuple[str, dict]]
+    """
+    wrappers = set()
+
+    for item in extracted.recipes + extracted.reviews:
+        current: Optional[dict] = item
+
+        while current is not None:
+            wrappers.add(id(current))
+            current = extracted.parent_of(current)
+
+    items = [("recipe", h_recipe) for h_recipe in extracted.recipes]
+    items += [("review", h_review) for h_review in extracted.reviews]
+    items += [("entry", h_entry) for h_entry in extracted.entries if id(h_entry) not in wrappers]
+
+    # the order in which the items appear on the page
+    order: Dict[int, int] = {}
+
+    for item in extracted.iter_items():
+        order.setdefault(id(item), len(order))
+
+    return sorted(items, key=lambda item: order.get(id(item[1]), 0))
+
+
+def item_title(properties: dict) -> str:
+    """
+    Gets the title of the wiki page an item is published to.
+
+    :param properties: The item.
+    :type properties: dict
+    :return: The title of the page.
+    :rtype: str
+    """
+    names = properties.get("properties", {}).get("name") or [""]
+
+    return names[0] if isinstance(names[0], str) else ""
+
+
+def _prefetch(function: Callable[[Any], Any], items: List[Any], depth: int) -> Iterator[Any]:
+    # at most `depth` items are processed ahead of the consumer, in order
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        pending: "deque" = deque()
+
+        for item in items:
+            pending.append(executor.submit(in_request_context(function), item))
+
+            if len(pending) >= depth:
+                yield pending.popleft()
+
+        while pending:
+            yield pending.popleft()
+
+
+def parse_url(
+    content_url: str,
+    wiki_session: Optional[WikiSession],
+    edit: bool = True,
+    skip_unchanged: Optional[bool] = None,
+) -> Iterator[Tuple[Dict[str, Any], str, str]]:
+    """
+    Retrieves every h-recipe, h-review and h-entry from a URL and makes a
+    dictionary for each one with information that will be used to create a new
+    wiki page (or update an existing one).
+
+    The page is fetched and parsed once. Items are yielded in the order they
+    appear on the page. While one item is being published, the next few items
+    are geocoded and rendered in the background.
+
+    Items that have already been published from this URL without changes
+    are not geocoded, rendered or edited again. They are yielded with a
+    "status" of "skipped" and the "revid" of the edit that published them.
+
+    :param content_url: The URL of the content to be parsed.
+    :type content_url: str
+    :param wiki_session: The session used to make edits. Only used if `edit` is True.
+    :type wiki_session: Optional[WikiSession]
+    :param edit: Whether to submit each item to the MediaWiki as it is yielded.
+    :type edit: bool
+    :param skip_unchanged: Whether to skip items that have not changed since
+        they were last published. Defaults to the value of `edit`.
+    :type skip_unchanged: Optional[bool]
+    :return: A generator of tuples containing a dictionary of information about
+        the content for a wiki page, the domain of the post and the post type.
+
+    :raises requests.exceptions.RequestException: The request to get the content on a page fails.
+    :raises MicroformatsNotFound: The page has no h-recipe, h-review or h-entry.
+    :raises SyndicationLinkNotPresent: No item on the page has a syndication link to the MediaWiki instance.
+    """
+    # a cached copy is used if the page has not changed since it was last fetched
+    content_parsed = get_source_cache().fetch(content_url)
+
+    # walk the parsed page once, including microformats nested in h-entry content
+    extracted = extract_microformats(content_parsed)
+
+    domain = urlparse_func(content_url).netloc
+
+    items = find_items(extracted)
+
+    if len(items) == 0:
+        raise MicroformatsNotFound
+
+    if skip_unchanged is None:
+        skip_unchanged = edit
+
+    def parse_item(item: Tuple[str, dict]) -> Dict[str, Any]:
+        post_type, properties = item
+
+        with stage("render"):
+            if post_type == "recipe":
+                return parse_h_recipe(properties, domain)
+
+            if post_type == "review":
+                return parse_h_review(properties, extracted, content_url, domain)
+
+            return parse_h_entry(properties)
+
+    # the hash covers the item as it appears on the page, so unchanged items are found before any geocoding
+    content_hashes = []
+    unchanged: Dict[int, Dict[str, Any]] = {}
+
+    for index, (post_type, properties) in enumerate(items):
+        geo = extracted.geo_for(properties) if post_type == "review" else None
+        content_hashes.append(hash_item(post_type, properties, geo))
+
+        if not skip_unchanged:
+            continue
+
+        title = item_title(properties)
+        published_item = get_idempotency_store().get(content_url, title)
+
+        if published_item and published_item["content_hash"] == content_hashes[index]:
+            CACHE_REQUESTS.inc(cache="idempotency", result="hit")
+            ITEMS_PUBLISHED.inc(post_type=post_type, status="skipped")
+
+            unchanged[index] = {
+                "name": title,
+                "url": content_url,
+                "content": {"html": ""},
+                "status": "skipped",
+                "revid": published_item["revid"],
+            }
+
+    changed_items = [item for index, item in enumerate(items) if index not in unchanged]
+    futures = _prefetch(parse_item, changed_items, PARSE_PIPELINE_DEPTH)
+
+    published = 0
+    syndication_error: Optional[SyndicationLinkNotPresent] = None
+
+    for index, (post_type, _) in enumerate(items):
+        if index in unchanged:
+            published += 1
+
+            yield unchanged[index], domain, post_type
+
+            continue
+
+        try:
+            content_details = next(futures).result()
+        except SyndicationLinkNotPresent as exception:
+            # entries without a syndication link are left out, unless there is nothing else to publish
+            syndication_error = exception
+            continue
+
+        content_details["source_url"] = content_url
+        content_details["content_hash"] = content_hashes[index]
+
+        if edit == True and wiki_session is not None:
+            content_details["status"] = publish_content(
+                content_details, post_type, wiki_session
+            )
+
+        published += 1
+
+        yield content_details, domain, post_type
+
+    if published == 0 and syndication_error is not None:
+        raise syndication_error
+
+
+def publish_content(
+    content_details: Dict[str, Any],
+    post_type: str,
+    wiki_session: WikiSession,
+    exists: Optional[bool] = None,
+) -> str:
+    """
+    Makes the wiki edits for content returned by `parse_url`.
 
     :param content_details: A dictionary of information about the page to edit.
-    :type content_details: Dict[str, str]
-    :param session: A session object used to make requests to the API.
-    :type session: requests.Session
-    :param api_url: The URL of the MediaWiki API.
-    :type api_url: str
-    :param csrf_token: A CSRF token retrieved from the MediaWiki API.
-    :type csrf_token: str
+    :type content_details: Dict[str, Any]
+    :param post_type: The type of post ("recipe", "review" or "entry").
+    :type post_type: str
+    :param wiki_session: The session used to make requests to the API.
+    :type wiki_session: WikiSession
+    :param exists: Whether the page is known to exist. It is looked up if None.
+    :type exists: Optional[bool]
+    :return: "created", "updated" or "skipped" if nothing was changed.
+    :rtype: str
+    """
+    if post_type == "review":
+        status = publish_review(content_details, wiki_session, exists)
+        record_place(content_details)
+    elif post_type == "recipe":
+        edit = submit_edit_request(content_details, wiki_session)
+        content_details["revid"] = edit.get("newrevid")
+
+        if "nochange" in edit:
+            status = "skipped"
+        else:
+            status = "created" if "new" in edit else "updated"
+    else:
+        # entries are not published to the wiki
+        return "skipped"
+
+    ITEMS_PUBLISHED.inc(post_type=post_type, status=status)
+
+    # the next time the post is sent, this item is skipped unless it has changed
+    if "content_hash" in content_details:
+        get_idempotency_store().record(
+            content_details["source_url"],
+            content_details["name"],
+            content_details["content_hash"],
+            content_details.get("revid"),
+        )
 
-    :raises requests.exceptions.RequestException: The edit request failed.
+    return status
+
+
+def edit_page(
+    wiki_session: WikiSession, title: str, summary: str, **fields: Any
+) -> Dict[str, Any]:
+    """
+    Makes an edit with the MediaWiki API.
+
+    :param wiki_session: The session used to make requests to the API.
+    :type wiki_session: WikiSession
+    :param title: The title of the page to edit.
+    :type title: str
+    :param summary: The edit summary.
+    :type summary: str
+    :param fields: Other edit parameters, such as text, appendtext, section or basetimestamp.
+    :return: The "edit" object from the API response.
+    :rtype: Dict[str, Any]
+
+    :raises MediaWikiAPIError: The API rejected the edit.
     """
     edit_page_params = {
         "action": "edit",
-        "title": content_details["name"],
-        "text": content_details["content"]["html"],
+        "title": title,
         "format": "json",
-        "summary": f"New page created by coffeebot from {content_details['url']}",
-        "token": csrf_token,
+        "summary": summary,
         "bot": False,
+        "maxlag": MAXLAG,
+        **fields,
     }
 
-    try:
-        session.post(api_url, data=edit_page_params)
-    except requests.exceptions.RequestException as exception:
-        raise exception
+    # every edit is paced by the scheduler, in the priority set by edit_priority
+    result = wiki_session.edit_scheduler.run(
+        lambda: wiki_session.post(edit_page_params),
+        getattr(_edit_priority, "value", INTERACTIVE),
+    )
+
+    return result.get("edit", {})
+
+
+def submit_edit_request(
+    content_details: Dict[str, Any], wiki_session: WikiSession
+) -> Dict[str, Any]:
+    """
+    Submits an edit request to the MediaWiki API.
+
+    Edit requests create a new page if the specified page does not exist.
+
+    :param content_details: A dictionary of information about the page to edit.
+    :type content_details: Dict[str, Any]
+    :param wiki_session: The session used to make requests to the API.
+    :type wiki_session: WikiSession
+    :return: The "edit" object from the API response.
+    :rtype: Dict[str, Any]
+
+    :raises requests.exceptions.RequestException: The edit request failed.
+    :raises MediaWikiAPIError: The API rejected the edit.
+    """
+    return edit_page(
+        wiki_session,
+        content_details["name"],
+        f"New page created by coffeebot from {content_details['url']}",
+        text=content_details["content"]["html"],
+    )
+
+
+# the number of times a section edit is retried after an edit conflict
+EDIT_CONFLICT_RETRIES = getattr(config, "EDIT_CONFLICT_RETRIES", 3)
+
+# the most titles MediaWiki accepts in one query from a user without the apihighlimits right
+REVISION_BATCH_SIZE = 50
+
+
+def get_page_revisions(
+    titles: List[str], wiki_session: WikiSession
+) -> Dict[str, Optional[Dict[str, Any]]]:
+    """
+    Gets the latest revision ID and timestamp of each page in a list.
+
+    :param titles: The titles of the pages.
+    :type titles: List[str]
+    :param wiki_session: The session used to make requests to the API.
+    :type wiki_session: WikiSession
+    :return: The "revid" and "timestamp" of each page, keyed by the titles
+        given, or None for pages that do not exist.
+    :rtype: Dict[str, Optional[Dict[str, Any]]]
+    """
+    revisions: Dict[str, Optional[Dict[str, Any]]] = {title: None for title in titles}
+
+    unique_titles = list(revisions)
+
+    # one query is made for every REVISION_BATCH_SIZE titles
+    for start in range(0, len(unique_titles), REVISION_BATCH_SIZE):
+        batch = unique_titles[start : start + REVISION_BATCH_SIZE]
+
+        result = wiki_session.get(
+            {
+                "action": "query",
+                "prop": "revisions",
+                "titles": "|".join(batch),
+                "rvprop": "ids|timestamp",
+                "formatversion": "2",
+            }
+        )
+
+        query = result.get("query", {})
+
+        # map the titles MediaWiki normalised back to the titles we asked for
+        requested_titles = {title: title for title in batch}
+
+        for normalized in query.get("normalized", []):
+            requested_titles[normalized["to"]] = normalized["from"]
+
+        for page in query.get("pages", []):
+            if page.get("missing") or not page.get("revisions"):
+                continue
+
+            revision = page["revisions"][0]
+
+            revisions[requested_titles.get(page["title"], page["title"])] = {
+                "revid": revision["revid"],
+                "timestamp": revision["timestamp"],
+            }
+
+    return revisions
+
+
+def get_page_sections(title: str, wiki_session: WikiSession) -> Dict[str, int]:
+    """
+    Gets the index of each section on a page.
+
+    :param title: The title of the page.
+    :type title: str
+    :param wiki_session: The session used to make requests to the API.
+    :type wiki_session: WikiSession
+    :return: The index of each section, keyed by heading.
+    :rtype: Dict[str, int]
+    """
+    result = wiki_session.get(
+        {"action": "parse", "page": title, "prop": "sections", "formatversion": "2"}
+    )
+
+    sections: Dict[str, int] = {}
+
+    for section in result["parse"]["sections"]:
+        # sections from transcluded templates have indexes such as "T-1" and cannot be edited here
+        if str(section["index"]).isdigit():
+            sections.setdefault(section["line"].strip(), int(section["index"]))
+
+    return sections
+
+
+def get_section(title: str, section: int, wiki_session: WikiSession) -> Dict[str, Any]:
+    """
+    Gets the text of one section of a page and the revision it was read from.
+
+    :param title: The title of the page.
+    :type title: str
+    :param section: The index of the section.
+    :type section: int
+    :param wiki_session: The session used to make requests to the API.
+    :type wiki_session: WikiSession
+    :return: The "text", "revid" and "timestamp" of the section.
+    :rtype: Dict[str, Any]
+    """
+    result = wiki_session.get(
+        {
+            "action": "query",
+            "prop": "revisions",
+            "titles": title,
+            "rvprop": "content|ids|timestamp",
+            "rvslots": "main",
+            "rvsection": section,
+            "formatversion": "2",
+        }
+    )
+
+    revision = result["query"]["pages"][0]["revisions"][0]
+
+    return {
+        "text": revision["slots"]["main"]["content"],
+        "revid": revision["revid"],
+        "timestamp": revision["timestamp"],
+    }
+
+
+def edit_section(
+    title: str,
+    section: int,
+    update: Callable[[str], str],
+    summary: str,
+    wiki_session: WikiSession,
+) -> Dict[str, Any]:
+    """
+    Replaces one section of a page, retrying if the page changes while the
+    section is being edited.
+
+    The edit is made against the revision the section was read from. If
+    another edit is saved first, only that section is read again and the
+    update is applied to the new text.
+
+    :param title: The title of the page.
+    :type title: str
+    :param section: The index of the section.
+    :type section: int
+    :param update: A function that returns the new text of the section, given its current text.
+    :type update: Callable[[str], str]
+    :param summary: The edit summary.
+    :type summary: str
+    :param wiki_session: The session used to make requests to the API.
+    :type wiki_session: WikiSession
+    :return: The "edit" object from the API response.
+    :rtype: Dict[str, Any]
+
+    :raises MediaWikiAPIError: The API rejected the edit, or the edit conflicted too many times.
+    """
+    for attempt in range(EDIT_CONFLICT_RETRIES + 1):
+        current = get_section(title, section, wiki_session)
+
+        try:
+            return edit_page(
+                wiki_session,
+                title,
+                summary,
+                section=section,
+                text=update(current["text"]),
+                baserevid=current["revid"],
+                basetimestamp=current["timestamp"],
+                nocreate=1,
+            )
+        except MediaWikiAPIError as exception:
+            if exception.code != "editconflict" or attempt == EDIT_CONFLICT_RETRIES:
+                raise
+
+            RETRIES.inc(operation="edit", reason="editconflict")
+
+            logger.info("Edit conflict on %s, retrying", title)
+
+    raise MediaWikiAPIError("editconflict")
+
+
+# the blocks at the top of a review page that describe the place
+INFOBOX_BLOCKS = ("infobox", "h_geo")
+
+
+def _add_review_photo(
+    title: str,
+    photo: str,
+    photos_index: Optional[int],
+    summary: str,
+    wiki_session: WikiSession,
+) -> Dict[str, Any]:
+    # the photo goes at the end of the Photos section, which is added if the page has none
+    if photos_index is not None:
+        return edit_page(
+            wiki_session,
+            title,
+            summary,
+            section=photos_index,
+            appendtext=photo,
+            nocreate=1,
+        )
+
+    return edit_page(
+        wiki_session,
+        title,
+        summary,
+        appendtext="\n\n== Photos ==\n\n" + photo,
+        nocreate=1,
+    )
+
+
+def _add_review_text(
+    title: str,
+    content_details: Dict[str, Any],
+    reviews_index: Optional[int],
+    summary: str,
+    wiki_session: WikiSession,
+) -> Dict[str, Any]:
+    sections = content_details["sections"]
+
+    # the review is added to the Reviews section, which is added if the page has none
+    if reviews_index is None:
+        return edit_page(
+            wiki_session, title, summary, appendtext=sections["reviews"], nocreate=1
+        )
+
+    review = sections["review"]
+
+    return edit_section(
+        title,
+        reviews_index,
+        lambda text: add_review_to_text(
+            text,
+            content_details["url"],
+            review["h_review"],
+            review["domain"],
+            review["content"],
+        ),
+        summary,
+        wiki_session,
+    )
+
+
+def _add_review_infobox(
+    title: str, infobox: str, summary: str, wiki_session: WikiSession
+) -> Optional[Dict[str, Any]]:
+    # the infobox and the h-geo are each only added if the page does not have one yet
+    lead = WikiPage.parse(get_section(title, 0, wiki_session)["text"])
+
+    blocks = [block for block in WikiPage.parse(infobox).blocks() if block.kind in INFOBOX_BLOCKS]
+    missing = [block.text for block in blocks if lead.find(block.kind) is None]
+
+    if not missing:
+        return None
+
+    # a page with neither gets them exactly as a new page would
+    if len(missing) < len(blocks):
+        infobox = "\n".join(missing)
+
+    return edit_page(
+        wiki_session,
+        title,
+        summary,
+        section=0,
+        prependtext=infobox,
+        nocreate=1,
+    )
+
+
+def publish_review(
+    content_details: Dict[str, Any],
+    wiki_session: WikiSession,
+    exists: Optional[bool] = None,
+) -> str:
+    """
+    Publishes a review to the wiki.
+
+    If the page for the place does not exist, it is created. Otherwise, only
+    the Reviews, Photos and Infobox sections are sent to the wiki: the review
+    is added to the Reviews section, the photo is appended to the Photos
+    section, and an infobox is added if the page does not have one.
+
+    :param content_details: The output of parse_h_review.
+    :type content_details: Dict[str, Any]
+    :param wiki_session: The session used to make requests to the API.
+    :type wiki_session: WikiSession
+    :param exists: Whether the page is known to exist. It is looked up if None.
+    :type exists: Optional[bool]
+    :return: "created" if a new page was created, otherwise "updated".
+    :rtype: str
+
+    :raises MediaWikiAPIError: The API rejected an edit.
+    """
+    title = content_details["name"]
+    sections = content_details["sections"]
+    summary = f"Review added by coffeebot from {content_details['url']}"
+
+    if exists is None:
+        exists = get_page_revisions([title], wiki_session)[title] is not None
+
+    if not exists:
+        try:
+            edit = edit_page(
+                wiki_session,
+                title,
+                f"New page created by coffeebot from {content_details['url']}",
+                text=content_details["content"]["html"],
+                createonly=1,
+            )
+            content_details["revid"] = edit.get("newrevid")
+
+            return "created"
+        except MediaWikiAPIError as exception:
+            # the page was created by another request since we checked
+            if exception.code != "articleexists":
+                raise
+
+    section_indexes = get_page_sections(title, wiki_session)
+    photos_index = section_indexes.get("Photos")
+
+    edits = []
+
+    # the review adds headings, which would move the Photos section, so the photo is added first
+    if sections["photo"] and photos_index is not None:
+        edits.append(
+            _add_review_photo(
+                title, sections["photo"], photos_index, summary, wiki_session
+            )
+        )
+
+    edits.append(
+        _add_review_text(
+            title, content_details, section_indexes.get("Reviews"), summary, wiki_session
+        )
+    )
+
+    # a new Photos section goes at the end of the page, after the review
+    if sections["photo"] and photos_index is None:
+        edits.append(
+            _add_review_photo(title, sections["photo"], None, summary, wiki_session)
+        )
+
+    if sections["infobox"]:
+        infobox_edit = _add_review_infobox(title, sections["infobox"], summary, wiki_session)
+
+        if infobox_edit is not None:
+            edits.append(infobox_edit)
+
+    # the revision created by the last edit that changed the page
+    revids = [edit["newrevid"] for edit in edits if "newrevid" in edit]
+    content_details["revid"] = revids[-1] if revids else None
+
+    return "updated"
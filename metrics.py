@@ -0,0 +1,363 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import config
+from profiling import get_active_profile, run_profiled
+
+# if True, timings and counters are recorded and served at /metrics
+METRICS_ENABLED = getattr(config, "METRICS_ENABLED", False)
+
+# the upper bounds, in seconds, of the histogram buckets
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+METRIC_PREFIX = "mf2wiki_"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """
+    A named metric with a value for each combination of label values.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = METRIC_PREFIX + name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], Any] = {}
+
+        registry.append(self)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def _labels(
+        self, key: Tuple[str, ...], extra: Sequence[Tuple[str, str]] = ()
+    ) -> str:
+        pairs = list(zip(self.label_names, key)) + list(extra)
+
+        if not pairs:
+            return ""
+
+        return (
+            "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+        )
+
+    def samples(self) -> List[str]:
+        """
+        Renders the metric's values as lines of the Prometheus text format.
+
+        :return: One line per value.
+        :rtype: List[str]
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+
+        return [
+            f"{self.name}{self._labels(key)} {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Counter(Metric):
+    """
+    A value that only goes up, such as the number of cache hits.
+    """
+
+    type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        """
+        Adds to the counter.
+
+        :param amount: The amount to add.
+        :type amount: float
+        :param labels: The label values.
+        """
+        if not METRICS_ENABLED:
+            return
+
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, such as the number of requests in progress.
+    """
+
+    type = "gauge"
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        """
+        Adds to the gauge.
+
+        :param amount: The amount to add. Use a negative amount to subtract.
+        :type amount: float
+        :param labels: The label values.
+        """
+        if not METRICS_ENABLED:
+            return
+
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: Any) -> None:
+        """
+        Subtracts from the gauge.
+
+        :param amount: The amount to subtract.
+        :type amount: float
+        :param labels: The label values.
+        """
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """
+    The distribution of observed values, such as how long each stage took.
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels: Any) -> None:
+        """
+        Records a value.
+
+        :param value: The value.
+        :type value: float
+        :param labels: The label values.
+        """
+        if not METRICS_ENABLED:
+            return
+
+        key = self._key(labels)
+
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+
+            self._values[key] = (counts, total + value)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(
+                (key, (list(counts), total))
+                for key, (counts, total) in self._values.items()
+            )
+
+        lines = []
+
+        for key, (counts, total) in values:
+            cumulative = 0
+
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = self._labels(key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+            lines.append(f"{self.name}_sum{self._labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+
+        return lines
+
+
+registry: List[Metric] = []
+
+
+def render_metrics() -> str:
+    """
+    Renders every metric in the Prometheus text exposition format.
+
+    :return: The metrics.
+    :rtype: str
+    """
+    lines = []
+
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.samples())
+
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "stage_seconds", "Time spent in each stage of publishing a post.", ["stage"]
+)
+STAGE_ERRORS = Counter(
+    "stage_errors_total", "Stages that raised an exception.", ["stage", "error"]
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total", "Lookups in each cache, by result.", ["cache", "result"]
+)
+SOURCES_REJECTED = Counter(
+    "sources_rejected_total",
+    "Source posts rejected before parsing, by reason.",
+    ["reason"],
+)
+RETRIES = Counter(
+    "retries_total",
+    "Requests that were retried, by operation and reason.",
+    ["operation", "reason"],
+)
+ITEMS_PUBLISHED = Counter(
+    "items_published_total", "Items published to the wiki.", ["post_type", "status"]
+)
+REQUEST_SECONDS = Histogram(
+    "request_duration_seconds",
+    "Time taken to respond to HTTP requests.",
+    ["endpoint", "method", "status"],
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "requests_in_flight", "HTTP requests being processed.", ["endpoint"]
+)
+
+
+class RequestTimings:
+    """
+    The total time spent in each stage while handling one request.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage_name: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[stage_name] = self.stages.get(stage_name, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        """
+        Formats the timings as a Server-Timing header.
+
+        :return: The value of the header, in milliseconds.
+        :rtype: str
+        """
+        with self._lock:
+            stages = list(self.stages.items())
+
+        stages.append(("total", time.perf_counter() - self.started))
+
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in stages)
+
+
+_request_timings: "contextvars.ContextVar[Optional[RequestTimings]]" = (
+    contextvars.ContextVar("request_timings", default=None)
+)
+
+
+def start_request_timings() -> Optional[RequestTimings]:
+    """
+    Starts collecting stage timings for the current request.
+
+    :return: The timings, or None if metrics are disabled.
+    :rtype: Optional[RequestTimings]
+    """
+    if not METRICS_ENABLED:
+        return None
+
+    timings = RequestTimings()
+    _request_timings.set(timings)
+
+    return timings
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Times a stage, adding it to the stage histogram and to the timings of the
+    current request. Exceptions raised by the stage are counted.
+
+    :param name: The name of the stage.
+    :type name: str
+    """
+    if not METRICS_ENABLED:
+        yield
+        return
+
+    started = time.perf_counter()
+
+    try:
+        yield
+    except BaseException as exception:
+        STAGE_ERRORS.inc(stage=name, error=type(exception).__name__)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+
+        STAGE_SECONDS.observe(elapsed, stage=name)
+
+        timings = _request_timings.get()
+
+        if timings is not None:
+            timings.add(name, elapsed)
+
+
+def in_request_context(function: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Wraps a function so that stages it runs on another thread are added to
+    the timings, and to the profile, of the request that created it.
+
+    :param function: The function to wrap.
+    :type function: Callable[..., Any]
+    :return: The wrapped function.
+    :rtype: Callable[..., Any]
+    """
+    if not METRICS_ENABLED and get_active_profile() is None:
+        return function
+
+    context = contextvars.copy_context()
+
+    # each call gets its own copy, since one context cannot be entered by two threads at once
+    return lambda *args, **kwargs: context.copy().run(
+        run_profiled, function, *args, **kwargs
+    )
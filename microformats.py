@@ -0,0 +1,125 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+
+
+@dataclass
+class ExtractedMicroformats:
+    """
+    The microformats found on a page, grouped by type.
+
+    Items are listed in document order and include items nested in the
+    children or properties of other items.
+    """
+
+    parsed: Dict[str, Any]
+    entries: List[dict] = field(default_factory=list)
+    reviews: List[dict] = field(default_factory=list)
+    recipes: List[dict] = field(default_factory=list)
+    geos: List[dict] = field(default_factory=list)
+    parents: Dict[int, dict] = field(default_factory=dict, repr=False)
+    nested_geos: Dict[int, List[dict]] = field(default_factory=dict, repr=False)
+
+    def parent_of(self, item: dict) -> Optional[dict]:
+        """
+        Gets the item that contains an item.
+
+        :param item: An item found on the page.
+        :type item: dict
+        :return: The containing item, or None if the item is at the top level of the page.
+        :rtype: Optional[dict]
+        """
+        return self.parents.get(id(item))
+
+    def geo_for(self, item: dict) -> Optional[dict]:
+        """
+        Gets the h-geo that describes the location of an item.
+
+        The h-geo nearest to the item is used: one nested in the item itself,
+        then one nested in each containing item. If the page has only one
+        h-review, an h-geo elsewhere on the page is used for it too. On a page
+        with several reviews, such an h-geo could describe any of them, so it
+        is not used.
+
+        :param item: An item found on the page.
+        :type item: dict
+        :return: The h-geo, or None if no h-geo describes the item.
+        :rtype: Optional[dict]
+        """
+        current: Optional[dict] = item
+
+        while current is not None:
+            geos = self.nested_geos.get(id(current))
+
+            if geos:
+                return geos[0]
+
+            current = self.parent_of(current)
+
+        if self.geos and len(self.reviews) == 1:
+            return self.geos[0]
+
+        return None
+
+    def iter_items(self) -> Iterator[dict]:
+        """
+        Yields every item on the page in document order, including nested items.
+
+        :return: A generator of items.
+        :rtype: Iterator[dict]
+        """
+        stack = list(reversed(self.parsed.get("items", [])))
+
+        while stack:
+            item = stack.pop()
+
+            yield item
+
+            stack.extend(reversed(_nested_items(item)))
+
+
+def _nested_items(item: dict) -> List[dict]:
+    nested = list(item.get("children", []))
+
+    for values in item.get("properties", {}).values():
+        for value in values:
+            if isinstance(value, dict) and value.get("type"):
+                nested.append(value)
+
+    return nested
+
+
+def extract_microformats(parsed: Dict[str, Any]) -> ExtractedMicroformats:
+    """
+    Walks a parsed mf2 document once and groups its h-entry, h-review,
+    h-recipe and h-geo items.
+
+    :param parsed: The output of mf2py.parse.
+    :type parsed: Dict[str, Any]
+    :return: The items on the page, grouped by type.
+    :rtype: ExtractedMicroformats
+    """
+    extracted = ExtractedMicroformats(parsed=parsed)
+
+    groups = {
+        "h-entry": extracted.entries,
+        "h-review": extracted.reviews,
+        "h-recipe": extracted.recipes,
+        "h-geo": extracted.geos,
+    }
+
+    for item in extracted.iter_items():
+        for item_type in item.get("type", []):
+            if item_type in groups:
+                groups[item_type].append(item)
+
+        nested = _nested_items(item)
+
+        for nested_item in nested:
+            extracted.parents[id(nested_item)] = item
+
+        geos = [n for n in nested if "h-geo" in n.get("type", [])]
+
+        if geos:
+            extracted.nested_geos[id(item)] = geos
+
+    return extracted
@@ -0,0 +1,269 @@
+import contextvars
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+import config
+from config import PASSPHRASE
+
+logger = logging.getLogger(__name__)
+
+# the directory in which request profiles are saved
+PROFILE_DIR = getattr(config, "PROFILE_DIR", ".cache/profiles")
+
+# the fraction of requests, between 0 and 1, that are profiled without being asked
+PROFILE_SAMPLE_RATE = getattr(config, "PROFILE_SAMPLE_RATE", 0.0)
+
+# the number of profiles kept; the oldest are deleted first
+PROFILE_MAX_FILES = getattr(config, "PROFILE_MAX_FILES", 100)
+
+PROFILE_EXTENSION = ".prof"
+
+
+class RequestProfile:
+    """
+    A cProfile trace of one request, including the work it hands to thread pools.
+
+    cProfile only sees the thread it was enabled on, so each thread that
+    works on the request gets its own profiler. The profilers are merged when
+    the profile is saved.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.time()
+        self.context_token: Optional[contextvars.Token] = None
+        self._profilers: List[cProfile.Profile] = []
+        self._lock = threading.Lock()
+
+    def enable(self) -> Optional[cProfile.Profile]:
+        """
+        Starts profiling the current thread.
+
+        :return: The profiler, or None if another profiler is already running.
+        :rtype: Optional[cProfile.Profile]
+        """
+        profiler = cProfile.Profile()
+
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12 and later only allow one profiler at a time
+            logger.debug("Could not profile a thread of %s", self.name)
+            return None
+
+        with self._lock:
+            self._profilers.append(profiler)
+
+        return profiler
+
+    def run(self, function: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        Calls a function on the current thread, adding it to the profile.
+
+        :param function: The function to call.
+        :type function: Callable[..., Any]
+        :return: The return value of the function.
+        :rtype: Any
+        """
+        profiler = self.enable()
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+
+    def disable(self) -> List[cProfile.Profile]:
+        """
+        Stops every profiler that is part of the profile.
+
+        :return: The profilers.
+        :rtype: List[cProfile.Profile]
+        """
+        with self._lock:
+            profilers = list(self._profilers)
+
+        for profiler in profilers:
+            profiler.disable()
+
+        return profilers
+
+    def save(self, directory: str = PROFILE_DIR) -> Optional[str]:
+        """
+        Merges the profile of every thread and saves it in pstats format.
+
+        :param directory: The directory in which to save the profile.
+        :type directory: str
+        :return: The file name of the profile, or None if nothing was profiled.
+        :rtype: Optional[str]
+        """
+        profilers = self.disable()
+
+        if not profilers:
+            return None
+
+        stats = pstats.Stats(profilers[0])
+
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+
+        os.makedirs(directory, exist_ok=True)
+
+        file_name = (
+            time.strftime("%Y%m%dT%H%M%S", time.gmtime(self.started))
+            + f"-{self.name}-{uuid.uuid4().hex[:8]}{PROFILE_EXTENSION}"
+        )
+
+        stats.dump_stats(os.path.join(directory, file_name))
+
+        rotate_profiles(directory)
+
+        return file_name
+
+
+_active_profile: "contextvars.ContextVar[Optional[RequestProfile]]" = (
+    contextvars.ContextVar("active_profile", default=None)
+)
+
+
+def should_profile(token: Optional[str]) -> bool:
+    """
+    Decides whether to profile a request.
+
+    :param token: The value of the request's X-Profile header or profile query
+        parameter, which must be the passphrase to ask for a profile.
+    :type token: Optional[str]
+    :return: Whether to profile the request.
+    :rtype: bool
+    """
+    if token and token == PASSPHRASE:
+        return True
+
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def start_profile(name: str) -> RequestProfile:
+    """
+    Starts profiling the current request on the current thread. It must be
+    stopped with stop_profile when the request ends.
+
+    :param name: A name for the profile, such as the endpoint.
+    :type name: str
+    :return: The profile.
+    :rtype: RequestProfile
+    """
+    profile = RequestProfile(name)
+    profile.context_token = _active_profile.set(profile)
+    profile.enable()
+
+    return profile
+
+
+def stop_profile(profile: RequestProfile) -> None:
+    """
+    Stops profiling the current request, so that later requests handled by
+    the same thread are not added to its profile.
+
+    :param profile: The profile returned by start_profile.
+    :type profile: RequestProfile
+    """
+    profile.disable()
+
+    if profile.context_token is not None:
+        _active_profile.reset(profile.context_token)
+        profile.context_token = None
+
+
+def get_active_profile() -> Optional[RequestProfile]:
+    """
+    Gets the profile of the current request.
+
+    :return: The profile, or None if the request is not being profiled.
+    :rtype: Optional[RequestProfile]
+    """
+    return _active_profile.get()
+
+
+def run_profiled(function: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """
+    Calls a function, adding it to the profile of the current request if
+    there is one.
+
+    :param function: The function to call.
+    :type function: Callable[..., Any]
+    :return: The return value of the function.
+    :rtype: Any
+    """
+    profile = _active_profile.get()
+
+    if profile is None:
+        return function(*args, **kwargs)
+
+    return profile.run(function, *args, **kwargs)
+
+
+def rotate_profiles(directory: str = PROFILE_DIR) -> None:
+    """
+    Deletes the oldest profiles once there are more than PROFILE_MAX_FILES.
+
+    :param directory: The directory in which profiles are saved.
+    :type directory: str
+    """
+    profiles = list_profiles(directory)
+
+    for profile in profiles[PROFILE_MAX_FILES:]:
+        try:
+            os.remove(os.path.join(directory, profile["name"]))
+        except OSError:
+            pass
+
+
+def list_profiles(directory: str = PROFILE_DIR) -> List[Dict[str, Any]]:
+    """
+    Lists the saved profiles, newest first.
+
+    :param directory: The directory in which profiles are saved.
+    :type directory: str
+    :return: The "name", "size" in bytes and "created" time of each profile.
+    :rtype: List[Dict[str, Any]]
+    """
+    if not os.path.isdir(directory):
+        return []
+
+    profiles = []
+
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.name.endswith(PROFILE_EXTENSION):
+            stat = entry.stat()
+            profiles.append(
+                {"name": entry.name, "size": stat.st_size, "created": stat.st_mtime}
+            )
+
+    return sorted(profiles, key=lambda profile: profile["created"], reverse=True)
+
+
+def format_profile(path: str, limit: int = 50) -> str:
+    """
+    Formats a saved profile as a table of the functions that took the most time.
+
+    :param path: The path of the profile.
+    :type path: str
+    :param limit: The number of functions to show.
+    :type limit: int
+    :return: The table.
+    :rtype: str
+    """
+    output = io.StringIO()
+
+    stats = pstats.Stats(path, stream=output)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+
+    return output.getvalue()
@@ -0,0 +1,79 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket rate limiter.
+
+    Tokens are added at `rate` per second, up to `capacity`. Callers that
+    find the bucket empty reserve a token and sleep until it is available, so
+    waiting callers are served in the order they arrived.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        """
+        Takes tokens from the bucket only if they are available now.
+
+        Unlike `reserve`, nothing is taken if the caller would have to wait,
+        so callers can decide again who goes next when the tokens are ready.
+
+        :param tokens: The number of tokens to take.
+        :type tokens: float
+        :return: 0 if the tokens were taken, otherwise the number of seconds
+            until they will be available.
+        :rtype: float
+        """
+        with self._lock:
+            self._refill()
+
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+
+            return (tokens - self._tokens) / self.rate
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """
+        Takes tokens from the bucket without waiting.
+
+        :param tokens: The number of tokens to take.
+        :type tokens: float
+        :return: The number of seconds the caller must wait before using the tokens.
+        :rtype: float
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+
+            if self._tokens >= 0:
+                return 0.0
+
+            return -self._tokens / self.rate
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        """
+        Takes tokens from the bucket, waiting until they are available.
+
+        :param tokens: The number of tokens to take.
+        :type tokens: float
+        """
+        wait = self.reserve(tokens)
+
+        if wait > 0:
+            time.sleep(wait)
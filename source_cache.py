@@ -0,0 +1,480 @@
+import codecs
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import mf2py
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+from metrics import CACHE_REQUESTS, SOURCES_REJECTED, stage
+
+logger = logging.getLogger(__name__)
+
+# the directory in which fetched source posts are cached
+SOURCE_CACHE_DIR = getattr(config, "SOURCE_CACHE_DIR", ".cache/sources")
+
+# the maximum size, in bytes, of the source post cache
+SOURCE_CACHE_MAX_BYTES = getattr(config, "SOURCE_CACHE_MAX_BYTES", 100 * 1024 * 1024)
+
+# the timeout, in seconds, for requests to fetch source posts
+SOURCE_FETCH_TIMEOUT = getattr(config, "SOURCE_FETCH_TIMEOUT", 30)
+
+# the number of pooled connections kept open to each source website
+SOURCE_POOL_SIZE = getattr(config, "SOURCE_POOL_SIZE", 10)
+
+# the largest source post, in bytes, that is downloaded and parsed
+MAX_SOURCE_BYTES = getattr(config, "MAX_SOURCE_BYTES", 5 * 1024 * 1024)
+
+# the content types of source posts that are parsed; posts sent without a content type are parsed too
+SOURCE_CONTENT_TYPES = getattr(
+    config, "SOURCE_CONTENT_TYPES", ("text/html", "application/xhtml+xml")
+)
+
+# the number of bytes read from a source post at a time
+SOURCE_CHUNK_SIZE = 64 * 1024
+
+# the format of cached entries; entries written in an older format are fetched again
+SOURCE_CACHE_VERSION = 2
+
+# a charset declared in a Content-Type header or a <meta> tag
+CHARSET_PATTERN = re.compile(rb"""charset\s*=\s*["']?([\w.:-]+)""", re.IGNORECASE)
+
+# the number of bytes at the start of a page that are searched for a <meta> charset
+META_CHARSET_BYTES = 4096
+
+# a class name that only appears on pages with a post that can be published
+POST_CLASS_PATTERN = re.compile(rb"(?<![\w-])h-(?:entry|review|recipe)(?!\w)")
+
+
+class SourceRejected(Exception):
+    """
+    A source post was rejected before it was parsed.
+    """
+
+    pass
+
+
+class SourceTooLarge(SourceRejected):
+    """
+    A source post is larger than MAX_SOURCE_BYTES.
+    """
+
+    pass
+
+
+class UnsupportedContentType(SourceRejected):
+    """
+    A source post is not served as HTML.
+    """
+
+    pass
+
+
+class PostMarkupNotFound(SourceRejected):
+    """
+    A source post does not use the h-entry, h-review or h-recipe class names,
+    so it cannot contain anything to publish.
+    """
+
+    pass
+
+
+def check_content_type(
+    content_type: Optional[str], allowed: Sequence[str] = SOURCE_CONTENT_TYPES
+) -> None:
+    """
+    Checks that a source post is served with a content type that can be parsed.
+
+    :param content_type: The value of the Content-Type header, if any.
+    :type content_type: Optional[str]
+    :param allowed: The media types that can be parsed.
+    :type allowed: Sequence[str]
+
+    :raises UnsupportedContentType: The content type is not one of those allowed.
+    """
+    if not content_type:
+        return
+
+    media_type = content_type.split(";", 1)[0].strip().lower()
+
+    if media_type not in allowed:
+        raise UnsupportedContentType(media_type)
+
+
+def read_body(response: requests.Response, max_bytes: int = MAX_SOURCE_BYTES) -> bytes:
+    """
+    Downloads the body of a streamed response, stopping once it is too large.
+
+    :param response: The response, requested with stream=True.
+    :type response: requests.Response
+    :param max_bytes: The largest body that is downloaded.
+    :type max_bytes: int
+    :return: The body.
+    :rtype: bytes
+
+    :raises SourceTooLarge: The body is larger than max_bytes.
+    """
+    content_length = response.headers.get("Content-Length", "")
+
+    # a body that says it is too large is not downloaded at all
+    if content_length.isdigit() and int(content_length) > max_bytes:
+        raise SourceTooLarge(f"{content_length} bytes")
+
+    chunks = []
+    size = 0
+
+    for chunk in response.iter_content(SOURCE_CHUNK_SIZE):
+        size += len(chunk)
+
+        if size > max_bytes:
+            raise SourceTooLarge(f"more than {max_bytes} bytes")
+
+        chunks.append(chunk)
+
+    return b"".join(chunks)
+
+
+def has_post_markup(body: bytes) -> bool:
+    """
+    Checks, without parsing the page, whether a page could contain a h-entry,
+    h-review or h-recipe.
+
+    The check looks for the class names anywhere in the page, so a page that
+    only mentions them in its text passes too. Those pages are rejected after
+    they are parsed, when no items are found.
+
+    :param body: The page.
+    :type body: bytes
+    :return: Whether the page uses any of the class names.
+    :rtype: bool
+    """
+    return POST_CLASS_PATTERN.search(body) is not None
+
+
+def _find_charset(text: bytes) -> Optional[str]:
+    match = CHARSET_PATTERN.search(text)
+
+    if match is None:
+        return None
+
+    charset = match.group(1).decode("ascii", errors="ignore")
+
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        return None
+
+    return charset
+
+
+def decode_body(body: bytes, content_type: Optional[str]) -> str:
+    """
+    Decodes a page using the charset it declares.
+
+    The charset in the Content-Type header is used if there is one. Otherwise
+    the page's <meta> charset is used, and pages that declare neither are
+    decoded as UTF-8. Unlike requests, text/html without a charset is not
+    assumed to be ISO-8859-1, since most pages that leave it out are UTF-8.
+
+    :param body: The page.
+    :type body: bytes
+    :param content_type: The value of the Content-Type header, if any.
+    :type content_type: Optional[str]
+    :return: The decoded page.
+    :rtype: str
+    """
+    if body.startswith(codecs.BOM_UTF8):
+        return body[len(codecs.BOM_UTF8) :].decode("utf-8", errors="replace")
+
+    charset = (
+        _find_charset(content_type.encode("latin-1", errors="ignore"))
+        if content_type
+        else None
+    )
+
+    if charset is None:
+        charset = _find_charset(body[:META_CHARSET_BYTES]) or "utf-8"
+
+    return body.decode(charset, errors="replace")
+
+
+class SourceCache:
+    """
+    An on-disk HTTP cache of source posts and their parsed microformats.
+
+    Each cached post is revalidated with a conditional request. If the server
+    replies 304 Not Modified, the parsed microformats are read from the cache
+    so the post is neither downloaded nor parsed again.
+
+    The least recently used posts are removed when the cache is larger than
+    its size limit.
+    """
+
+    def __init__(
+        self,
+        directory: str = SOURCE_CACHE_DIR,
+        max_bytes: int = SOURCE_CACHE_MAX_BYTES,
+        max_source_bytes: int = MAX_SOURCE_BYTES,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_source_bytes = max_source_bytes
+        self.session = requests.Session()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._size = 0
+
+        adapter = HTTPAdapter(pool_maxsize=SOURCE_POOL_SIZE)
+
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._load_index()
+
+    def _load_index(self) -> None:
+        entries = []
+
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(".json"):
+                continue
+
+            key = file_name[: -len(".json")]
+
+            try:
+                stat = os.stat(self._path(key, "json"))
+                size = stat.st_size + os.path.getsize(self._path(key, "html"))
+            except OSError:
+                continue
+
+            entries.append((stat.st_mtime, key, size))
+
+        # oldest first, so the least recently used entry is evicted first
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._size += size
+
+    def _path(self, key: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{key}.{extension}")
+
+    def _read(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(key, "json"), "r") as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # older entries may have been decoded with the wrong charset
+        if metadata.get("version") != SOURCE_CACHE_VERSION:
+            return None
+
+        return metadata
+
+    def _write(self, key: str, metadata: Dict[str, Any], body: str) -> None:
+        for extension, contents in (("html", body), ("json", json.dumps(metadata))):
+            temporary_path = self._path(key, extension) + ".tmp"
+
+            with open(temporary_path, "w") as f:
+                f.write(contents)
+
+            os.replace(temporary_path, self._path(key, extension))
+
+        size = os.path.getsize(self._path(key, "json")) + os.path.getsize(
+            self._path(key, "html")
+        )
+
+        with self._lock:
+            self._size -= self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._size += size
+
+            self._evict()
+
+    def _touch(self, key: str) -> None:
+        try:
+            os.utime(self._path(key, "json"))
+        except OSError:
+            pass
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+
+    def _evict(self) -> None:
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+
+            for extension in ("json", "html"):
+                try:
+                    os.remove(self._path(key, extension))
+                except OSError:
+                    pass
+
+    def _get(
+        self, url: str, headers: Dict[str, str], revalidating: bool
+    ) -> Tuple[requests.Response, Optional[bytes]]:
+        # the body is streamed so that it can be checked before, and while, it is downloaded
+        with self.session.get(
+            url, headers=headers, timeout=SOURCE_FETCH_TIMEOUT, stream=True
+        ) as response:
+            if revalidating and response.status_code == 304:
+                return response, None
+
+            response.raise_for_status()
+
+            check_content_type(response.headers.get("Content-Type"))
+
+            return response, read_body(response, self.max_source_bytes)
+
+    def _conditional_headers(self, cached: Optional[Dict[str, Any]]) -> Dict[str, str]:
+        headers = {}
+
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        return headers
+
+    def _store(
+        self,
+        key: str,
+        url: str,
+        response: requests.Response,
+        text: str,
+        parsed: Dict[str, Any],
+    ) -> None:
+        # only responses the server lets us revalidate are worth keeping
+        if not response.headers.get("ETag") and not response.headers.get(
+            "Last-Modified"
+        ):
+            return
+
+        metadata = {
+            "version": SOURCE_CACHE_VERSION,
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "parsed": parsed,
+        }
+
+        try:
+            self._write(key, metadata, text)
+        except OSError:
+            logger.exception("Could not cache %s", url)
+
+    def fetch(self, url: str, screen: bool = True) -> Dict[str, Any]:
+        """
+        Gets the parsed microformats on a page, using the cache if the page
+        has not changed.
+
+        :param url: The URL of the page.
+        :type url: str
+        :param screen: Whether to reject pages without a h-entry, h-review or
+            h-recipe class name before parsing them. Pass False for pages that
+            are read for other microformats, such as the h-geo on wiki pages.
+        :type screen: bool
+        :return: The output of mf2py.parse for the page.
+        :rtype: Dict[str, Any]
+
+        :raises requests.exceptions.RequestException: The request to get the page failed.
+        :raises SourceRejected: The page is too large, is not HTML, or cannot contain a post.
+        """
+        key = hashlib.sha256(url.encode()).hexdigest()
+
+        cached = self._read(key)
+
+        try:
+            with stage("fetch"):
+                response, body = self._get(
+                    url,
+                    self._conditional_headers(cached),
+                    revalidating=cached is not None,
+                )
+
+            if body is not None and screen:
+                with stage("screen"):
+                    if not has_post_markup(body):
+                        raise PostMarkupNotFound
+        except SourceRejected as exception:
+            SOURCES_REJECTED.inc(reason=type(exception).__name__)
+            raise
+
+        if body is None:
+            # only a request that revalidated a cached page is answered without a body
+            assert cached is not None
+
+            with self._lock:
+                self.hits += 1
+
+            CACHE_REQUESTS.inc(cache="source", result="hit")
+
+            self._touch(key)
+
+            return cached["parsed"]
+
+        with self._lock:
+            self.misses += 1
+
+        CACHE_REQUESTS.inc(cache="source", result="miss")
+
+        text = decode_body(body, response.headers.get("Content-Type"))
+
+        with stage("parse"):
+            parsed = mf2py.parse(doc=text, url=response.url)
+
+        self._store(key, url, response, text, parsed)
+
+        return parsed
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the cache's hit and miss counters.
+
+        :return: The number of hits, misses and evictions, and the size of the cache.
+        :rtype: Dict[str, int]
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._size,
+            }
+
+
+_source_cache: Optional[SourceCache] = None
+_source_cache_lock = threading.Lock()
+
+
+def get_source_cache() -> SourceCache:
+    """
+    Returns the process-wide source post cache, creating it on first use.
+
+    :return: The shared cache.
+    :rtype: SourceCache
+    """
+    global _source_cache
+
+    if _source_cache is None:
+        with _source_cache_lock:
+            if _source_cache is None:
+                _source_cache = SourceCache()
+
+    return _source_cache
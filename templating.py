@@ -0,0 +1,60 @@
+import os
+import threading
+from typing import Any, Optional
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+import config
+
+TEMPLATE_DIRECTORIES = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "wiki_templates"),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates"),
+]
+
+# the directory in which compiled templates are cached between worker starts
+TEMPLATE_CACHE_DIR = getattr(config, "TEMPLATE_CACHE_DIR", ".cache/templates")
+
+# if True, templates are recompiled when their files change (useful in development)
+TEMPLATE_AUTO_RELOAD = getattr(config, "TEMPLATE_AUTO_RELOAD", False)
+
+_environment: Optional[Environment] = None
+_environment_lock = threading.Lock()
+
+
+def get_template_environment() -> Environment:
+    """
+    Returns the process-wide environment used to render wiki pages and maps.
+
+    Each template is compiled once per process. Compiled templates are also
+    cached on disk, so new worker processes do not have to compile them again.
+
+    :return: The shared template environment.
+    :rtype: Environment
+    """
+    global _environment
+
+    if _environment is None:
+        with _environment_lock:
+            if _environment is None:
+                os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+
+                _environment = Environment(
+                    loader=FileSystemLoader(TEMPLATE_DIRECTORIES),
+                    bytecode_cache=FileSystemBytecodeCache(TEMPLATE_CACHE_DIR),
+                    auto_reload=TEMPLATE_AUTO_RELOAD,
+                )
+
+    return _environment
+
+
+def render_wiki_template(template_name: str, **context: Any) -> str:
+    """
+    Renders a template from the wiki_templates or templates directory.
+
+    :param template_name: The file name of the template.
+    :type template_name: str
+    :param context: The variables to pass to the template.
+    :return: The rendered template.
+    :rtype: str
+    """
+    return get_template_environment().get_template(template_name).render(**context)
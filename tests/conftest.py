@@ -0,0 +1,78 @@
+import os
+import sys
+import tempfile
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_wiki import FakeWiki, start_server  # noqa: E402
+
+# the modules of the app read the config when they are imported, so it is installed first
+_wiki = FakeWiki([])
+_server, ORIGIN = start_server(_wiki)
+_wiki.users = [ORIGIN.split("/")[2]]
+_cache_dir = tempfile.mkdtemp()
+
+config = types.ModuleType("config")
+config.__dict__.update(
+    {
+        "API_URL": f"{ORIGIN}/api.php",
+        "WIKI_URL": f"{ORIGIN}/wiki/",
+        "PASSPHRASE": "test",
+        "LGNAME": "Test",
+        "LGPASSWORD": "test",
+        "SYNDICATION_LINK": "https://breakfastand.coffee",
+        "REQUIRE_SYNDICATION_LINK": False,
+        "SOURCE_CACHE_DIR": os.path.join(_cache_dir, "sources"),
+        "GEOCODE_CACHE_PATH": os.path.join(_cache_dir, "geocode.sqlite3"),
+        "GEO_INDEX_PATH": os.path.join(_cache_dir, "geo_index.sqlite3"),
+        "IDEMPOTENCY_STORE_PATH": os.path.join(_cache_dir, "idempotency.sqlite3"),
+        "TEMPLATE_CACHE_DIR": os.path.join(_cache_dir, "templates"),
+        "PROFILE_DIR": os.path.join(_cache_dir, "profiles"),
+        "MAP_UPDATE_QUIET_PERIOD": 24 * 60 * 60,
+        # the fake wiki has no rate limit
+        "EDIT_RATE_LIMIT": 1_000_000,
+        "EDIT_BURST": 1_000_000,
+    }
+)
+
+sys.modules["config"] = config
+
+# a reviews section as written by earlier versions of the bot, which never closed a review's <div>
+LEGACY_REVIEWS = """
+
+<div class='h-feed'>
+== Reviews ==
+
+<div class='h-review'>
+===<a href='https://example.com/review' class='p-name'>Harbour Coffee</a> by example.com - \
+<data value='4' class='p-rating'>4 stars</data> ===
+
+        <blockquote>Lovely flat white.</blockquote>
+
+        <div class='h-review-aggregate'>
+            <p><span class='p-item'>Harbour Coffee</span> aggregate review: ⭐⭐⭐⭐ - \
+<data value='4' class='p-average'>4</data>/<data value='5' class='p-best'>5</data>
+            (<data value='1' class='p-votes'>1</data> rating)
+</p>
+            <p>{{addyourself}}</p>
+        </div>[[Category:Falmouth]][[Category:United Kingdom]]"""
+
+
+@pytest.fixture
+def wiki() -> FakeWiki:
+    _wiki.pages.clear()
+
+    return _wiki
+
+
+@pytest.fixture
+def origin() -> str:
+    return ORIGIN
+
+
+@pytest.fixture
+def legacy_reviews() -> str:
+    return LEGACY_REVIEWS
@@ -0,0 +1,25 @@
+from hreview import add_review_to_text
+
+
+def test_ratings_are_counted_again_on_a_page_without_totals(legacy_reviews):
+    h_review = {"name": ["Harbour Coffee"], "rating": ["2"]}
+
+    text = add_review_to_text(
+        legacy_reviews,
+        "https://example.org/review",
+        h_review,
+        "example.org",
+        "Too busy.",
+    )
+
+    assert "data-rating-sum='6'" in text
+    assert "data-rating-count='2'" in text
+    assert "<data value='3.0' class='p-average'>" in text
+    assert text.count("h-review-aggregate") == 1
+
+    # the new review goes above the aggregate, after the review already on the page
+    assert (
+        text.index("example.com")
+        < text.index("example.org")
+        < text.index("h-review-aggregate")
+    )
@@ -0,0 +1,11 @@
+import pytest
+
+import importer
+from source_cache import SourceTooLarge
+
+
+def test_feed_larger_than_the_limit_is_not_read(origin, monkeypatch):
+    monkeypatch.setattr(importer, "MAX_FEED_BYTES", 1024)
+
+    with pytest.raises(SourceTooLarge):
+        importer.discover_urls(f"{origin}/posts/h_review_large")
@@ -0,0 +1,21 @@
+from app import app
+from profiling import get_active_profile
+
+
+def test_profile_does_not_outlive_its_request(wiki):
+    client = app.test_client()
+
+    # an invalid body is rejected after the profile has started
+    profiled = client.post(
+        "/webhook?passphrase=test", json={}, headers={"X-Profile": "test"}
+    )
+
+    assert profiled.status_code == 400
+    assert "X-Profile-Trace" in profiled.headers
+    assert get_active_profile() is None
+
+    unprofiled = client.post("/webhook?passphrase=test", json={})
+
+    assert unprofiled.status_code == 400
+    assert "X-Profile-Trace" not in unprofiled.headers
+    assert get_active_profile() is None
@@ -0,0 +1,56 @@
+from typing import Any, Dict
+
+import geocode
+from mediawiki import get_wiki_session, parse_url
+
+
+class NoCountryBackend:
+    """
+    A geocoder that finds a place but not the country it is in.
+    """
+
+    remote = False
+
+    def reverse(self, latitude: float, longitude: float) -> Dict[str, Any]:
+        return {"city": "Nowhere"}
+
+
+def test_h_geo_is_added_once_when_the_place_has_no_country(wiki, origin, monkeypatch):
+    monkeypatch.setattr(
+        geocode, "_geocoder", geocode.ReverseGeocoder(NoCountryBackend())
+    )
+
+    # three posts reviewing the same place
+    for version in range(3):
+        url = f"{origin}/posts/h_review_geo?n=7&version={version}"
+        statuses = [
+            details["status"] for details, _, _ in parse_url(url, get_wiki_session())
+        ]
+
+        assert statuses == ["created" if version == 0 else "updated"]
+
+    text = wiki.pages["Harbour Coffee 7"]["text"]
+
+    assert text.count('class="h-geo"') == 1
+    assert "Infobox" not in text
+
+
+def test_photos_of_every_review_go_in_one_photos_section(wiki, origin, monkeypatch):
+    monkeypatch.setattr(
+        geocode, "_geocoder", geocode.ReverseGeocoder(NoCountryBackend())
+    )
+
+    # three posts reviewing the same place, each with a photo
+    for version in range(3):
+        url = f"{origin}/posts/h_review_geo?n=8&version={version}"
+
+        for _ in parse_url(url, get_wiki_session()):
+            pass
+
+    text = wiki.pages["Harbour Coffee 8"]["text"]
+    before, heading, photos = text.partition("\n== Photos ==\n")
+
+    assert heading
+    assert "== Photos ==" not in photos
+    assert "photos/harbour.jpg" not in before
+    assert photos.count("photos/harbour.jpg") == 3
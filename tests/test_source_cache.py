@@ -0,0 +1,30 @@
+import pytest
+
+from app import app
+from hreview import get_h_geos
+from source_cache import PostMarkupNotFound, get_source_cache
+
+H_GEO_PAGE = (
+    '<div class="h-geo" style="display: none;">'
+    '<data class="p-latitude" value="51.5"></data>'
+    '<data class="p-longitude" value="-0.1"></data>'
+    "</div>"
+)
+
+
+def test_wiki_pages_are_harvested_without_the_post_screen(wiki, origin):
+    wiki.pages["Only A Place"] = {"text": H_GEO_PAGE, "revid": 1, "timestamp": ""}
+    url = f"{origin}/wiki/Only_A_Place"
+
+    with pytest.raises(PostMarkupNotFound):
+        get_source_cache().fetch(url)
+
+    assert [geo["properties"]["latitude"] for geo in get_h_geos(url)] == [["51.5"]]
+
+
+def test_index_rejects_pages_without_posts(wiki, origin):
+    wiki.pages["Only A Place"] = {"text": H_GEO_PAGE, "revid": 1, "timestamp": ""}
+
+    response = app.test_client().post("/", data={"url": f"{origin}/wiki/Only_A_Place"})
+
+    assert response.status_code == 422
@@ -0,0 +1,13 @@
+from mediawiki import WikiSession
+
+
+def test_login_expiring_on_the_first_request_logs_in_again(wiki, origin):
+    wiki.expired_logins = 1
+
+    session = WikiSession(f"{origin}/api.php")
+    result = session.get({"action": "query", "list": "allusers"})
+
+    assert result["query"]["allusers"]
+    assert wiki.expired_logins == 0
+    # once at startup, and again after the error
+    assert session._generation == 2
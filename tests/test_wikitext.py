@@ -0,0 +1,22 @@
+from wikitext import WikiPage
+
+
+def test_unclosed_review_ends_before_the_aggregate(legacy_reviews):
+    page = WikiPage.parse(legacy_reviews)
+    reviews = page.section("Reviews")
+
+    assert reviews is not None
+    assert [block.kind for block in reviews.blocks] == [
+        "heading",
+        "text",
+        "review",
+        "aggregate",
+        "category",
+        "category",
+    ]
+
+    review = reviews.find("review")
+
+    assert review is not None
+    assert "h-review-aggregate" not in review.text
+    assert page.serialize() == legacy_reviews
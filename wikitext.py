@@ -0,0 +1,216 @@
+import re
+from typing import Iterator, List, Optional
+
+# the parts of a review page that can be read and changed on their own
+BLOCK_PATTERN = re.compile(
+    r"(?P<heading>^==(?!=)[^\n]*?[^=\n]==[ \t]*$)"
+    r"|(?P<infobox>\{\{\s*Infobox\b.*?\}\})"
+    r"|(?P<h_geo><div class=\"h-geo\".*?</div>)"
+    # pages made by earlier versions of the bot never close a review's <div>, so a review also
+    # ends where the next review, the aggregate, a heading or the categories start
+    r"|(?P<review><div class='h-review'>.*?"
+    r"(?:</div>|(?=<div class='h-review|^==(?!=)|\[\[Category:|\Z)))"
+    r"|(?P<aggregate><div class='h-review-aggregate'[^>]*>.*?</div>)"
+    r"|(?P<photo><span class=\"plainlinks\">.*?</span>)"
+    r"|(?P<category>\[\[Category:[^\]]*\]\])",
+    re.DOTALL | re.MULTILINE,
+)
+
+
+class Block:
+    """
+    A piece of wikitext, such as a review, an infobox or plain text.
+    """
+
+    __slots__ = ("kind", "text")
+
+    def __init__(self, kind: str, text: str):
+        self.kind = kind
+        self.text = text
+
+    def __repr__(self) -> str:
+        return f"Block({self.kind!r}, {self.text[:30]!r})"
+
+
+class Section:
+    """
+    A level two section of a page and the blocks it contains.
+
+    The lead section, before the first heading, has no heading.
+    """
+
+    def __init__(self, heading: Optional[str] = None, heading_text: str = ""):
+        self.heading = heading
+        self.blocks: List[Block] = []
+
+        if heading_text:
+            self.blocks.append(Block("heading", heading_text))
+
+    def find(self, kind: str) -> Optional[Block]:
+        """
+        Gets the first block of a kind in the section.
+
+        :param kind: The kind of block, such as "review" or "aggregate".
+        :type kind: str
+        :return: The block, or None if the section has no block of that kind.
+        :rtype: Optional[Block]
+        """
+        for block in self.blocks:
+            if block.kind == kind:
+                return block
+
+        return None
+
+    def find_all(self, kind: str) -> List[Block]:
+        """
+        Gets every block of a kind in the section.
+
+        :param kind: The kind of block, such as "review" or "aggregate".
+        :type kind: str
+        :return: The blocks, in page order.
+        :rtype: List[Block]
+        """
+        return [block for block in self.blocks if block.kind == kind]
+
+    def insert_before(self, existing: Block, *blocks: Block) -> None:
+        """
+        Inserts blocks immediately before a block in the section.
+
+        :param existing: The block to insert before.
+        :type existing: Block
+        :param blocks: The blocks to insert.
+        """
+        index = next(i for i, block in enumerate(self.blocks) if block is existing)
+
+        self.blocks[index:index] = blocks
+
+    def append(self, *blocks: Block) -> None:
+        """
+        Adds blocks to the end of the section.
+
+        :param blocks: The blocks to add.
+        """
+        self.blocks.extend(blocks)
+
+    def prepend(self, *blocks: Block) -> None:
+        """
+        Adds blocks to the start of the section, after its heading.
+
+        :param blocks: The blocks to add.
+        """
+        start = 1 if self.heading is not None else 0
+
+        self.blocks[start:start] = blocks
+
+    @property
+    def text(self) -> str:
+        return "".join(block.text for block in self.blocks)
+
+
+class WikiPage:
+    """
+    A page of wikitext read into sections and blocks.
+
+    The page is read in one pass and written back in one pass. Writing an
+    unchanged page returns exactly the text it was read from.
+    """
+
+    def __init__(self, sections: List[Section]):
+        self.sections = sections
+
+    @classmethod
+    def parse(cls, text: str) -> "WikiPage":
+        """
+        Reads wikitext into sections and blocks.
+
+        :param text: The wikitext of the page, or of one section of a page.
+        :type text: str
+        :return: The page.
+        :rtype: WikiPage
+        """
+        sections = [Section()]
+        position = 0
+
+        for match in BLOCK_PATTERN.finditer(text):
+            if match.start() > position:
+                sections[-1].blocks.append(
+                    Block("text", text[position : match.start()])
+                )
+
+            kind = match.lastgroup or "text"
+
+            if kind == "heading":
+                heading = match.group(0).strip().strip("=").strip()
+                sections.append(Section(heading, match.group(0)))
+            else:
+                sections[-1].blocks.append(Block(kind, match.group(0)))
+
+            position = match.end()
+
+        if position < len(text):
+            sections[-1].blocks.append(Block("text", text[position:]))
+
+        return cls(sections)
+
+    @property
+    def lead(self) -> Section:
+        return self.sections[0]
+
+    def section(self, heading: str) -> Optional[Section]:
+        """
+        Gets a section by its heading.
+
+        :param heading: The heading of the section, such as "Reviews".
+        :type heading: str
+        :return: The section, or None if the page has no section with that heading.
+        :rtype: Optional[Section]
+        """
+        for section in self.sections:
+            if section.heading == heading:
+                return section
+
+        return None
+
+    def add_section(self, heading: str, *blocks: Block) -> Section:
+        """
+        Adds a section to the end of the page.
+
+        :param heading: The heading of the section.
+        :type heading: str
+        :param blocks: The blocks to add under the heading.
+        :return: The new section.
+        :rtype: Section
+        """
+        section = Section(heading, f"\n\n== {heading} ==\n\n")
+        section.append(*blocks)
+
+        self.sections.append(section)
+
+        return section
+
+    def blocks(self) -> Iterator[Block]:
+        """
+        Iterates over every block on the page, in page order.
+        """
+        for section in self.sections:
+            yield from section.blocks
+
+    def find(self, kind: str) -> Optional[Block]:
+        """
+        Gets the first block of a kind anywhere on the page.
+
+        :param kind: The kind of block, such as "infobox".
+        :type kind: str
+        :return: The block, or None if the page has no block of that kind.
+        :rtype: Optional[Block]
+        """
+        return next((block for block in self.blocks() if block.kind == kind), None)
+
+    def serialize(self) -> str:
+        """
+        Writes the page back to wikitext.
+
+        :return: The wikitext of the page.
+        :rtype: str
+        """
+        return "".join(block.text for block in self.blocks())